@@ -9,17 +9,15 @@ from pathlib import Path
 from enum import Enum
 import math
 
+from control import BangBangController
 from utils import send_message
 
 
 def average(values):
-    average = 0.0
     n = len(values)
     if n > 0:
-        for v in values:
-            average = average + v
-        average = average / n
-    return average
+        return math.fsum(values) / n
+    return 0.0
 
 
 class Activity:
@@ -38,27 +36,27 @@ class Activity:
         self.logger = logger
         self.temperature_log = None
         self.graph = None
-
-    def __del__(self):
-        # stop pump & heater?
-        send_message("time 0")
+        self.controller = BangBangController()
 
     def tick(self):
         pass
 
-    def set_temperatures(self, temperatures):
-        if len(temperatures) > 0:
-            ave = average(temperatures)
-            send_message("temp " + str(ave))
-            if self.temperature_log is not None:
-                self.temperature_log.log_temperatures(temperatures, ave)
-            return ave
-        return math.nan
+    def finish(self):
+        """ The activity is being replaced, so release anything it holds on to."""
+        send_message("time 0")
+        if self.graph is not None:
+            self.graph.close()
+        if self.temperature_log is not None:
+            self.temperature_log.close()
+
+    def log_temperatures(self, temperatures, average_temperature, window = None):
+        if self.temperature_log is not None and len(temperatures) > 0:
+            self.temperature_log.log_temperatures(temperatures, average_temperature, window)
 
     def send_updated_graph(self):
+        """ Ask for the graph to be redrawn. The GUI is told when it is ready."""
         if self.graph is not None:
             self.graph.write()
-            send_message("image " + self.graph.path())
 
     def is_holding_temperature(self):
         return False
@@ -76,16 +74,25 @@ class Activity:
         seconds - the time into the profile.
         heater_is_on - whether the heater is already on now
         """
-        target = self.profile.temperature_at(seconds)
-        state = Activity.State.OK
-        should_heat = False
-        if not math.isnan(target):
-            if temperature <= target - 0.6:
-                state = Activity.State.COLD
-            if temperature > target + 0.5:
-                state = Activity.State.HOT
-            should_heat = temperature < (target - 0.5)
-        return target, state, should_heat
+        return determine_state(self.profile, self.controller, temperature, seconds, heater_is_on)
+
+
+def determine_state(profile, controller, temperature, seconds, heater_is_on):
+    """
+    Returns (target, state, should_heat) for temperature, seconds into profile,
+    with controller deciding whether to heat. See Activity.determine_state.
+    This is also how the control process decides, without an Activity.
+    """
+    target = profile.temperature_at(seconds)
+    state = Activity.State.OK
+    should_heat = False
+    if not math.isnan(target):
+        if temperature <= target - 0.6:
+            state = Activity.State.COLD
+        if temperature > target + 0.5:
+            state = Activity.State.HOT
+        should_heat = controller.should_heat(profile, seconds, temperature, heater_is_on)
+    return target, state, should_heat
 
 
 class Idle(Activity):
@@ -103,15 +110,19 @@ class Hold(Activity):
     # Add time to the current rest so the graph extends into the future a little.
     rest_additional_minutes = 10
 
-    def __init__(self, logger, profile, temperature_logger, graph_writer):
+    def __init__(self, logger, profile, temperature_logger, graph_writer, controller = None):
         """
         logger: a Logger in case we need to report errors
         profile: the Profile to run
         temperature_logger: the TemperatureLogger that is logging temperature for this profile
         graph_writer: the GraphWriter that is creating the graph for this profile
+        controller: what decides when to heat (see control.py), or None for the default
         """
         super().__init__(logger)
+        if controller is not None:
+            self.controller = controller
         self.seconds = 0
+        self.minutes = 0
         self.temperature_log = temperature_logger
         self.profile = profile
         self.graph = graph_writer
@@ -122,9 +133,16 @@ class Hold(Activity):
     def tick(self):
         self.seconds = self.profile.seconds()
         send_message("time " + str(self.seconds))
-        if self.seconds % 60 is 0:
+        # seconds isn't a whole number, so look for the minute changing
+        minutes = int(self.seconds // 60)
+        if minutes != self.minutes:
+            self.minutes = minutes
             self.profile.update_rest()
 
+    def finish(self):
+        self.profile.flush()
+        super().finish()
+
     def change_set_point(self, temperature):
         self.profile.change_set_point(temperature)
         self.send_updated_graph()
@@ -136,14 +154,17 @@ class Hold(Activity):
 class Preset(Activity):
     """ An Activity that runs a preset temperature Profile. """
 
-    def __init__(self, logger, profile, temperature_logger, graph_writer):
+    def __init__(self, logger, profile, temperature_logger, graph_writer, controller = None):
         """
         logger: a Logger in case we need to report errors
         profile: the Profile to run
         temperature_logger: the TemperatureLogger that is logging temperature for this profile
         graph_writer: the GraphWriter that is creating the graph for this profile
+        controller: what decides when to heat (see control.py), or None for the default
         """
         super().__init__(logger)
+        if controller is not None:
+            self.controller = controller
         self.seconds = 0
         self.temperature_log = temperature_logger
         self.profile = profile
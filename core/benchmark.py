@@ -0,0 +1,339 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+Benchmarks for the core's hot paths.
+
+Runs anywhere: GPIO is stubbed and the temperature sensors are a fake
+1-wire tree (see fake_hardware), and everything is written to a
+temporary installation folder.
+
+    python3 benchmark.py [--output results.json] [--quick]
+
+Results are written as JSON, with the time per call in microseconds for
+each benchmark, so they can be compared between versions.
+Benchmarks that need something that isn't installed (e.g. gnuplot) are
+listed as skipped.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+
+from fake_hardware import install_stub_gpio, FakeOneWireBus
+install_stub_gpio()
+
+import stats
+import utils
+from profile import Profile, ProfileCache
+from logger import Logger, TemperatureLogger
+from graph_writer import GraphWriter
+from plot_feed import PlotFeed
+from raster_graph import RasterGraphWriter
+from sample_history import SampleHistory
+from temperature_reader import TemperatureReader
+from watchdog import Watchdog
+
+
+repository_folder = str(Path(__file__).resolve().parent.parent) + "/"
+
+sensor_ids = ["28-000001", "28-000002", "28-000003", "28-000004"]
+
+
+class NullLogger:
+    def log(self, text):
+        pass
+
+    def error(self, text):
+        pass
+
+
+class Benchmarks:
+    """
+    Time each benchmark by calling it 'repeat' times, in 'rounds'.
+    The result for each round is the mean time per call.
+    """
+    def __init__(self, folder, quick):
+        self.folder = folder
+        self.rounds = 3 if quick else 7
+        self.scale = 0.1 if quick else 1
+        self.results = {}
+        self.skipped = {}
+
+    def time(self, name, function, repeat):
+        repeat = max(1, int(repeat * self.scale))
+        per_call = []
+        for r in range(self.rounds):
+            start = time.perf_counter()
+            for i in range(repeat):
+                function()
+            per_call.append((time.perf_counter() - start) / repeat * 1e6)
+        self.results[name] = {
+            "calls_per_round": repeat,
+            "rounds": self.rounds,
+            "min_us": min(per_call),
+            "median_us": statistics.median(per_call),
+            "mean_us": statistics.fmean(per_call),
+            "max_us": max(per_call),
+        }
+        sys.stderr.write("{0:40} {1:12.2f} us\n".format(name, self.results[name]["median_us"]))
+
+    def skip(self, name, reason):
+        self.skipped[name] = reason
+        sys.stderr.write("{0:40} skipped: {1}\n".format(name, reason))
+
+    def path(self, name):
+        return self.folder + name
+
+
+def long_hold_profile(path, set_point_changes):
+    """ A 12 hour hold, with set point changes spread evenly through it."""
+    profile = Profile(path + "profile.json", path + "profile.dat", NullLogger())
+    profile.create_hold_profile(66, 10)
+    interval = 12 * 60 / (set_point_changes + 1)
+    for i in range(set_point_changes):
+        profile.last_change -= timedelta(minutes = interval)
+        profile.change_set_point(60 + (i % 10))
+    profile.update_rest()
+    return profile
+
+
+def benchmark_profile(b):
+    for changes in [10, 300]:
+        profile = long_hold_profile(b.path(""), changes)
+        times = [random.uniform(0, 12 * 3600) for i in range(1000)]
+        b.time("profile.temperature_at[1000 times, " + str(changes) + " changes]", lambda: [profile.temperature_at(t) for t in times], 20)
+        ordered = sorted(times)
+        b.time("profile.temperatures_at[1000 times, " + str(changes) + " changes]", lambda: profile.temperatures_at(ordered), 20)
+        b.time("profile.write_plot[" + str(changes) + " changes]", profile.write_plot, 20)
+        b.time("profile.update_rest[" + str(changes) + " changes]", profile.update_rest, 50)
+        b.time("profile.change_set_point[" + str(changes) + " changes]", lambda: profile.change_set_point(65), 5)
+
+
+def benchmark_profile_list(b):
+    profiles_folder = b.path("profiles/")
+    Path(profiles_folder).mkdir()
+    for i in range(50):
+        steps = [{"start": 40}, {"rest": 20}, {"ramp": 10, "to": 66}, {"rest": 60}, {"mashout": 76}]
+        with open(profiles_folder + "profile" + str(i) + ".json", "w") as f:
+            json.dump({"name": "Profile " + str(i), "description": "Benchmark profile", "steps": steps}, f)
+    b.time("profile_cache.get_list[50 cold]", lambda: ProfileCache(NullLogger()).get_list(profiles_folder), 20)
+    cache = ProfileCache(NullLogger())
+    b.time("profile_cache.get_list[50 cached]", lambda: cache.get_list(profiles_folder), 200)
+
+
+def benchmark_logger(b):
+    unbuffered = Logger(b.path("logs/unbuffered"))
+    b.time("logger.log[unbuffered]", lambda: unbuffered.log_values([66.25, 1, 1]), 5000)
+    buffered = Logger(b.path("logs/buffered"), buffered = True)
+    b.time("logger.log[buffered]", lambda: buffered.log_values([66.25, 1, 1]), 5000)
+    temperatures = TemperatureLogger(b.path("logs/"), sensor_ids, buffered = True)
+    b.time("temperature_logger.log_temperatures", lambda: temperatures.log_temperatures([66.0, 66.5, 65.75, 66.25], 66.125), 5000)
+
+
+def benchmark_graph_writer(b):
+    if shutil.which("gnuplot") is None:
+        b.skip("graph_writer.write[12 hours]", "gnuplot is not installed")
+        b.skip("graph_writer.write[12 hours, plot feed]", "gnuplot is not installed")
+        return
+    run_folder = b.path("graph/")
+    Path(run_folder).mkdir()
+    profile = long_hold_profile(run_folder, 300)
+    temperatures = TemperatureLogger(run_folder, sensor_ids)
+    state = Logger(run_folder + "state", initial_log = "Time, Target, Heater, Pump")
+    for i in range(12 * 360):
+        temperatures.log_temperatures([66.0, 66.5, 65.75, 66.25], 66.125)
+        state.log_values([66.0, i % 2, 1])
+    writer = GraphWriter(NullLogger(), run_folder + "graph.png", repository_folder + "target/graph.plt",
+                         temperatures.path, profile.graph_data_path(), state.path, profile.start_time)
+    b.time("graph_writer.write[12 hours]", writer.write, 10)
+    writer.close()
+    feed = PlotFeed(run_folder)
+    for i in range(12 * 360):
+        feed.add(i * 10, 66.125, 66.0, i % 2, 1)
+    feed.write()
+    writer = GraphWriter(NullLogger(), run_folder + "graph.png", repository_folder + "target/graph.plt",
+                         feed.temperature_path, profile.graph_data_path(), feed.state_path, profile.start_time)
+    b.time("graph_writer.write[12 hours, plot feed]", writer.write, 10)
+    writer.close()
+
+
+def benchmark_raster_graph(b):
+    run_folder = b.path("raster/")
+    Path(run_folder).mkdir()
+    profile = long_hold_profile(run_folder, 300)
+    feed = PlotFeed(run_folder)
+    start = profile.start_time.timestamp()
+    for i in range(12 * 360):
+        feed.add(start + i * 10, 66.125, 66.0, i % 2, 1)
+    feed.write()
+    writer = RasterGraphWriter(NullLogger(), run_folder + "graph.png", feed.temperature_path, profile.graph_data_path(), feed.state_path, profile.start_time)
+    writer.write()
+    samples = iter(range(12 * 360, 10 ** 9))
+    def add_and_write():
+        i = next(samples)
+        feed.add(start + i * 10, 66.125 + (i % 7) * 0.1, 66.0, i % 2, 1)
+        feed.write()
+        writer.write()
+    b.time("raster_graph.write[12 hours, plot feed]", add_and_write, 50)
+    def redraw():
+        writer.end_seconds = None
+        writer.write()
+    b.time("raster_graph.write[redraw everything]", redraw, 20)
+
+
+def benchmark_plot_feed(b):
+    folder = b.path("feed/")
+    Path(folder).mkdir()
+    feed = PlotFeed(folder)
+    samples = iter(range(10 ** 9))
+    b.time("plot_feed.add", lambda: feed.add(next(samples) * 10, 66.125, 66.0, True, True), 20000)
+    def add_and_write():
+        feed.add(next(samples) * 10, 66.125, 66.0, True, True)
+        feed.write()
+    b.time("plot_feed.write[320 points]", add_and_write, 200)
+
+
+def benchmark_stats(b):
+    def timed():
+        stats.stop("benchmark", stats.start())
+    stats.enable(False)
+    b.time("stats.start+stop[off]", timed, 20000)
+    stats.enable(True)
+    b.time("stats.start+stop[on]", timed, 20000)
+    stats.enable(False)
+    stats.reset()
+
+
+def benchmark_watchdog(b):
+    """
+    How long from the last kick until the heater is off, for a short deadline.
+    The time beyond the deadline is the watchdog's latency. Each round is one
+    trip, so max_us is the worst case seen. With a busy thread, the watchdog
+    has to get the GIL from something that never gives it up willingly,
+    like a loop of exceptions.
+    """
+    from gpiozero import LED
+    heater = LED(21)
+    deadline = 0.1
+    off = threading.Event()
+    def trip(reason):
+        heater.off()
+        off.set()
+    watchdog = Watchdog(deadline, trip)
+    watchdog.start()
+    def time_to_heater_off():
+        heater.on()
+        off.clear()
+        watchdog.kick()
+        if not off.wait(deadline * 20):
+            raise RuntimeError("The watchdog didn't trip")
+        if heater.is_lit:
+            raise RuntimeError("The watchdog didn't turn the heater off")
+    b.time("watchdog.time_to_heater_off[0.1s deadline]", time_to_heater_off, 10)
+
+    busy = True
+    def exception_storm():
+        while busy:
+            try:
+                raise RuntimeError("busy")
+            except RuntimeError:
+                pass
+    storm = threading.Thread(target=exception_storm, daemon=True)
+    storm.start()
+    b.time("watchdog.time_to_heater_off[0.1s deadline, busy thread]", time_to_heater_off, 10)
+    busy = False
+    storm.join()
+    watchdog.stop()
+
+
+def benchmark_temperature_reader(b, bus):
+    reader = TemperatureReader(b.path("sensor_names.txt"))
+    reader.discover_sensors()
+    b.time("sensor.read[4 sensors]", lambda: [s.read() for s in reader.sensors], 500)
+    b.time("temperature_reader.temperatures", reader.temperatures, 5000)
+    b.time("temperature_reader.snapshots", reader.snapshots, 5000)
+    snapshot = reader.snapshots()[0]
+    b.time("snapshot.statistics[60s]", lambda: (snapshot.mean(60), snapshot.median(60), snapshot.slope(60)), 1000)
+    history = SampleHistory(TemperatureReader.history_size)
+    for i in range(TemperatureReader.history_size):
+        history.add(i, 20.0)
+    b.time("sample_history.add[full]", lambda: history.add(time.monotonic(), 20.0), 5000)
+    b.time("sample_history.add_and_snapshot[full]", lambda: (history.add(time.monotonic(), 20.0), history.snapshot()), 5000)
+
+
+def benchmark_core(b, bus):
+    import core
+    installation = b.path("installation/")
+    Path(installation).mkdir()
+    shutil.copy(repository_folder + "target/graph.plt", installation + "graph.plt")
+    the_core = core.Core(installation)
+    time.sleep(0.1)
+    the_core.hold(66)
+    if shutil.which("gnuplot") is None:
+        # Don't fill the log with complaints about gnuplot
+        the_core.activity.graph.close()
+        the_core.activity.graph = None
+    b.time("core.update_temperatures[hold]", the_core.update_temperatures, 500)
+    b.time("core.decode_message[heartbeat]", lambda: the_core.decode_message("heartbeat"), 2000)
+    the_core.go_to_idle()
+    the_core.close_finished_graphs()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the Mash-o-matiC core")
+    parser.add_argument("--output", help = "write the results to this JSON file, rather than stdout")
+    parser.add_argument("--quick", action = "store_true", help = "fewer, shorter, rounds")
+    arguments = parser.parse_args()
+
+    random.seed(1)
+    folder = tempfile.mkdtemp(prefix = "mash-benchmark-") + "/"
+    with open(os.devnull, "w") as null:
+        # The GUI messages would get in the way of the results.
+        utils.message_writer.output = null
+        bus = FakeOneWireBus(folder + "w1/", sensor_ids)
+        bus.install()
+        b = Benchmarks(folder, arguments.quick)
+        try:
+            benchmark_profile(b)
+            benchmark_profile_list(b)
+            benchmark_logger(b)
+            benchmark_graph_writer(b)
+            benchmark_raster_graph(b)
+            benchmark_plot_feed(b)
+            benchmark_stats(b)
+            benchmark_watchdog(b)
+            benchmark_temperature_reader(b, bus)
+            benchmark_core(b, bus)
+        finally:
+            utils.flush_messages()
+            shutil.rmtree(folder, ignore_errors = True)
+
+    results = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": b.results,
+        "skipped": b.skipped,
+    }
+    text = json.dumps(results, indent = 4)
+    if arguments.output is not None:
+        with open(arguments.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+Clocks
+
+Everything in the core that needs the time gets it from here, rather
+than from datetime or time directly, so that a VirtualClock can be used
+to replay or simulate a run much faster than real time.
+"""
+
+import threading
+import time as system_time
+from datetime import datetime, timedelta
+
+
+class SystemClock:
+    """ The real time."""
+    def now(self):
+        return datetime.now()
+
+    def time(self):
+        return system_time.time()
+
+    def monotonic(self):
+        return system_time.monotonic()
+
+    def sleep(self, seconds):
+        system_time.sleep(seconds)
+
+
+class VirtualClock:
+    """
+    A clock that only moves when it is told to.
+
+    Threads that sleep() are woken when advance() has moved the clock
+    past the time they are waiting for, so a background thread can be
+    driven at whatever speed the caller advances the clock.
+    """
+    def __init__(self, start = None):
+        """ start: the datetime the clock starts at, or now if None."""
+        self.start = datetime.now() if start is None else start
+        self.elapsed = 0.0
+        self.condition = threading.Condition()
+
+    def now(self):
+        return self.start + timedelta(seconds = self.elapsed)
+
+    def time(self):
+        return self.start.timestamp() + self.elapsed
+
+    def monotonic(self):
+        return self.elapsed
+
+    def sleep(self, seconds):
+        with self.condition:
+            wake = self.elapsed + seconds
+            while self.elapsed < wake:
+                self.condition.wait()
+
+    def advance(self, seconds):
+        self.advance_to(self.elapsed + seconds)
+
+    def advance_to(self, monotonic):
+        """ Move the clock forward to the given monotonic() time."""
+        with self.condition:
+            if monotonic > self.elapsed:
+                self.elapsed = monotonic
+                self.condition.notify_all()
+
+
+clock = SystemClock()
+
+
+def set_clock(new_clock):
+    global clock
+    clock = new_clock
+
+
+def now():
+    return clock.now()
+
+
+def time():
+    return clock.time()
+
+
+def monotonic():
+    return clock.monotonic()
+
+
+def sleep(seconds):
+    clock.sleep(seconds)
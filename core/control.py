@@ -0,0 +1,228 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+Heater controllers
+
+A controller decides whether the heater should be on. Each run has its
+own controller, chosen by name when the run starts (see create_controller).
+"""
+
+import math
+
+import clock
+from sample_history import SampleHistory
+
+
+def recent_slope(history, seconds):
+    """ The rate of change over the last seconds of history, in degrees per second, or 0 if we don't know it yet."""
+    slope = history.snapshot().slope(seconds)
+    return 0.0 if math.isnan(slope) else slope / 60
+
+
+class MinimumOffTime:
+    """
+    Controlling for every sample would let noise switch the heater on and
+    off every second, so once a controller turns it off it stays off for
+    at least seconds. It can always go off straight away.
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.off_time = None
+
+    def allow(self, should_heat, heater_is_on):
+        """ Returns whether to heat, given what the controller wants and whether the heater is on now."""
+        now = clock.monotonic()
+        if heater_is_on:
+            if not should_heat:
+                self.off_time = now
+            return should_heat
+        if should_heat and self.off_time is not None and now - self.off_time < self.seconds:
+            return False
+        return should_heat
+
+
+class BangBangController:
+    """ The original rule: heat while the temperature is more than 0.5 degrees below the target."""
+
+    name = "bangbang"
+
+    minimum_off_seconds = 10
+
+    def __init__(self):
+        self.minimum_off = MinimumOffTime(BangBangController.minimum_off_seconds)
+
+    def should_heat(self, profile, seconds, temperature, heater_is_on):
+        """
+        profile: the Profile being run
+        seconds: the time into the profile
+        temperature: the current sensor temperature
+        heater_is_on: whether the heater is already on now
+        """
+        target = profile.temperature_at(seconds)
+        if math.isnan(target):
+            return self.minimum_off.allow(False, heater_is_on)
+        return self.minimum_off.allow(temperature < (target - 0.5), heater_is_on)
+
+
+class PredictiveController:
+    """
+    Heat according to where the temperature is going to be, rather than
+    where it is now.
+
+    The sensors are a long way from the heating coil, so the temperature
+    keeps rising for a while after the heater goes off. We project the
+    temperature lag_seconds ahead from its recent slope, and compare that
+    with the target lag_seconds ahead, so the heater goes off before the
+    target is reached, and comes on before a ramp in the profile starts.
+
+    lag_seconds is learnt as the run goes on: each time the heater goes off
+    while the temperature is rising, we wait for the peak, and the rise
+    after switching off, divided by the slope at the time, is the lag we
+    should have allowed for.
+    """
+
+    name = "predictive"
+
+    slope_window_seconds = 120
+    initial_lag_seconds = 60
+    minimum_lag_seconds = 10
+    maximum_lag_seconds = 600
+    lag_learning_rate = 0.3
+
+    # Don't turn the heater back on until the prediction is this far below the target.
+    band = 0.3
+
+    # The sensors read about 0.6 degrees low (see doc/numbers.md), so aim as
+    # far below the target as the bang-bang rule does.
+    aim_below = 0.5
+
+    history_size = 120
+
+    minimum_off_seconds = BangBangController.minimum_off_seconds
+
+    def __init__(self):
+        self.history = SampleHistory(PredictiveController.history_size)
+        self.minimum_off = MinimumOffTime(PredictiveController.minimum_off_seconds)
+        self.lag_seconds = PredictiveController.initial_lag_seconds
+        self.heating = False
+        # While waiting for the peak after the heater went off:
+        # the temperature and slope when it went off, and the highest temperature since.
+        self.switched_off = None
+        self.peak = None
+
+    def should_heat(self, profile, seconds, temperature, heater_is_on):
+        self.history.add(clock.monotonic(), temperature)
+        slope = self.slope()
+        self.__learn_lag(temperature, slope, heater_is_on)
+
+        target = profile.temperature_at(seconds + self.lag_seconds)
+        if math.isnan(target):
+            target = profile.temperature_at(seconds)
+        if math.isnan(target) or math.isnan(temperature):
+            return self.__decided(False, temperature, slope, heater_is_on)
+
+        target = target - PredictiveController.aim_below
+        predicted = temperature + slope * self.lag_seconds
+        if heater_is_on:
+            return self.__decided(predicted < target, temperature, slope, heater_is_on)
+        return self.__decided(predicted < target - PredictiveController.band, temperature, slope, heater_is_on)
+
+    def slope(self):
+        return recent_slope(self.history, PredictiveController.slope_window_seconds)
+
+    def __decided(self, should_heat, temperature, slope, heater_is_on):
+        should_heat = self.minimum_off.allow(should_heat, heater_is_on)
+        if self.heating and not should_heat and slope > 0:
+            self.switched_off = (temperature, slope)
+            self.peak = temperature
+        self.heating = should_heat
+        return should_heat
+
+    def __learn_lag(self, temperature, slope, heater_is_on):
+        if self.switched_off is None:
+            return
+        if heater_is_on:
+            # Back on before the peak, so we didn't see the whole rise.
+            self.switched_off = None
+            return
+        self.peak = max(self.peak, temperature)
+        if slope <= 0:
+            off_temperature, off_slope = self.switched_off
+            observed = (self.peak - off_temperature) / off_slope
+            observed = min(max(observed, PredictiveController.minimum_lag_seconds), PredictiveController.maximum_lag_seconds)
+            self.lag_seconds = self.lag_seconds + (observed - self.lag_seconds) * PredictiveController.lag_learning_rate
+            self.switched_off = None
+
+
+class TimeProportionalController:
+    """
+    Slow PWM: rather than just on or off, work out what proportion of the
+    time the heater should be on, and turn it on for that part of each
+    pwm_period_seconds. The proportion depends on how far the predicted
+    temperature is below the target, so the heater eases off as the
+    temperature gets close, rather than overshooting at full power.
+
+    The heater can only change when the controller is asked, so this needs
+    the core to control often, which it does for every set of samples.
+    There's no minimum off time, since the heater only changes at most
+    twice each period, and a short off time is part of the duty.
+    """
+
+    name = "proportional"
+
+    pwm_period_seconds = 30
+
+    # How far, in degrees, the prediction has to be below the target for the heater to be on all the time.
+    proportional_band = 2.0
+
+    lag_seconds = 60
+    slope_window_seconds = 120
+    aim_below = PredictiveController.aim_below
+    history_size = 120
+
+    def __init__(self):
+        self.history = SampleHistory(TimeProportionalController.history_size)
+        self.window_start = None
+        self.window_duty = 0.0
+
+    def should_heat(self, profile, seconds, temperature, heater_is_on):
+        now = clock.monotonic()
+        self.history.add(now, temperature)
+        duty = self.duty(profile, seconds, temperature)
+        period = TimeProportionalController.pwm_period_seconds
+        if self.window_start is None or now - self.window_start >= period:
+            self.window_start = now
+            self.window_duty = duty
+        # Don't wait for the end of the window if it's now warm enough.
+        return duty > 0 and now - self.window_start < self.window_duty * period
+
+    def duty(self, profile, seconds, temperature):
+        """ The proportion of the time the heater should be on, 0 to 1."""
+        lag = TimeProportionalController.lag_seconds
+        target = profile.temperature_at(seconds + lag)
+        if math.isnan(target):
+            target = profile.temperature_at(seconds)
+        if math.isnan(target) or math.isnan(temperature):
+            return 0.0
+        predicted = temperature + recent_slope(self.history, TimeProportionalController.slope_window_seconds) * lag
+        error = target - TimeProportionalController.aim_below - predicted
+        return min(max(error / TimeProportionalController.proportional_band, 0.0), 1.0)
+
+
+controllers = {
+    BangBangController.name: BangBangController,
+    PredictiveController.name: PredictiveController,
+    TimeProportionalController.name: TimeProportionalController,
+}
+
+default_controller = BangBangController.name
+
+
+def create_controller(name = None):
+    """ Create the controller called name, or the default controller if name is None. """
+    if name is None:
+        name = default_controller
+    if name not in controllers:
+        raise RuntimeError("Unknown controller: " + name)
+    return controllers[name]()
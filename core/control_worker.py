@@ -0,0 +1,333 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+The control process.
+
+Controlling the heater is the one part of the core that has to be on
+time, so with Core.split_processes it has a small process of its own,
+which shares its GIL with nothing else. It reads the sensors, decides
+whether to heat, switches the heater and pump, and records every set of
+samples in the TelemetryRing, for the core, the log process and the
+graph process to follow. It has the watchdog, and if it loses the core
+it turns everything off.
+
+The core tells it what to control for, one JSON command per line on its
+stdin: a new run's profile and controller, a change to the profile, idle,
+test mode or timing statistics. What it writes to stdout (heat, pump, temp, hot, cold, ok,
+buttons and errors) is for the GUI, and the core passes it on.
+
+    python3 control_worker.py RING_NAME LOG_FOLDER SENSOR_NAMES_FILE [--cpus 3] [--priority 50] [--resolution 10] [--watchdog 15] [--status]
+
+It pins itself to its CPUs before anything starts a thread, and only then
+claims the GPIO pins (see gpio.py).
+
+ControlProcess is the core's side of it.
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import threading
+from datetime import datetime
+
+import clock
+import gpio
+import stats
+from activity import Activity, average, determine_state
+from control import create_controller
+from gpio import heater, pump, turn_heater_on, turn_heater_off, turn_pump_on, all_off, enter_test_mode, leave_test_mode, send_temperature_debug
+from logger import Logger
+from profile import Profile
+from scheduling import pin_to_cpus, use_real_time_priority, parse_cpus
+from telemetry import TelemetryRing
+from temperature_reader import TemperatureReader
+from utils import send_message, message_batch, flush_messages, ErrorReporter
+from watchdog import Watchdog
+from worker_process import WorkerProcess, answer_stats
+
+
+class ControlWorker:
+    """
+    The control process's side: control the heater for the current run,
+    for every new set of samples, in the same way as Core.control().
+    Between runs, and in test mode, the heater is left off.
+    """
+
+    def __init__(self, ring, logger, temperature_reader, watchdog_seconds = None, timeout_seconds = 5, send_status = True, real_time_priority = None):
+        """
+        ring: the TelemetryRing to record the samples and state in
+        logger: a Logger
+        temperature_reader: a TemperatureReader, which start() starts
+        watchdog_seconds: see Core.watchdog_seconds
+        timeout_seconds: control anyway if there have been no new samples for this long
+        send_status: send the temperature to the GUI for every set of samples
+        real_time_priority: see Core.control_real_time_priority
+        """
+        self.ring = ring
+        self.logger = logger
+        self.temperature_reader = temperature_reader
+        self.watchdog_seconds = watchdog_seconds
+        self.timeout_seconds = timeout_seconds
+        self.send_status = send_status
+        self.real_time_priority = real_time_priority
+        self.lock = threading.RLock()
+        self.errors = ErrorReporter(logger)
+        self.run = None
+        self.profile = None
+        self.controller = None
+        self.controlling = False
+        self.thread = None
+        self.watchdog = None
+
+    def start(self):
+        """ Turn everything off, then start reading the sensors and controlling."""
+        all_off()
+        try:
+            self.temperature_reader.start()
+        except RuntimeError as rt:
+            self.error("{0}".format(rt))
+        self.controlling = True
+        self.thread = threading.Thread(target=ControlWorker.__thread_function, daemon=True, args=(self,))
+        self.thread.start()
+        if self.watchdog_seconds is not None:
+            self.watchdog = Watchdog(self.watchdog_seconds, self.watchdog_tripped, self.temperature_reader.sample_age, TemperatureReader.stale_sample_seconds)
+            self.watchdog.start()
+
+    def stop(self):
+        """ Stop controlling, and leave everything off."""
+        with self.lock:
+            self.controlling = False
+            all_off()
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        self.temperature_reader.stop()
+
+    def handle(self, command):
+        name = command.get("command")
+        with self.lock, message_batch():
+            if name == "run":
+                leave_test_mode()
+                self.controller = create_controller(command.get("controller"))
+                self.profile = ControlWorker.profile(command, self.logger)
+                self.run = command["run"]
+                self.logger.log("Run " + str(self.run) + ": " + command.get("path", "") + ", " + self.controller.name)
+                turn_pump_on()
+                # Straight away, unless the sensors haven't been read yet (e.g. we've just been restarted).
+                if self.temperature_reader.wait_for_samples(None) > 0:
+                    self.guarded_control()
+            elif name == "profile":
+                if command.get("run") == self.run:
+                    self.profile = ControlWorker.profile(command, self.logger)
+            elif name == "idle":
+                self.idle()
+                leave_test_mode()
+            elif name == "testmode":
+                self.idle()
+                enter_test_mode()
+            elif name == "stats":
+                answer_stats(command, send_message)
+            else:
+                self.logger.error("ControlWorker: unknown command " + str(name))
+
+    @staticmethod
+    def profile(command, logger):
+        """ The run's Profile, from a 'run' or 'profile' command."""
+        profile = Profile(command.get("path", ""), None, logger, command["profile"])
+        profile.start_time = datetime.fromisoformat(command["start_time"])
+        return profile
+
+    def idle(self):
+        self.run = None
+        self.profile = None
+        self.controller = None
+        all_off()
+
+    def guarded_control(self):
+        """ control(), with errors reported rather than stopping the control thread."""
+        with self.lock, message_batch():
+            if not self.controlling:
+                return
+            started = stats.start()
+            try:
+                self.control()
+            except RuntimeError as rt:
+                self.errors.report("{0}".format(rt))
+            stats.stop("control_process.control", started)
+
+    def control(self):
+        """ Decide whether to heat, from the latest temperatures."""
+        temperatures = self.temperature_reader.temperatures()
+        average_temperature = average(temperatures) if len(temperatures) > 0 else math.nan
+        if self.profile is None:
+            target, state, should_heat = average_temperature, Activity.State.OK, False
+        else:
+            target, state, should_heat = determine_state(self.profile, self.controller, average_temperature, self.profile.seconds(), heater().is_lit)
+        if self.send_status and len(temperatures) > 0:
+            send_message("temp " + str(average_temperature))
+
+        if gpio.test_mode:
+            # The buttons drive the heater and pump.
+            send_temperature_debug(self.temperature_reader)
+        else:
+            if state == Activity.State.HOT:
+                send_message("hot")
+            if state == Activity.State.COLD:
+                send_message("cold")
+            if state == Activity.State.OK:
+                send_message("ok")
+
+            # The controller stops the heater chattering, if it needs to (see control.py).
+            if should_heat and not heater().is_lit:
+                turn_pump_on()
+                turn_heater_on()
+            else:
+                if heater().is_lit and not should_heat:
+                    turn_heater_off()
+
+        if self.watchdog is not None:
+            self.watchdog.kick()
+        self.ring.append(clock.time(), average_temperature, target, heater().is_lit, pump().is_lit, temperatures)
+
+    def watchdog_tripped(self, reason):
+        """ Called from the watchdog's thread, so it mustn't wait for the lock."""
+        all_off()
+        self.error("Watchdog: " + reason + ", so everything is off")
+
+    def error(self, message):
+        self.logger.error(message)
+        send_message("error \"" + message + "\"")
+
+    def __thread_function(self):
+        if self.real_time_priority is not None:
+            use_real_time_priority(self.real_time_priority, self.logger)
+        # Not until the sensors have been read for the first time.
+        cycle = 0
+        while self.controlling:
+            cycle = self.temperature_reader.wait_for_samples(cycle, self.timeout_seconds)
+            self.guarded_control()
+
+
+class ControlProcess(WorkerProcess):
+    """
+    The core's side of the control process.
+
+    It is started straight away, which turns everything off, and the core
+    calls keep_running() every second, so if it stops it is soon replaced,
+    and the new one is told about the current run again. What it writes
+    to stdout is passed on to the GUI.
+    """
+
+    worker_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "control_worker.py")
+
+    # Long enough for the sensors' current read to finish, so the heater and pump are off before we give up waiting.
+    close_timeout_seconds = 5
+
+    def __init__(self, logger, event_loop, ring, log_folder, sensor_names_file, cpus = None, real_time_priority = None,
+                 resolution = None, watchdog_seconds = None, timeout_seconds = 5, send_status = True):
+        """
+        logger: a Logger in case we need to report errors
+        event_loop: the EventLoop that reads the process's output
+        ring: the TelemetryRing the process records the run in
+        log_folder: where the process should write its log
+        sensor_names_file: see TemperatureReader
+        The rest are the ControlWorker's settings, and the CPUs it should run on, or None for any.
+        """
+        arguments = [ring.name, log_folder, sensor_names_file, "--timeout", str(timeout_seconds)]
+        if cpus is not None:
+            arguments = arguments + ["--cpus", ",".join(str(c) for c in sorted(cpus))]
+        if real_time_priority is not None:
+            arguments = arguments + ["--priority", str(real_time_priority)]
+        if resolution is not None:
+            arguments = arguments + ["--resolution", str(resolution)]
+        if watchdog_seconds is not None:
+            arguments = arguments + ["--watchdog", str(watchdog_seconds)]
+        if send_status:
+            arguments = arguments + ["--status"]
+        super().__init__("control process", ControlProcess.worker_path, arguments, logger, event_loop)
+        self.current_run = None
+        self.test_mode = False
+        self.runs = 0
+
+    def start_run(self, profile, controller_name):
+        """ Control for profile, a Profile, with the controller called controller_name. The pump goes on."""
+        self.runs = self.runs + 1
+        self.current_run = {"command": "run", "run": self.runs, "controller": controller_name}
+        self.current_run.update(ControlProcess.__profile_fields(profile))
+        self.test_mode = False
+        self.send(self.current_run)
+
+    def change_profile(self, profile):
+        """ The current run's profile has changed, e.g. its set point."""
+        if self.current_run is not None:
+            self.current_run.update(ControlProcess.__profile_fields(profile))
+            command = {"command": "profile", "run": self.runs}
+            command.update(ControlProcess.__profile_fields(profile))
+            self.send(command)
+
+    def idle(self):
+        """ Turn everything off, and stop controlling."""
+        self.current_run = None
+        self.test_mode = False
+        self.send({"command": "idle"})
+
+    def enter_test_mode(self):
+        """ Turn everything off, and let the buttons drive the heater and pump (see gpio.py)."""
+        self.current_run = None
+        self.test_mode = True
+        self.send({"command": "testmode"})
+
+    def missed(self):
+        if self.current_run is not None:
+            return [self.current_run]
+        if self.test_mode:
+            return [{"command": "testmode"}]
+        return []
+
+    def stopped(self):
+        super().stopped()
+        send_message("error \"The control process stopped\"")
+
+    @staticmethod
+    def __profile_fields(profile):
+        return {"path": profile.file_path, "profile": profile.profile, "start_time": profile.start_time.isoformat()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Control the Mash-o-matiC heater in its own process")
+    parser.add_argument("ring", help = "the name of the core's TelemetryRing")
+    parser.add_argument("log_folder")
+    parser.add_argument("sensor_names_file")
+    parser.add_argument("--cpus", help = "the CPUs to run on, e.g. 3")
+    parser.add_argument("--priority", type = int, help = "the control thread's real-time priority, 1 to 99")
+    parser.add_argument("--resolution", type = int, help = "the sensors' resolution in bits, 9 to 12")
+    parser.add_argument("--watchdog", type = float, help = "turn everything off if the heater hasn't been controlled for this many seconds")
+    parser.add_argument("--timeout", type = float, default = 5, help = "control anyway if there have been no new samples for this many seconds")
+    parser.add_argument("--status", action = "store_true", help = "send the temperature for every set of samples")
+    arguments = parser.parse_args()
+
+    logger = Logger(arguments.log_folder + "control", initial_log = "Mash-o-matiC control process")
+    if arguments.cpus is not None:
+        # Before any threads start, including gpiozero's and the sensors', so they all stay on these CPUs.
+        pin_to_cpus(parse_cpus(arguments.cpus), logger)
+    ring = TelemetryRing.attach(arguments.ring)
+    reader = TemperatureReader(arguments.sensor_names_file, concurrent = True, bulk_read = True, resolution = arguments.resolution)
+    worker = ControlWorker(ring, logger, reader, arguments.watchdog, arguments.timeout, arguments.status, arguments.priority)
+    worker.start()
+    try:
+        for line in sys.stdin:
+            try:
+                worker.handle(json.loads(line))
+            except (ValueError, KeyError, RuntimeError) as e:
+                logger.error("ControlWorker: " + repr(e) + " handling " + line.strip())
+    finally:
+        # The core has finished with us, or gone, so leave everything off.
+        worker.stop()
+        flush_messages()
+        ring.close()
+
+
+if __name__ == "__main__":
+    main()
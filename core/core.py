@@ -10,8 +10,6 @@
 # because the temperature log will keep growing, and the graph will be
 # updated every 10s?
 
-# Send temperature to GUI as fast as possible, but only log every 10s ?
-
 
 """
 Mash-o-matiC Core.
@@ -24,20 +22,36 @@ This code is what needs to run in order that the thing actually works.
 The C++ GUI is just the human interface to this.
 """
 
+import math
 import sys
-import select
-from gpiozero import Button, LED
-from time import sleep
+import threading
 from pathlib import Path
 from shutil import copyfile
 from datetime import datetime
 
-from profile import Profile
+import clock
+import gpio
+import stats
+from gpio import heater, pump, turn_heater_on, turn_heater_off, turn_pump_on, all_off, enter_test_mode, leave_test_mode, send_temperature_debug
+from profile import Profile, ProfileCache
 from temperature_reader import TemperatureReader
-from graph_writer import GraphWriter
-from activity import Idle, Hold, Preset, Activity
+from graph_writer import GraphWriter, BackgroundGraphWriter, GraphHandOff
+from raster_graph import RasterGraphWriter
+from render_worker import RenderProcess
+from control_worker import ControlProcess
+from log_worker import LogProcess
+from scheduling import pin_to_cpus, use_real_time_priority
+from telemetry import TelemetryRing
+from activity import Idle, Hold, Preset, Activity, average
+from control import create_controller
+from watchdog import Watchdog
 from logger import Logger, TemperatureLogger
-from utils import send_message, datetime_now_string
+from run_log import RunLogWriter
+from run_catalogue import RunCatalogue
+from utils import send_message, message_batch, flush_messages, datetime_now_string, ErrorReporter
+from event_loop import EventLoop, LineReader
+from window_statistics import WindowStatistics
+from plot_feed import PlotFeed
 
 
 # Utility functions
@@ -58,127 +72,390 @@ def sanitized_stem(profile_path):
     return stem.replace(" ", "-")
 
 
-# GPIO
-
-button1 = Button(17)
-button2 = Button(22)
-button3 = Button(23)
-button4 = Button(27)
-
-heater = LED(21)
-pump = LED(20)
-
-def send_down(button):
-    return lambda : send_message("button "+str(button)+" down")
-
-def send_up(button):
-    return lambda : send_message("button "+str(button)+" up")
-
-button1.when_pressed = send_down(1)
-button1.when_released = send_up(1)
-button2.when_pressed = send_down(2)
-button2.when_released = send_up(2)
-button3.when_pressed = send_down(3)
-button3.when_released = send_up(3)
-button4.when_pressed = send_down(4)
-button4.when_released = send_up(4)
-
-def turn_heater_on():
-    heater.on()
-    send_message("heat on")
-
-def turn_heater_off():
-    heater.off()
-    send_message("heat off")
-
-def turn_pump_on():
-    pump.on()
-    send_message("pump on")
-
-def turn_pump_off():
-    pump.off()
-    send_message("pump off")
-
-def all_off():
-    heater.off()
-    pump.off()
-    send_message("heat off")
-    send_message("pump off")
-
-
-# Test mode
-
-test_mode = False
-
-def enter_test_mode():
-    global test_mode
-    if not test_mode:
-        test_mode = True
-        button2.when_pressed = turn_pump_on
-        button2.when_released = turn_pump_off
-        button3.when_pressed = turn_heater_on
-        button3.when_released = turn_heater_off
-
-def leave_test_mode():
-    global test_mode
-    if test_mode:
-        test_mode = False
-        button2.when_pressed = send_down(2)
-        button2.when_released = send_up(2)
-        button3.when_pressed = send_down(3)
-        button3.when_released = send_up(3)
-
-def send_temperature_debug(temperature_reader):
-    names = temperature_reader.sensor_names()
-    values = temperature_reader.temperatures()
-    lines = []
-    for n, v in zip(names, values):
-        lines.append("{0:16} {1:.2f}".format(n, v))
-    message = "testshow \"" + "<br>".join(lines) + "\""
-    send_message(message)
+class Core:
+    """
+    The core application.
 
+    Owns the current Activity, decodes messages from the GUI, and does
+    the periodic actions, all driven by an EventLoop.
 
-def main():
-
-    # should all this be in a big "application" class?
-    # then we wouldn't need all these "nonlocal" in the functions.
-
-    installation_path    = "/opt/mash-o-matic/"
-    log_folder           = installation_path + "logs/"
-    profiles_folder      = installation_path + "profiles/"
-    gnuplot_command_file = installation_path + "graph.plt"
-    sensor_names_file    = installation_path + "sensor_names.txt"
-
-    all_off()
-
-    if not Path(gnuplot_command_file).is_file():
-        sys.stderr.write("gnuplot file missing: " + gnuplot_command_file + "\n")
-        sys.exit()
-
-    logger = Logger(log_folder + "core", initial_log = "Mash-o-matiC", log_creation_to_stderr = True)
-    state_logger = None
-
-    temperature_reader = TemperatureReader(sensor_names_file)
-    try:
-        temperature_reader.start()
-    except RuntimeError as rt:
-        message = "error \"{0}\"".format(rt)
-        logger.error(message)
-        send_message(message)
-
-    activity = Idle(logger)
-
-    heard_from_gui = False
-    keep_looping = True
-
-    def send_splash():
-        send_message("image " + installation_path + "splash.png")
-
-    def update_temperatures():
-        nonlocal temperature_reader, activity
-        temperatures = temperature_reader.temperatures()
-        average = activity.set_temperatures(temperatures)
-        target, state, should_heat = activity.state(average, heater.is_lit)
+    The heater is controlled from its own thread, which runs whenever the
+    TemperatureReader has a new set of samples, so it doesn't wait for the
+    logging or the graph. Logging, the graph and the temperature shown on
+    the GUI each have their own period. The lock is held by the control
+    thread, and by the event loop's actions, so the Activity can't change
+    underneath either of them.
+
+    With split_processes the heater is controlled by a process of its own
+    instead (see control_worker.py), and the logs are written by another
+    (see log_worker.py). The core then just runs the Activity and talks to
+    the GUI, and passes on what the other processes have to tell it.
+    """
+
+    one_second_period = 1
+
+    # How often, in seconds, to log the temperatures, and redraw the graph.
+    # Each log line summarises the samples since the last one.
+    log_period = 10
+    graph_period = 10
+
+    # How often to send the temperature to the GUI, or None for every set of samples.
+    status_period = None
+
+    # Also log every set of samples, to raw_temperature_*.log in the run folder.
+    raw_temperature_log = False
+
+    # How often to control the heater when there is no control thread (e.g. for replay).
+    control_period = 1
+
+    # Control anyway if there have been no new samples for this long, so sensor failures are noticed.
+    control_timeout_seconds = 5
+
+    # Write a binary run log (run.bin) alongside the CSV logs.
+    binary_run_log = True
+
+    # Add the Minimum and Maximum of the average over each logging window to the temperature log,
+    # after the sensors. They are always in run.bin. See doc/run_files.md.
+    temperature_log_window_columns = False
+
+    # How to draw the graph: "gnuplot", with graph.plt, or "raster", which draws it in process (see raster_graph.py).
+    graph_renderer = "gnuplot"
+
+    # Where to draw the graph and hand it to the GUI, e.g. "/dev/shm/mash-o-matic/" to keep it
+    # off the SD card, or None for the run folder. The last graph is always kept in the run folder.
+    graph_hand_off_folder = None
+
+    # Draw the graph in a process of its own, which follows the run through a TelemetryRing,
+    # so it can't hold up the control thread (see render_worker.py).
+    graph_process = False
+
+    # Read the sensors and control the heater and pump in a small process of their own, which
+    # records the run in a TelemetryRing, and write the logs and draw the graph in two more
+    # processes, which follow it (see control_worker.py, log_worker.py and render_worker.py).
+    split_processes = False
+
+    # The CPUs for whatever does the control, sensors and GPIO (the core, or the control process),
+    # and for the other processes, e.g. {3} and {0, 1, 2}, or None to let the OS decide.
+    control_cpus = None
+    worker_cpus = None
+
+    # Run the control thread with this SCHED_FIFO priority (1 to 99), or None for normal scheduling.
+    # This needs root, or CAP_SYS_NICE.
+    control_real_time_priority = None
+
+    # The temperature sensors' resolution in bits, 9 to 12, or None to leave them as they are.
+    # Each bit less halves the conversion time, and doubles the step between readings (1/16 degree at 12 bits).
+    sensor_resolution = None
+
+    # Turn everything off if the heater hasn't been controlled for this long, or None for no watchdog.
+    # The temperatures mustn't be older than TemperatureReader.stale_sample_seconds either.
+    watchdog_seconds = 15
+
+    # Collect timing statistics from the start, rather than waiting for 'stats on' (see stats.py).
+    timing_statistics = False
+
+    # When a run finishes, write the timing statistics to stats.json in its folder, if they are being collected.
+    timing_statistics_in_run_folder = True
+
+    # How long to wait for the worker processes' timing statistics, before answering 'stats' without them.
+    worker_stats_timeout_seconds = 2
+
+    def __init__(self, installation_path, temperature_reader = None):
+        """
+        installation_path: the folder with graph.plt, profiles/ etc., where logs and runs are written
+        temperature_reader: what to get temperatures from, instead of the sensors (e.g. for replay)
+        """
+        self.installation_path    = installation_path
+        self.log_folder           = installation_path + "logs/"
+        self.profiles_folder      = installation_path + "profiles/"
+        self.gnuplot_command_file = installation_path + "graph.plt"
+        self.sensor_names_file    = installation_path + "sensor_names.txt"
+        self.runs_folder          = installation_path + "runs/"
+
+        if Core.graph_renderer == "gnuplot" and not Path(self.gnuplot_command_file).is_file():
+            sys.stderr.write("gnuplot file missing: " + self.gnuplot_command_file + "\n")
+            sys.exit()
+
+        self.logger = Logger(self.log_folder + "core", initial_log = "Mash-o-matiC", log_creation_to_stderr = True)
+        if Core.timing_statistics:
+            stats.enable()
+        cpus = Core.worker_cpus if Core.split_processes else Core.control_cpus
+        if cpus is not None:
+            # Before any threads start, including gpiozero's, so they all stay on these CPUs.
+            pin_to_cpus(cpus, self.logger)
+        self.event_loop = EventLoop()
+        self.telemetry = None
+        self.control_process = None
+        self.log_process = None
+        self.render_process = None
+        if Core.split_processes:
+            self.telemetry = TelemetryRing.create()
+            self.control_process = ControlProcess(self.logger, self.event_loop, self.telemetry, self.log_folder, self.sensor_names_file,
+                                                  Core.control_cpus, Core.control_real_time_priority, Core.sensor_resolution,
+                                                  Core.watchdog_seconds, Core.control_timeout_seconds, Core.status_period is None)
+            # Which turns everything off.
+            self.control_process.keep_running()
+        else:
+            # The first use of the GPIO, so this is where gpiozero starts.
+            all_off()
+        self.state_logger = None
+        self.run_log = None
+        self.run_folder = None
+        self.catalogue = RunCatalogue(self.runs_folder + "catalogue.sqlite", self.runs_folder, self.logger)
+        self.profile_cache = ProfileCache(self.logger)
+
+        if temperature_reader is not None:
+            self.temperature_reader = temperature_reader
+        elif self.control_process is not None:
+            # Only for the sensors' names. The control process reads them, and reports any problem.
+            self.temperature_reader = TemperatureReader(self.sensor_names_file)
+            try:
+                self.temperature_reader.discover_sensors()
+            except RuntimeError as rt:
+                self.logger.error("{0}".format(rt))
+        else:
+            self.temperature_reader = TemperatureReader(self.sensor_names_file, concurrent = True, bulk_read = True, resolution = Core.sensor_resolution)
+            try:
+                self.temperature_reader.start()
+            except RuntimeError as rt:
+                message = "error \"{0}\"".format(rt)
+                self.logger.error(message)
+                send_message(message)
+
+        self.activity = Idle(self.logger)
+        # The graphs of finished activities, for close_finished_graphs().
+        self.finished_graphs = []
+        self.lock = threading.RLock()
+        self.errors = ErrorReporter(self.logger)
+        self.control_thread = None
+        self.controlling = False
+        self.temperatures = []
+        self.average_temperature = math.nan
+        self.target = math.nan
+        self.watchdog = None
+        self.window = WindowStatistics()
+        self.raw_log = None
+        self.plot_feed = None
+
+        self.heard_from_gui = False
+        self.next_record = 0
+
+        if Core.split_processes:
+            self.log_process = LogProcess(self.logger, self.event_loop, self.telemetry, self.log_folder, Core.log_period, self.catalogue.add, Core.worker_cpus)
+        if Core.graph_process or Core.split_processes:
+            if self.telemetry is None:
+                self.telemetry = TelemetryRing.create()
+            self.render_process = RenderProcess(self.logger, self.event_loop, self.telemetry, self.log_folder, Core.worker_cpus)
+        # The 'stats' message being answered, once the workers have sent their statistics: (option, workers, deadline).
+        self.stats_request = None
+        for worker in self.workers():
+            worker.stats_reported = self.guarded(self.check_stats_request)
+
+        # Message dispatch table.
+        # Each handler is given the whole message, and the message split into words.
+        self.commands = {
+            "bye":       self.on_bye,
+            "heartbeat": self.on_heartbeat,
+            "idle":      self.on_idle,
+            "hold":      self.on_hold,
+            "preset":    self.on_preset,
+            "list":      self.on_list,
+            "allstop":   self.on_allstop,
+            "testmode":  self.on_testmode,
+            "runs":      self.on_runs,
+            "stats":     self.on_stats,
+        }
+
+    def run(self):
+        stdin = LineReader(sys.stdin.fileno(), self.decode_message, self.lost_gui)
+        self.event_loop.add_reader(sys.stdin, stdin.read)
+        if self.control_process is None:
+            self.start_control_thread()
+            self.start_watchdog()
+        self.start_timers()
+        try:
+            self.event_loop.run()
+        finally:
+            self.shut_down()
+
+    def shut_down(self):
+        """ Stop controlling, and finish the run, so everything it wrote is up to date and on the disk."""
+        self.controlling = False
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        with self.lock:
+            # Finishing the activity writes anything it has held back, e.g. a hold's profile.
+            self.change_activity(Idle(self.logger))
+        self.close_finished_graphs()
+        self.checkpoint_logs()
+        self.close_run_logs()
+        self.close_workers()
+
+    def workers(self):
+        """ The worker processes, which keep their own timing statistics."""
+        return [w for w in [self.control_process, self.log_process, self.render_process] if w is not None]
+
+    def close_workers(self):
+        # The control process first, so everything is turned off.
+        if self.control_process is not None:
+            self.control_process.close()
+        if self.log_process is not None:
+            self.log_process.close()
+        if self.render_process is not None:
+            self.render_process.close()
+        if self.telemetry is not None:
+            self.telemetry.close()
+            self.telemetry = None
+
+    def start_timers(self, control_timer = False):
+        """ control_timer: control the heater from a timer, rather than the control thread."""
+        if control_timer:
+            self.event_loop.call_every(Core.control_period, self.guarded(self.control))
+        self.event_loop.call_every(Core.one_second_period, self.guarded(self.do_one_second_actions))
+        if Core.status_period is not None:
+            self.event_loop.call_every(Core.status_period, self.guarded(self.send_status))
+        if self.log_process is None:
+            self.event_loop.call_every(Core.log_period, self.guarded(self.log_temperatures))
+        self.event_loop.call_every(Core.graph_period, self.guarded(self.update_graph))
+
+    def start_control_thread(self):
+        self.controlling = True
+        self.control_thread = threading.Thread(target=Core.__control_thread_function, daemon=True, args=(self,))
+        self.control_thread.start()
+
+    def start_watchdog(self):
+        if Core.watchdog_seconds is not None:
+            self.watchdog = Watchdog(Core.watchdog_seconds, self.watchdog_tripped, self.temperature_reader.sample_age, TemperatureReader.stale_sample_seconds)
+            self.watchdog.start()
+
+    def watchdog_tripped(self, reason):
+        """ Called from the watchdog's thread, so it mustn't wait for the lock."""
+        all_off()
+        message = "Watchdog: " + reason + ", so everything is off"
+        self.logger.error(message)
+        send_message("error \"" + message + "\"")
+
+    def __control_thread_function(self):
+        if Core.control_real_time_priority is not None:
+            use_real_time_priority(Core.control_real_time_priority, self.logger)
+        control = self.guarded(self.control)
+        # Not until the sensors have been read for the first time.
+        cycle = 0
+        while self.controlling:
+            cycle = self.temperature_reader.wait_for_samples(cycle, Core.control_timeout_seconds)
+            if self.controlling:
+                control()
+
+    def guarded(self, action):
+        """
+        Wrap action so runtime errors are reported rather than stopping the loop,
+        and the messages it sends go to the GUI together.
+        """
+        name = "core." + action.__name__
+        def guarded_action():
+            with self.lock, message_batch():
+                started = stats.start()
+                try:
+                    action()
+                except RuntimeError as rt:
+                    self.errors.report("{0}".format(rt))
+                stats.stop(name, started)
+        return guarded_action
+
+    def send_splash(self):
+        send_message("image " + self.installation_path + "splash.png")
+
+    def change_activity(self, new_activity):
+        # Closing the graph waits for one being drawn, so it's left until we've let go of the lock.
+        if self.activity.graph is not None:
+            self.finished_graphs.append(self.activity.graph)
+            self.activity.graph = None
+        self.activity.finish()
+        self.activity = new_activity
+
+    def close_finished_graphs(self):
+        """ Close the graphs of the activities that have finished. Call it without the lock."""
+        with self.lock:
+            graphs, self.finished_graphs = self.finished_graphs, []
+        for graph in graphs:
+            graph.close()
+
+    def create_run_logs(self, run_folder):
+        """
+        Create the logs for a new run, returning the TemperatureLogger, which belongs to the Activity,
+        or None if the log process is keeping them.
+        """
+        self.close_run_logs()
+        self.run_folder = run_folder
+        sensor_names = self.temperature_reader.sensor_names()
+        if self.log_process is not None:
+            self.log_process.start_run(run_folder, sensor_names, Core.binary_run_log, Core.raw_temperature_log, Core.temperature_log_window_columns)
+            return None
+        self.state_logger = Logger(run_folder + "state", initial_log = "Time, Target, Heater, Pump", buffered = True)
+        if Core.binary_run_log:
+            self.run_log = RunLogWriter(run_folder + "run.bin", sensor_names, with_window_columns = True)
+        if Core.raw_temperature_log:
+            self.raw_log = TemperatureLogger(run_folder + "raw_", sensor_names, buffered = True)
+        self.window.reset()
+        if self.render_process is None:
+            # Otherwise the graph process keeps its own.
+            self.plot_feed = PlotFeed(run_folder)
+        return TemperatureLogger(run_folder, sensor_names, buffered = True, window_columns = Core.temperature_log_window_columns)
+
+    def close_run_logs(self):
+        if self.state_logger is not None:
+            self.state_logger.close()
+            self.state_logger = None
+        if self.run_log is not None:
+            self.run_log.close()
+            self.run_log = None
+        if self.raw_log is not None:
+            self.raw_log.close()
+            self.raw_log = None
+        self.plot_feed = None
+        if self.run_folder is not None:
+            if stats.enabled and Core.timing_statistics_in_run_folder:
+                # With the workers' statistics from the last time they were asked, if they have been.
+                self.dump_stats([w.stats_report for w in self.workers() if w.stats_report is not None])
+            if self.log_process is not None:
+                # It adds the run to the catalogue once the logs are closed.
+                self.log_process.close_run()
+            else:
+                self.catalogue.add(self.run_folder)
+            self.run_folder = None
+
+    def checkpoint_logs(self):
+        """ Make sure all the logs are safely on the disk."""
+        self.logger.checkpoint()
+        if self.state_logger is not None:
+            self.state_logger.checkpoint()
+        if self.run_log is not None:
+            self.run_log.checkpoint()
+        if self.raw_log is not None:
+            self.raw_log.checkpoint()
+        if self.activity.temperature_log is not None:
+            self.activity.temperature_log.checkpoint()
+        if self.log_process is not None:
+            self.log_process.checkpoint()
+
+    def control(self):
+        """ Decide whether to heat, from the latest temperatures. This runs for every new set of samples."""
+        temperatures = self.temperature_reader.temperatures()
+        average_temperature = average(temperatures) if len(temperatures) > 0 else math.nan
+        target, state, should_heat = self.activity.state(average_temperature, heater().is_lit)
+        self.temperatures = temperatures
+        self.average_temperature = average_temperature
+        self.target = target
+        self.window.add(temperatures, average_temperature)
+        if self.raw_log is not None:
+            self.raw_log.log_temperatures(temperatures, average_temperature)
+        if Core.status_period is None:
+            self.send_status()
+
+        if gpio.test_mode:
+            # The buttons drive the heater and pump.
+            self.controlled()
+            return
 
         if state == Activity.State.HOT:
             send_message("hot")
@@ -187,161 +464,344 @@ def main():
         if state == Activity.State.OK:
             send_message("ok")
 
-        if should_heat and not heater.is_lit:
+        # The controller stops the heater chattering, if it needs to (see control.py).
+        if should_heat and not heater().is_lit:
             turn_pump_on()
             turn_heater_on()
         else:
-            if heater.is_lit and not should_heat:
+            if heater().is_lit and not should_heat:
                 turn_heater_off()
+        self.controlled()
+
+    def controlled(self):
+        """ control() has decided what to do, whether or not it changed anything."""
+        if self.watchdog is not None:
+            self.watchdog.kick()
+        self.record_telemetry()
+
+    def record_telemetry(self):
+        if self.telemetry is not None:
+            self.telemetry.append(clock.time(), self.average_temperature, self.target, heater().is_lit, pump().is_lit, self.temperatures)
+
+    def log_temperatures(self):
+        """
+        Log the mean, minimum and maximum over the window since the last time.
+        The logs are buffered (see Logger), and only read once the run has finished,
+        since the graph is drawn from the PlotFeed.
+        """
+        window = self.window.take()
+        if window is None:
+            if len(self.temperatures) == 0:
+                return
+            window = (self.temperatures, self.average_temperature, self.average_temperature, self.average_temperature)
+        temperatures, average_temperature, minimum, maximum = window
+        self.activity.log_temperatures(temperatures, average_temperature, (minimum, maximum))
+        if self.state_logger is not None:
+            self.state_logger.log_values([self.target, 1 if heater().is_lit else 0, 1 if pump().is_lit else 0])
+        if self.run_log is not None:
+            self.run_log.append(clock.time(), average_temperature, temperatures, self.target, heater().is_lit, pump().is_lit, (minimum, maximum))
+        if self.plot_feed is not None:
+            self.plot_feed.add(clock.time(), average_temperature, self.target, heater().is_lit, pump().is_lit)
+
+    def follow_telemetry(self):
+        """ Catch up with the control process's latest samples and state."""
+        records, self.next_record, lost = self.telemetry.read(self.next_record)
+        if len(records) > 0:
+            timestamp, self.average_temperature, self.target, heater_is_on, pump_is_on, self.temperatures = records[-1]
+
+    def send_status(self):
+        if self.control_process is not None:
+            self.follow_telemetry()
+        if len(self.temperatures) > 0:
+            send_message("temp " + str(self.average_temperature))
+
+    def update_graph(self):
+        if self.plot_feed is not None:
+            self.plot_feed.write()
+        self.activity.send_updated_graph()
+
+    def update_temperatures(self):
+        """ Control, log, tell the GUI and update the graph, all now, e.g. when a run starts."""
+        started = stats.start()
+        if self.control_process is not None:
+            # The control and log processes do theirs as soon as they hear about the run.
+            self.update_graph()
+            stats.stop("core.update_temperatures", started)
+            return
+        self.control()
+        if Core.status_period is not None:
+            self.send_status()
+        self.log_temperatures()
+        self.update_graph()
+        stats.stop("core.update_temperatures", started)
+
+    def hold(self, temperature, controller_name = None):
+        if self.activity.is_holding_temperature():
+            self.activity.change_set_point(temperature)
+            if self.control_process is not None:
+                self.control_process.change_profile(self.activity.profile)
+        else:
+            controller = self.create_controller(controller_name)
+            if controller is None:
+                return
 
-        if state_logger is not None:
-            state_logger.log_values([target, 1 if heater.is_lit else 0, 1 if pump.is_lit else 0])
+            run_folder = create_and_record_run_folder(self.installation_path, "hold", self.logger)
 
-        activity.send_updated_graph()
+            temperature_logger = self.create_run_logs(run_folder)
 
-    def hold(temperature):
-        nonlocal activity, state_logger
-        if activity.is_holding_temperature():
-            activity.change_set_point(temperature)
-        else:
-            run_folder = create_and_record_run_folder(installation_path, "hold", logger)
+            profile = Profile(run_folder + "profile.json", run_folder + "profile.dat", self.logger)
+            profile.create_hold_profile(temperature, Hold.rest_additional_minutes)
 
-            temperature_logger = TemperatureLogger(run_folder, temperature_reader.sensor_names())
-            state_logger = Logger(run_folder + "state", initial_log = "Time, Target, Heater, Pump")
+            graph_writer = self.create_graph_writer(run_folder, profile)
 
-            profile = Profile(run_folder + "profile.json", run_folder + "profile.dat", logger)
-            profile.create_hold_profile(temperature, Hold.rest_additional_minutes)
+            self.change_activity(Hold(self.logger, profile, temperature_logger, graph_writer, controller))
+            self.start_control(profile, controller)
 
-            graph_writer = GraphWriter(logger, run_folder + "graph.png", gnuplot_command_file, temperature_logger.path, profile.graph_data_path(), state_logger.path, datetime.now())
+        self.update_temperatures()
 
-            activity = Hold(logger, profile, temperature_logger, graph_writer)
-            turn_pump_on()
+    def preset(self, profile_name, controller_name = None):
+        if not self.activity.is_running_preset(profile_name):
+            controller = self.create_controller(controller_name)
+            if controller is None:
+                return
 
-        update_temperatures()
+            details = self.profile_cache.get(profile_name)
+            if details is None:
+                send_message("error \"Can't use preset " + profile_name + "\"")
+                return
 
-    def preset(profile_name):
-        nonlocal activity, state_logger
-        if not activity.is_running_preset(profile_name):
-            run_folder = create_and_record_run_folder(installation_path, "preset_" + sanitized_stem(profile_name), logger)
+            run_folder = create_and_record_run_folder(self.installation_path, "preset_" + sanitized_stem(profile_name), self.logger)
 
-            temperature_logger = TemperatureLogger(run_folder, temperature_reader.sensor_names())
-            state_logger = Logger(run_folder + "state", initial_log = "Time, Target, Heater, Pump")
+            temperature_logger = self.create_run_logs(run_folder)
 
             copyfile(profile_name, run_folder + Path(profile_name).name)
-            profile = Profile(profile_name, run_folder + "profile.dat", logger)
-            profile.write_plot()
+            profile = Profile(profile_name, run_folder + "profile.dat", self.logger, details.profile)
+            profile.write_plot(details.points)
 
-            graph_writer = GraphWriter(logger, run_folder + "graph.png", gnuplot_command_file, temperature_logger.path, profile.graph_data_path(), state_logger.path, datetime.now())
+            graph_writer = self.create_graph_writer(run_folder, profile)
 
-            activity = Preset(logger, profile, temperature_logger, graph_writer)
+            self.change_activity(Preset(self.logger, profile, temperature_logger, graph_writer, controller))
+            self.start_control(profile, controller)
+            self.update_temperatures()
+
+    def start_control(self, profile, controller):
+        """ A run has started, so the pump goes on, and the heater follows the controller."""
+        if self.control_process is not None:
+            self.control_process.start_run(profile, controller.name)
+        else:
             turn_pump_on()
-            update_temperatures()
 
-    def send_list():
-        details = Profile.get_list(profiles_folder, logger)
+    def all_off(self):
+        if self.control_process is not None:
+            self.control_process.idle()
+        else:
+            all_off()
+
+    def create_graph_writer(self, run_folder, profile):
+        folder = run_folder
+        keep_path = run_folder + "graph.png"
+        if Core.graph_hand_off_folder is not None:
+            folder = create_folder_for_path(Core.graph_hand_off_folder)
+        if self.render_process is not None:
+            return self.render_process.graph_writer(run_folder, folder, keep_path, profile.graph_data_path(), clock.now(), Core.graph_renderer, self.gnuplot_command_file)
+        if Core.graph_renderer == "raster":
+            writer = RasterGraphWriter(self.logger, folder + "graph.png", self.plot_feed.temperature_path, profile.graph_data_path(), self.plot_feed.state_path, clock.now())
+        else:
+            writer = GraphWriter(self.logger, folder + "graph.png", self.gnuplot_command_file, self.plot_feed.temperature_path, profile.graph_data_path(), self.plot_feed.state_path, clock.now())
+        return BackgroundGraphWriter(writer, GraphHandOff(folder, keep_path))
+
+    def create_controller(self, controller_name):
+        try:
+            controller = create_controller(controller_name)
+        except RuntimeError as rt:
+            message = "{0}".format(rt)
+            self.logger.error(message)
+            send_message("error \"" + message + "\"")
+            return None
+        self.logger.log("Controller: " + controller.name)
+        return controller
+
+    def send_list(self):
+        details = self.profile_cache.get_list(self.profiles_folder)
         for d in details:
-            send_message("preset \"" + d["filepath"] + "\" \"" + d["name"] + "\" \"" + d["description"] + "\"")
-
-    def go_to_idle():
-        nonlocal activity, state_logger
-        all_off()
-        activity = Idle(logger)
-        state_logger = None
-        send_splash()
+            send_message("preset \"" + d["filepath"] + "\" \"" + d["name"] + "\" \"" + d["description"] + "\" \"" + str(round(d["duration"])) + "\"")
+
+    def send_stats(self, worker_reports = ()):
+        """ worker_reports: the workers' statistics to merge with our own (see stats.histograms())."""
+        summary = stats.summary(worker_reports)
+        if len(summary) == 0:
+            send_message("stats")
+        for name, s in summary.items():
+            values = [s["p50_ms"], s["p90_ms"], s["p99_ms"], s["max_ms"]]
+            send_message("stats " + name + " " + str(s["count"]) + " " + " ".join("{0:.3f}".format(v) for v in values))
+
+    def dump_stats(self, worker_reports = ()):
+        """ Write the timing statistics to the run folder, or the log folder if there's no run. See send_stats()."""
+        if self.run_folder is not None:
+            path = self.run_folder + "stats.json"
+        else:
+            path = self.log_folder + "stats_" + datetime_now_string() + ".json"
+        try:
+            stats.dump(path, worker_reports)
+            self.logger.log("Wrote " + path)
+        except OSError as e:
+            self.logger.error("Couldn't write " + path + ": " + str(e))
+
+    def send_runs(self, count):
+        for run in self.catalogue.recent(count):
+            start = datetime.fromtimestamp(run["start"]).strftime("%Y-%m-%d %H:%M:%S")
+            values = [run["duration"], run["samples"], run["minimum"], run["maximum"], run["mean"]]
+            send_message("run \"" + run["folder"] + "\" \"" + run["type"] + "\" \"" + run["profile"] + "\" \"" + start + "\" " + " ".join(map(str, values)))
+
+    def go_to_idle(self):
+        self.all_off()
+        self.change_activity(Idle(self.logger))
+        self.close_run_logs()
+        self.send_splash()
         send_message("ok")
-        leave_test_mode()
+        if self.control_process is None:
+            leave_test_mode()
 
-    def decode_message(message):
-        nonlocal activity, logger, keep_looping, temperature_reader
+    def lost_gui(self):
+        self.logger.error("stdin closed")
+        self.event_loop.remove_reader(sys.stdin)
 
+    def decode_message(self, message):
         parts = message.split()
         if len(parts) == 0:
             return
 
         command = parts[0]
-        has_parameters = len(parts) > 1
-
-        if command == "bye":
-            logger.log(message)
-            keep_looping = False
-        if command == "heartbeat":
-            # Echo heartbeats so GUI is happy, but don't log them
-            send_message(message)
-        if command == "idle":
-            logger.log(message)
-            go_to_idle()
-        if command == "hold" and has_parameters:
-            logger.log(message)
+        if command in self.commands:
+            with self.lock, message_batch():
+                started = stats.start()
+                self.commands[command](message, parts)
+                stats.stop("core.decode_message", started)
+            self.close_finished_graphs()
+
+        if not self.heard_from_gui:
+            self.send_splash()
+            self.heard_from_gui = True
+
+    # Message handlers
+
+    def on_bye(self, message, parts):
+        self.logger.log(message)
+        self.checkpoint_logs()
+        self.event_loop.stop()
+
+    def on_heartbeat(self, message, parts):
+        # Echo heartbeats so GUI is happy, but don't log them
+        send_message(message)
+
+    def on_idle(self, message, parts):
+        self.logger.log(message)
+        self.go_to_idle()
+
+    def on_hold(self, message, parts):
+        if len(parts) > 1:
+            self.logger.log(message)
             temperature = float(parts[1])
-            hold(temperature)
-        if command == "preset" and has_parameters:
-            logger.log(message)
+            controller_name = parts[2] if len(parts) > 2 else None
+            self.hold(temperature, controller_name)
+
+    def on_preset(self, message, parts):
+        if len(parts) > 1:
+            self.logger.log(message)
             splitbyquotes = message.split('"')
             if len(splitbyquotes) > 1:
                 profile_name = splitbyquotes[1]
-                preset(profile_name)
-        if command == "list":
-            send_list()
-        if command == "allstop":
-            all_off()   # do this first, before complex functions that might throw exceptions
-            logger.log(message)
-            go_to_idle()
-        if command == "testmode":
-            logger.log(message)
-            go_to_idle()
-            send_message("image " + installation_path + "testcardf.png")
-            enter_test_mode()
+                options = splitbyquotes[2].split() if len(splitbyquotes) > 2 else []
+                controller_name = options[0] if len(options) > 0 else None
+                self.preset(profile_name, controller_name)
 
-        nonlocal heard_from_gui
-        if not heard_from_gui:
-            send_splash()
-            heard_from_gui = True
+    def on_list(self, message, parts):
+        self.send_list()
 
-    def do_one_second_actions():
-        if test_mode:
-            send_temperature_debug(temperature_reader)
+    def on_runs(self, message, parts):
+        count = 10
+        if len(parts) > 1:
+            try:
+                count = int(parts[1])
+            except ValueError:
+                count = 0
+            if count < 1:
+                send_message("error \"Can't list " + parts[1] + " runs\"")
+                return
+        self.send_runs(count)
+
+    def on_allstop(self, message, parts):
+        self.all_off()   # do this first, before complex functions that might throw exceptions
+        self.logger.log(message)
+        self.checkpoint_logs()
+        self.go_to_idle()
+
+    def on_stats(self, message, parts):
+        option = parts[1] if len(parts) > 1 else None
+        if option == "on":
+            stats.enable(True)
+        elif option == "off":
+            stats.enable(False)
+        elif option == "reset":
+            stats.reset()
+        workers = [w for w in self.workers() if w.is_running()]
+        for worker in workers:
+            worker.request_stats(option)
+        self.stats_request = (option, workers, clock.monotonic() + Core.worker_stats_timeout_seconds)
+        self.check_stats_request()
+
+    def check_stats_request(self):
+        """ Answer the 'stats' message, once the workers have all sent their statistics, or we've waited long enough."""
+        if self.stats_request is None:
+            return
+        option, workers, deadline = self.stats_request
+        missing = [w for w in workers if w.stats_report is None]
+        if len(missing) > 0 and clock.monotonic() < deadline:
+            return
+        for worker in missing:
+            self.logger.error("No timing statistics from the " + worker.description)
+        self.stats_request = None
+        reports = [w.stats_report for w in workers if w.stats_report is not None]
+        if option == "dump":
+            self.dump_stats(reports)
+        self.send_stats(reports)
+
+    def on_testmode(self, message, parts):
+        self.logger.log(message)
+        self.go_to_idle()
+        send_message("image " + self.installation_path + "testcardf.png")
+        if self.control_process is not None:
+            self.control_process.enter_test_mode()
         else:
-            activity.tick()
-
-    def do_ten_second_actions():
-        update_temperatures()
+            enter_test_mode()
 
-    seconds = 0
-    poll_period = 0.05
-    polls_in_one_second = 1.0 / poll_period
-    polls = 0
+    # Periodic actions
 
-    while keep_looping:
-        # Non-blocking check for whether there's anything to read on stdin
-        # select() only signals stdin when ENTER is pressed, so when
-        # this fires, the whole line is available, so we must use readline()
-        if select.select([sys.stdin], [], [], 0)[0] == [sys.stdin]:
-            decode_message(sys.stdin.readline())
+    def do_one_second_actions(self):
+        if self.control_process is not None:
+            self.control_process.keep_running()
+        self.check_stats_request()
+        if gpio.test_mode:
+            send_temperature_debug(self.temperature_reader)
+        else:
+            self.activity.tick()
 
-        sleep(poll_period)
 
-        polls = polls + 1
-        if polls >= polls_in_one_second:
-            polls = 0
-            seconds = seconds + 1
-            try:
-                do_one_second_actions()
-                if seconds % 10 == 0:
-                    do_ten_second_actions()
-            except RuntimeError as rt:
-                message = "{0}".format(rt)
-                logger.error(message)
-                send_message("error \"" + message + "\"")
+def main():
+    core = Core("/opt/mash-o-matic/")
+    core.run()
 
 
 if __name__ == "__main__":
     sys.stderr.write("Mash-o-matiC core\n")
     try:
         main()
-        all_off()
     except RuntimeError as rt:
         send_message("error \"{0}\"".format(rt))
     except:
         raise
     finally:
-        all_off()
+        # Unless the control process had the GPIO, in which case it has turned everything off.
+        if gpio.claimed():
+            all_off()
+        flush_messages()
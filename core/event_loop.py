@@ -0,0 +1,130 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+EventLoop class
+"""
+
+import heapq
+import math
+import os
+import selectors
+
+import clock
+import stats
+
+
+class EventLoop:
+    """
+    A minimal event loop for the core.
+
+    We sleep in select() until either a file we're interested in (stdin)
+    becomes readable or the next timer is due, so there are no idle
+    wakeups and messages are handled as soon as they arrive.
+
+    Timers are driven by the monotonic clock, and each deadline is
+    calculated from when the timer was created rather than from when it
+    last ran, so slow actions don't make the timers drift. If an action
+    is so slow that whole periods are missed, they are skipped rather
+    than run back to back.
+    Timers due at the same moment run in the order they were added.
+
+    The time comes from the clock module, so with a VirtualClock the
+    timers can be driven without run(), by advancing the clock to each
+    next_deadline() and calling run_due_timers().
+    """
+
+    class Timer:
+        def __init__(self, period, callback, start, order):
+            self.period = period
+            self.callback = callback
+            self.start = start
+            self.count = 1
+            self.order = order
+
+        def deadline(self):
+            return self.start + self.count * self.period
+
+        def __lt__(self, other):
+            return (self.deadline(), self.order) < (other.deadline(), other.order)
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.timers = []
+        self.timers_added = 0
+        self.running = False
+
+    def add_reader(self, file, callback):
+        """ Call callback() whenever file is readable."""
+        self.selector.register(file, selectors.EVENT_READ, callback)
+
+    def remove_reader(self, file):
+        self.selector.unregister(file)
+
+    def call_every(self, period, callback):
+        """ Call callback() every period seconds, starting one period from now."""
+        timer = EventLoop.Timer(period, callback, clock.monotonic(), self.timers_added)
+        self.timers_added = self.timers_added + 1
+        heapq.heappush(self.timers, timer)
+
+    def next_deadline(self):
+        """ The clock.monotonic() time the next timer is due, or None if there are no timers."""
+        return self.timers[0].deadline() if len(self.timers) > 0 else None
+
+    def run_due_timers(self):
+        """ Run the timers that are due, without waiting for anything."""
+        self.running = True
+        self.__run_due_timers()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        self.running = True
+        while self.running:
+            timeout = None
+            if len(self.timers) > 0:
+                timeout = max(0, self.timers[0].deadline() - clock.monotonic())
+            ready = self.selector.select(timeout)
+            started = stats.start()
+            for key, events in ready:
+                key.data()
+                if not self.running:
+                    return
+            self.__run_due_timers()
+            stats.stop("event_loop.work", started)
+
+    def __run_due_timers(self):
+        now = clock.monotonic()
+        while self.running and len(self.timers) > 0 and self.timers[0].deadline() <= now:
+            timer = heapq.heappop(self.timers)
+            if stats.enabled:
+                stats.record("event_loop.lateness", now - timer.deadline())
+            timer.callback()
+            timer.count = max(timer.count + 1, math.floor((clock.monotonic() - timer.start) / timer.period) + 1)
+            heapq.heappush(self.timers, timer)
+
+
+class LineReader:
+    """
+    Read whole lines from a file descriptor without blocking.
+
+    select() tells us there is something to read, but not how much, so
+    read whatever is there, and hand on every complete line. Any partial
+    line is kept until the rest of it arrives.
+    """
+    def __init__(self, fd, line_callback, eof_callback):
+        self.fd = fd
+        self.line_callback = line_callback
+        self.eof_callback = eof_callback
+        self.buffer = b""
+
+    def read(self):
+        data = os.read(self.fd, 4096)
+        if data == b"":
+            self.eof_callback()
+            return
+        lines = (self.buffer + data).split(b"\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            self.line_callback(line.decode(errors="replace"))
@@ -0,0 +1,125 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+Fake hardware, so the core can run somewhere other than the RPi.
+
+install_stub_gpio() must be called before core (or gpio) is imported,
+because that imports gpiozero. The Buttons and LEDs themselves aren't
+created until they're first used (see gpio.py). If gpiozero is
+installed we use its mock pin factory, otherwise we provide a minimal
+stand in for the parts of gpiozero the core uses.
+
+FakeOneWireBus builds a directory that looks like /sys/bus/w1/devices,
+with a temperature file for each sensor, and points TemperatureReader
+at it. write_fake_worker() does the same for a worker process (e.g. the
+control process), which can't be told from here.
+"""
+
+import os
+import sys
+import types
+from pathlib import Path
+
+from temperature_reader import TemperatureReader
+
+
+class StubButton:
+    """ Enough of gpiozero.Button for the core."""
+    def __init__(self, pin):
+        self.pin = pin
+        self.when_pressed = None
+        self.when_released = None
+
+    def press(self):
+        if self.when_pressed is not None:
+            self.when_pressed()
+
+    def release(self):
+        if self.when_released is not None:
+            self.when_released()
+
+
+class StubLED:
+    """ Enough of gpiozero.LED for the core."""
+    def __init__(self, pin):
+        self.pin = pin
+        self.is_lit = False
+
+    def on(self):
+        self.is_lit = True
+
+    def off(self):
+        self.is_lit = False
+
+
+def install_stub_gpio():
+    """ Make sure 'import gpiozero' gives us something that doesn't need real pins."""
+    if "gpiozero" in sys.modules:
+        return
+    try:
+        os.environ.setdefault("GPIOZERO_PIN_FACTORY", "mock")
+        import gpiozero
+    except ImportError:
+        stub = types.ModuleType("gpiozero")
+        stub.Button = StubButton
+        stub.LED = StubLED
+        sys.modules["gpiozero"] = stub
+
+
+class FakeOneWireBus:
+    """
+    A directory laid out like the w1 sysfs tree, for TemperatureReader to read.
+
+    folder: where to build the tree
+    sensor_ids: the sensor IDs (directory names), e.g. "28-000001"
+    bulk_read: whether to include w1_bus_master1/therm_bulk_read
+    """
+    def __init__(self, folder, sensor_ids, bulk_read = False):
+        self.folder = folder if folder.endswith("/") else folder + "/"
+        self.sensor_ids = list(sensor_ids)
+        master = Path(self.folder + "w1_bus_master1")
+        master.mkdir(parents=True, exist_ok=True)
+        (master / "w1_master_slave_count").write_text(str(len(self.sensor_ids)) + "\n")
+        (master / "w1_master_slaves").write_text("".join(i + "\n" for i in self.sensor_ids))
+        if bulk_read:
+            (master / "therm_bulk_read").write_text("0\n")
+        for i in self.sensor_ids:
+            Path(self.folder + i).mkdir(exist_ok=True)
+            (Path(self.folder + i) / "resolution").write_text("12\n")
+            self.set_temperature(i, 20.0)
+
+    def install(self):
+        """ Make TemperatureReader use this bus."""
+        TemperatureReader.one_wire_device_path = self.folder
+
+    def set_temperature(self, sensor_id, degrees):
+        # Write a new file and rename it, so a reader never sees a partly written value.
+        path = self.folder + sensor_id + "/temperature"
+        with open(path + ".tmp", "w") as f:
+            f.write(str(int(round(degrees * 1000))) + "\n")
+        os.replace(path + ".tmp", path)
+
+    def set_all_temperatures(self, degrees):
+        for i in self.sensor_ids:
+            self.set_temperature(i, degrees)
+
+
+fake_worker_script = """import runpy
+import sys
+sys.path.insert(0, {core_folder!r})
+from fake_hardware import install_stub_gpio
+install_stub_gpio()
+from temperature_reader import TemperatureReader
+TemperatureReader.one_wire_device_path = {one_wire_device_path!r}
+runpy.run_path({worker_path!r}, run_name = "__main__")
+"""
+
+def write_fake_worker(path, worker_path, bus):
+    """
+    Write a script to path which runs worker_path (e.g. ControlProcess.worker_path)
+    with the stub GPIO and bus, a FakeOneWireBus. Use it as the WorkerProcess's worker_path.
+    """
+    core_folder = os.path.dirname(os.path.abspath(__file__))
+    Path(path).write_text(fake_worker_script.format(core_folder = core_folder, one_wire_device_path = bus.folder, worker_path = worker_path))
+    return path
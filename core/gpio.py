@@ -0,0 +1,112 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+The GPIO: four buttons, the heater and the pump.
+
+The pins are created the first time they are used, in whichever process
+controls the heater, rather than when this is imported. gpiozero starts
+threads of its own for the buttons, so the process should be pinned to
+its CPUs first (see scheduling.py), and no other process should claim
+the pins.
+"""
+
+from gpiozero import Button, LED
+
+from utils import send_message
+
+
+class Pins:
+    """ The gpiozero devices, with the buttons sending their presses to the GUI."""
+    def __init__(self):
+        self.buttons = [Button(17), Button(22), Button(23), Button(27)]
+        self.heater = LED(21)
+        self.pump = LED(20)
+        for number, button in enumerate(self.buttons, 1):
+            button.when_pressed = send_down(number)
+            button.when_released = send_up(number)
+
+    def button(self, number):
+        """ number: 1 to 4, as the GUI knows them."""
+        return self.buttons[number - 1]
+
+
+pins = None
+
+def claim_pins():
+    """ Get the Pins, creating them if this is the first time."""
+    global pins
+    if pins is None:
+        pins = Pins()
+    return pins
+
+def claimed():
+    return pins is not None
+
+def heater():
+    return claim_pins().heater
+
+def pump():
+    return claim_pins().pump
+
+def send_down(button):
+    return lambda : send_message("button "+str(button)+" down")
+
+def send_up(button):
+    return lambda : send_message("button "+str(button)+" up")
+
+def turn_heater_on():
+    heater().on()
+    send_message("heat on")
+
+def turn_heater_off():
+    heater().off()
+    send_message("heat off")
+
+def turn_pump_on():
+    pump().on()
+    send_message("pump on")
+
+def turn_pump_off():
+    pump().off()
+    send_message("pump off")
+
+def all_off():
+    heater().off()
+    pump().off()
+    send_message("heat off")
+    send_message("pump off")
+
+
+# Test mode
+
+test_mode = False
+
+def enter_test_mode():
+    global test_mode
+    if not test_mode:
+        test_mode = True
+        claim_pins().button(2).when_pressed = turn_pump_on
+        claim_pins().button(2).when_released = turn_pump_off
+        claim_pins().button(3).when_pressed = turn_heater_on
+        claim_pins().button(3).when_released = turn_heater_off
+
+def leave_test_mode():
+    global test_mode
+    if test_mode:
+        test_mode = False
+        claim_pins().button(2).when_pressed = send_down(2)
+        claim_pins().button(2).when_released = send_up(2)
+        claim_pins().button(3).when_pressed = send_down(3)
+        claim_pins().button(3).when_released = send_up(3)
+
+def send_temperature_debug(temperature_reader):
+    names = temperature_reader.sensor_names()
+    snapshots = temperature_reader.snapshots()
+    lines = []
+    for n, snapshot in zip(names, snapshots):
+        latest = snapshot.latest()
+        value = 0.0 if latest is None else latest[1]
+        lines.append("{0:16} {1:.2f} {2:+.2f}/min".format(n, value, snapshot.slope(60)))
+    message = "testshow \"" + "<br>".join(lines) + "\""
+    send_message(message)
@@ -5,8 +5,18 @@ https://github.com/pqpq/beer-o-tron
 GraphWriter class
 """
 
+import hashlib
+import os
+import queue
+import select
+import shutil
+import threading
 from pathlib import Path
-from subprocess import run
+from subprocess import Popen, PIPE
+from time import monotonic
+
+import stats
+from utils import send_message
 
 
 class GraphWriter:
@@ -18,24 +28,37 @@ class GraphWriter:
     should be at and a line for the actual temperature.
     As we log the temperature we update the graph so the user can see
     what's going on.
+
+    Rather than starting gnuplot for every update, we keep one gnuplot
+    process for the whole run and talk to it over a pipe. The first
+    update 'call's the command file, which does all the style setup and
+    the first plot. After that we only need to point the output at the
+    graph file again and 'replot', which re-reads the data files.
+    If gnuplot dies (e.g. it didn't like the data) we start a new one
+    next time. If it can't be started at all (e.g. it isn't installed)
+    we keep trying, but only report it the first time.
     """
+
+    # gnuplot prints this when it has finished an update, so we know
+    # the graph file is complete.
+    done_marker = "graph-writer-done"
+
     def __init__(self, logger, graph_output_path, gnuplot_command_file, temperature_log_path, profile_data_path, state_log_path, start_time):
         """
         logger: a Logger in case we need to report errors
         graph_output_path : the path for the graph we are creating
         gnuplot_command_file: the file describing how to generate the graph
-        temperature_log_path: the path to the temperature log to use for the graph
+        temperature_log_path: the path to the temperature data to use for the graph, in the temperature log format
         profile_data_path: the path to the profile data to use for the graph
-        state_log_path: the path to the state data to use for the graph
+        state_log_path: the path to the state data to use for the graph, in the state log format
+        The temperature and state data are normally a PlotFeed's, rather than the whole logs.
         start_time: the start time of the graph, for the x-axis
         """
         self.logger = logger
         self.temperature_log_path = temperature_log_path
         self.graph_output_path = graph_output_path
-        self.command = [
-            "gnuplot",
-            "-c",
-            gnuplot_command_file,
+        self.gnuplot_command_file = gnuplot_command_file
+        self.arguments = [
             self.graph_output_path,
             "15",
             "85",
@@ -44,12 +67,276 @@ class GraphWriter:
             profile_data_path,
             state_log_path
         ]
+        self.process = None
+        # So that if gnuplot isn't there, we only say so once.
+        self.start_failed = False
+
+    def __del__(self):
+        self.close()
 
     def path(self):
         return self.graph_output_path
 
-    def write(self):
+    def set_path(self, graph_output_path):
+        """ Draw the graph at graph_output_path from now on."""
+        self.graph_output_path = graph_output_path
+        self.arguments[0] = graph_output_path
+
+    def write(self, timeout = None):
+        """
+        Update the graph, waiting for gnuplot to finish.
+        timeout: give up (and kill gnuplot) after this many seconds. None waits forever.
+        Returns True if the graph was written.
+        """
         if Path(self.temperature_log_path).is_file():
-            run(self.command)
+            if not self.__is_running():
+                try:
+                    self.__start()
+                except OSError as e:
+                    if not self.start_failed:
+                        self.logger.error("GraphWriter: couldn't start gnuplot: " + str(e))
+                        self.start_failed = True
+                    return False
+                self.start_failed = False
+                self.__send(self.__call_command())
+            else:
+                self.__send(self.__replot_command())
+            return self.__wait_until_done(timeout)
         else:
             self.logger.error("GraphWriter.write(): no temperature file yet")
+        return False
+
+    def close(self):
+        """ Stop the gnuplot process, if there is one."""
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout = 1)
+            except:
+                self.process.kill()
+            self.process = None
+
+    def __is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def __start(self):
+        self.close()
+        self.process = Popen(["gnuplot"], stdin=PIPE, stdout=PIPE, bufsize=0)
+        self.output = b""
+
+    def __call_command(self):
+        quoted = ['"' + a + '"' for a in [self.gnuplot_command_file] + self.arguments]
+        return ("call " + " ".join(quoted) + "\n"
+                + "unset output\n"
+                + "set print \"-\"\n"
+                + self.__done_command())
+
+    def __replot_command(self):
+        return ("set output \"" + self.graph_output_path + "\"\n"
+                + "replot\n"
+                + "unset output\n"
+                + self.__done_command())
+
+    def __done_command(self):
+        return "print \"" + GraphWriter.done_marker + "\"\n"
+
+    def __send(self, commands):
+        try:
+            self.process.stdin.write(commands.encode())
+        except (BrokenPipeError, ValueError):
+            self.logger.error("GraphWriter: gnuplot has stopped")
+
+    def __wait_until_done(self, timeout):
+        # Read stdout ourselves, rather than readline(), so that select()
+        # can tell us the truth about whether there's anything to read.
+        marker = GraphWriter.done_marker.encode()
+        deadline = None if timeout is None else monotonic() + timeout
+        stdout = self.process.stdout.fileno()
+        while marker not in self.output:
+            wait = None if deadline is None else max(0, deadline - monotonic())
+            if not select.select([stdout], [], [], wait)[0]:
+                self.logger.error("GraphWriter: gnuplot took more than " + str(timeout) + "s, killing it")
+                self.process.kill()
+                self.process.wait()
+                self.process = None
+                return False
+            data = os.read(stdout, 1024)
+            if data == b"":
+                # gnuplot exited, probably because of an error in the data.
+                self.logger.error("GraphWriter: gnuplot exited with " + str(self.process.wait()))
+                self.process = None
+                return False
+            self.output = self.output + data
+        self.output = self.output.split(marker, 1)[1]
+        return True
+
+
+class GraphHandOff:
+    """
+    Give each new graph image to the GUI safely, and only when it has changed.
+
+    The GUI is never pointed at the file being drawn. Each graph is drawn
+    into a file of its own (next_path()), and once it is complete it is
+    renamed over whichever of two buffer files the GUI isn't showing, so
+    the GUI is only told about complete pictures. Renaming, rather than
+    drawing over the buffer, means that if the GUI is still loading the
+    picture before last, it gets all of that one. It's the same rule
+    RasterGraphWriter follows when it writes its own file, and it matters
+    more for gnuplot, which writes the PNG a piece at a time.
+    If the image is the same as the last one (e.g. nothing has changed in
+    a long rest) the GUI isn't told at all, so it doesn't reload it.
+
+    The buffers can be in a different folder from the run, e.g. in
+    /dev/shm, so the GUI doesn't have to read from the SD card. When we
+    close, the last image is kept at keep_path, with the run: linked if
+    it's on the same file system, so it isn't written again, or copied.
+    """
+    def __init__(self, folder, keep_path = None):
+        self.paths = [folder + "graph_0.png", folder + "graph_1.png"]
+        self.drawing_path = folder + "graph_new.png"
+        self.keep_path = keep_path
+        self.next = 0
+        self.digest = None
+        self.latest = None
+
+    def next_path(self):
+        """ Where to draw the next graph."""
+        return self.drawing_path
+
+    def publish(self, image_path):
+        """
+        image_path: the complete image, drawn at next_path()
+        Returns the path the GUI should show, or None if the picture hasn't changed.
+        """
+        with open(image_path, "rb") as f:
+            digest = hashlib.sha1(f.read()).digest()
+        if digest == self.digest:
+            return None
+        path = self.paths[self.next]
+        os.replace(image_path, path)
+        self.digest = digest
+        self.latest = path
+        self.next = 1 - self.next
+        return path
+
+    def close(self):
+        if os.path.exists(self.drawing_path):
+            os.remove(self.drawing_path)
+        if self.keep_path is None or self.latest is None:
+            return
+        if os.path.lexists(self.keep_path):
+            os.remove(self.keep_path)
+        try:
+            os.link(self.latest, self.keep_path)
+        except OSError:
+            shutil.copyfile(self.latest, self.keep_path)
+        # The GUI may still be showing the latest one, so leave it if it's in the run's folder.
+        # If the buffers are shared with later runs, gnuplot would draw over the kept graph.
+        shared = os.path.dirname(self.latest) != os.path.dirname(self.keep_path)
+        for path in self.paths:
+            if (shared or path != self.latest) and os.path.exists(path):
+                os.remove(path)
+
+
+class BackgroundGraphWriter:
+    """
+    Run a GraphWriter in a worker thread, so a slow or stuck gnuplot can't
+    hold up the main loop (and therefore the heater).
+
+    Requests are coalesced: there is at most one pending request, and a
+    new request replaces it, since there's no point drawing a graph that
+    is already out of date. Each write has a hard timeout, and the GUI is
+    only told about the image once it has been written successfully, and
+    then through the GraphHandOff, if there is one. Once we've been
+    closed the GUI has moved on (e.g. to the splash), so it isn't told
+    about any more images, even one that was being drawn.
+    """
+
+    render_timeout_seconds = 20
+
+    # Long enough for a write in progress to finish, or be given up on.
+    close_timeout_seconds = render_timeout_seconds + 1
+
+    # Put in the queue to tell the worker thread to stop, or to draw the graph once more and then stop.
+    stop_request = "stop"
+    final_request = "final"
+
+    def __init__(self, graph_writer, hand_off = None):
+        """
+        graph_writer: a GraphWriter, or anything with the same write(), close(), path() and set_path()
+        hand_off: a GraphHandOff, which says where to draw each graph, or None to send the GUI the graph_writer's path after every write
+        """
+        self.graph_writer = graph_writer
+        self.hand_off = hand_off
+        self.requests = queue.Queue(maxsize = 1)
+        self.closed = False
+        self.closed_lock = threading.Lock()
+        self.thread = threading.Thread(target=BackgroundGraphWriter.__thread_function, daemon=True, args=(self,))
+        self.thread.start()
+
+    def path(self):
+        return self.graph_writer.path()
+
+    def write(self):
+        """ Ask for the graph to be updated. Never waits for gnuplot."""
+        self.__replace_pending_request("write")
+
+    def close(self, final_write = False, timeout = close_timeout_seconds):
+        """
+        Stop the worker thread, after drawing the graph once more if final_write.
+        Waits up to timeout seconds for the thread to finish, so don't call it
+        while holding anything the heater control needs.
+        """
+        with self.closed_lock:
+            self.closed = True
+        request = BackgroundGraphWriter.final_request if final_write else BackgroundGraphWriter.stop_request
+        self.__replace_pending_request(request)
+        self.thread.join(timeout = timeout)
+
+    def __replace_pending_request(self, request):
+        try:
+            self.requests.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            self.requests.put_nowait(request)
+        except queue.Full:
+            pass
+
+    def __thread_function(self):
+        while True:
+            request = self.requests.get()
+            if request == BackgroundGraphWriter.stop_request:
+                self.__close()
+                return
+            if self.hand_off is not None:
+                self.graph_writer.set_path(self.hand_off.next_path())
+            started = stats.start()
+            written = self.graph_writer.write(BackgroundGraphWriter.render_timeout_seconds)
+            stats.stop("graph.write", started)
+            if written:
+                self.__send_image()
+            if request == BackgroundGraphWriter.final_request:
+                self.__close()
+                return
+
+    def __send_image(self):
+        path = self.path()
+        if self.hand_off is not None:
+            try:
+                # Even once we're closed, so the hand off keeps the latest.
+                path = self.hand_off.publish(path)
+            except OSError as e:
+                self.graph_writer.logger.error("BackgroundGraphWriter: couldn't hand off the graph: " + str(e))
+                return
+        with self.closed_lock:
+            if path is not None and not self.closed:
+                send_message("image " + path)
+
+    def __close(self):
+        self.graph_writer.close()
+        if self.hand_off is not None:
+            try:
+                self.hand_off.close()
+            except OSError as e:
+                self.graph_writer.logger.error("BackgroundGraphWriter: couldn't keep the graph: " + str(e))
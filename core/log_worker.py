@@ -0,0 +1,264 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+The log process.
+
+With Core.split_processes the run's logs are written by a process of
+their own, which follows the run through the TelemetryRing, so neither
+the control process nor the core ever waits for the SD card. The logs
+are the same as when the core writes them itself (see doc/run_files.md).
+
+The core tells it when a run starts, when to checkpoint, and when the run
+has finished, and for its timing statistics, one JSON command per line on
+its stdin. Once it has closed
+a run's logs it writes 'closed FOLDER' on its stdout, so the core can add
+the run to the catalogue.
+
+    python3 log_worker.py RING_NAME LOG_FOLDER [--period 10] [--cpus 0,1,2]
+
+LogProcess is the core's side of it.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import clock
+import stats
+from event_loop import EventLoop, LineReader
+from logger import Logger, TemperatureLogger
+from run_log import RunLogWriter
+from scheduling import pin_to_cpus, parse_cpus
+from telemetry import TelemetryRing
+from window_statistics import WindowStatistics
+from worker_process import WorkerProcess, answer_stats
+
+
+class LogWorker:
+    """
+    The log process's side: follow the current run through the ring, and
+    every log period log the window since the last time, in the same way
+    as Core.log_temperatures().
+    """
+
+    # How often to catch up with the ring, which is how late the raw temperature log's times can be.
+    follow_seconds = 1
+
+    def __init__(self, ring, logger, output = sys.stdout):
+        self.ring = ring
+        self.logger = logger
+        self.output = output
+        self.run = None
+        self.run_folder = None
+        self.temperature_log = None
+        self.state_log = None
+        self.run_log = None
+        self.raw_log = None
+        self.window = WindowStatistics()
+        self.latest = None
+        self.next_record = 0
+
+    def handle(self, command):
+        name = command.get("command")
+        if name == "start":
+            self.start(command)
+        elif name == "stats":
+            answer_stats(command, self.send)
+        elif command.get("run") != self.run:
+            # For a run that has already been replaced.
+            pass
+        elif name == "checkpoint":
+            self.checkpoint()
+        elif name == "close":
+            self.close()
+        else:
+            self.logger.error("LogWorker: unknown command " + str(name))
+
+    def start(self, command):
+        """ A new run. The command has the run's folder, its sensors' names, and which logs to keep."""
+        self.close()
+        folder = command["run_folder"]
+        sensor_names = command["sensor_names"]
+        self.temperature_log = TemperatureLogger(folder, sensor_names, buffered = True, window_columns = command.get("window_columns", False))
+        self.state_log = Logger(folder + "state", initial_log = "Time, Target, Heater, Pump", buffered = True)
+        if command.get("binary", True):
+            self.run_log = RunLogWriter(folder + "run.bin", sensor_names, with_window_columns = True)
+        if command.get("raw", False):
+            self.raw_log = TemperatureLogger(folder + "raw_", sensor_names, buffered = True)
+        self.run = command["run"]
+        self.run_folder = folder
+        self.window.reset()
+        # The run starts with the latest samples logged, as it does when the core logs it.
+        self.next_record = command["from"]
+        records, next_record, lost = self.ring.read(max(0, self.next_record - 1))
+        self.latest = records[-1] if len(records) > 0 else None
+        self.log()
+
+    def follow(self):
+        """ Take in the samples recorded since we last looked."""
+        if self.run is None:
+            return
+        records, self.next_record, lost = self.ring.read(self.next_record)
+        if lost > 0:
+            self.logger.error("LogWorker: lost " + str(lost) + " samples")
+        for record in records:
+            timestamp, average, target, heater_is_on, pump_is_on, temperatures = record
+            self.window.add(temperatures, average)
+            if self.raw_log is not None:
+                self.raw_log.log_temperatures(temperatures, average)
+            self.latest = record
+
+    def log(self):
+        """ Log the mean, minimum and maximum over the window since the last time."""
+        started = stats.start()
+        self.follow()
+        if self.run is None or self.latest is None:
+            return
+        timestamp, latest_average, target, heater_is_on, pump_is_on, latest_temperatures = self.latest
+        window = self.window.take()
+        if window is None:
+            if len(latest_temperatures) == 0:
+                return
+            window = (latest_temperatures, latest_average, latest_average, latest_average)
+        temperatures, average_temperature, minimum, maximum = window
+        if len(temperatures) > 0:
+            self.temperature_log.log_temperatures(temperatures, average_temperature, (minimum, maximum))
+        self.state_log.log_values([target, 1 if heater_is_on else 0, 1 if pump_is_on else 0])
+        if self.run_log is not None:
+            self.run_log.append(clock.time(), average_temperature, temperatures, target, heater_is_on, pump_is_on, (minimum, maximum))
+        stats.stop("log_process.log", started)
+
+    def checkpoint(self):
+        """ Make sure all the logs are safely on the disk."""
+        for log in self.__logs():
+            log.checkpoint()
+
+    def close(self):
+        """ Close the run's logs, and say so."""
+        for log in self.__logs():
+            log.close()
+        if self.run_folder is not None:
+            self.send("closed " + self.run_folder)
+        self.temperature_log = None
+        self.state_log = None
+        self.run_log = None
+        self.raw_log = None
+        self.run = None
+        self.run_folder = None
+
+    def send(self, line):
+        """ Send line to the core."""
+        self.output.write(line + "\n")
+        self.output.flush()
+
+    def __logs(self):
+        return [log for log in [self.temperature_log, self.state_log, self.run_log, self.raw_log] if log is not None]
+
+
+class LogProcess(WorkerProcess):
+    """
+    The core's side of the log process.
+
+    If the process stops, the new one carries on with the current run from
+    the latest samples, in new temperature and state logs. When it has
+    closed a run's logs, closed() is called with the run's folder.
+    """
+
+    worker_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "log_worker.py")
+
+    # Long enough for the logs to be written and synced.
+    close_timeout_seconds = 5
+
+    def __init__(self, logger, event_loop, ring, log_folder, log_period, closed, cpus = None):
+        """
+        logger: a Logger in case we need to report errors
+        event_loop: the EventLoop that reads the process's output
+        ring: the TelemetryRing the run is recorded in
+        log_folder: where the process should write its own log
+        log_period: how often, in seconds, to log the temperatures
+        closed: called with the run folder, once the run's logs are closed
+        cpus: the CPUs the process should run on, or None for any
+        """
+        arguments = [ring.name, log_folder, "--period", str(log_period)]
+        if cpus is not None:
+            arguments = arguments + ["--cpus", ",".join(str(c) for c in sorted(cpus))]
+        super().__init__("log process", LogProcess.worker_path, arguments, logger, event_loop)
+        self.ring = ring
+        self.closed = closed
+        self.current_run = None
+        self.runs = 0
+
+    def start_run(self, run_folder, sensor_names, binary = True, raw = False, window_columns = False):
+        """ Log a new run, in run_folder. See Core for binary (run.bin), raw and window_columns."""
+        self.runs = self.runs + 1
+        self.current_run = {
+            "command": "start",
+            "run": self.runs,
+            "run_folder": run_folder,
+            "sensor_names": list(sensor_names),
+            "binary": binary,
+            "raw": raw,
+            "window_columns": window_columns,
+            "from": self.ring.written(),
+        }
+        self.send(self.current_run)
+
+    def checkpoint(self):
+        if self.current_run is not None:
+            self.send({"command": "checkpoint", "run": self.runs})
+
+    def close_run(self):
+        if self.current_run is not None:
+            self.send({"command": "close", "run": self.runs})
+            self.current_run = None
+
+    def missed(self):
+        if self.current_run is None:
+            return []
+        # Not from the start of the run again, which is in the old logs.
+        self.current_run["from"] = self.ring.written()
+        return [self.current_run]
+
+    def received(self, line):
+        if line.startswith("closed "):
+            self.closed(line[len("closed "):])
+        else:
+            self.logger.error("LogProcess: unexpected " + line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Write the Mash-o-matiC run logs in their own process")
+    parser.add_argument("ring", help = "the name of the core's TelemetryRing")
+    parser.add_argument("log_folder")
+    parser.add_argument("--period", type = float, default = 10, help = "how often, in seconds, to log the temperatures")
+    parser.add_argument("--cpus", help = "the CPUs to run on, e.g. 0,1,2")
+    arguments = parser.parse_args()
+
+    logger = Logger(arguments.log_folder + "log", initial_log = "Mash-o-matiC log process")
+    if arguments.cpus is not None:
+        pin_to_cpus(parse_cpus(arguments.cpus), logger)
+    ring = TelemetryRing.attach(arguments.ring)
+    worker = LogWorker(ring, logger)
+    event_loop = EventLoop()
+
+    def handle(line):
+        try:
+            worker.handle(json.loads(line))
+        except (ValueError, KeyError, RuntimeError, OSError) as e:
+            logger.error("LogWorker: " + repr(e) + " handling " + line.strip())
+
+    stdin = LineReader(sys.stdin.fileno(), handle, event_loop.stop)
+    event_loop.add_reader(sys.stdin, stdin.read)
+    event_loop.call_every(LogWorker.follow_seconds, worker.follow)
+    event_loop.call_every(arguments.period, worker.log)
+    try:
+        event_loop.run()
+    finally:
+        worker.close()
+        ring.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,20 +5,43 @@ https://github.com/pqpq/beer-o-tron
 Logger classes
 """
 
+import os
 import sys
+import threading
+import time
 from pathlib import Path
-from datetime import datetime
 
+import clock
 from utils import datetime_now_string
 
 
 class Logger:
-    """ A simple file based logger. """
-    def __init__(self, path, initial_log = None, log_creation_to_stderr = False):
+    """
+    A simple file based logger.
+
+    Normally every line is flushed to the file as soon as it is logged.
+    A buffered Logger keeps lines in memory until flush_interval_seconds
+    have passed or flush_size_bytes have built up, which saves a lot of
+    small writes to the SD card. Errors are always flushed straight away.
+    Nothing is fsync'ed except at a checkpoint(), so the data we could
+    lose is bounded by the flush interval, or by how often we checkpoint.
+    """
+
+    flush_interval_seconds = 30
+    flush_size_bytes = 4096
+
+    def __init__(self, path, initial_log = None, log_creation_to_stderr = False, buffered = False):
         parent = Path(path).parent
         Path(parent).mkdir(parents=True, exist_ok=True)
         self.path = path + "_" + datetime_now_string() + ".log"
         self.file = open(self.path, "a+")
+        self.buffered = buffered
+        self.buffer = []
+        self.buffer_size = 0
+        self.last_flush = clock.monotonic()
+        self.lock = threading.Lock()
+        self.time_second = None
+        self.time_text = ""
         if log_creation_to_stderr:
             sys.stderr.write("Logging to " + self.path + "\n")
         if initial_log is not None:
@@ -27,11 +50,19 @@ class Logger:
             self.file.flush()
 
     def log(self, text):
-        text = datetime.now().strftime("%H:%M:%S") + ", " + text
         if not text.endswith("\n"):
             text = text + "\n"
-        self.file.write(text)
-        self.file.flush()
+        with self.lock:
+            # The cached time text is shared by the control thread and the event loop.
+            text = self.__time_text() + ", " + text
+            if self.buffered:
+                self.buffer.append(text)
+                self.buffer_size = self.buffer_size + len(text)
+                if self.buffer_size >= Logger.flush_size_bytes or clock.monotonic() - self.last_flush >= Logger.flush_interval_seconds:
+                    self.__flush()
+            else:
+                self.file.write(text)
+                self.file.flush()
         return text
 
     def log_values(self, values):
@@ -40,13 +71,62 @@ class Logger:
 
     def error(self, text):
         logged_text = self.log(text)
+        self.flush()
         sys.stderr.write(logged_text)
 
+    def flush(self):
+        """ Write any buffered lines to the file."""
+        with self.lock:
+            self.__flush()
+
+    def checkpoint(self):
+        """ Make sure everything logged so far is on the disk."""
+        with self.lock:
+            self.__flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if not self.file.closed:
+            self.checkpoint()
+            self.file.close()
+
+    def __flush(self):
+        if len(self.buffer) > 0:
+            self.file.write("".join(self.buffer))
+            self.buffer = []
+            self.buffer_size = 0
+        self.file.flush()
+        self.last_flush = clock.monotonic()
+
+    def __time_text(self):
+        # Formatting the time is surprisingly slow, and we log a lot of lines
+        # in the same second, so only do it when the second changes.
+        # Call it with the lock held.
+        now = clock.time()
+        second = int(now)
+        if second != self.time_second:
+            self.time_second = second
+            self.time_text = time.strftime("%H:%M:%S", time.localtime(now))
+        return self.time_text
+
 
 class TemperatureLogger(Logger):
-    """ A Logger that knows how to log temperatures."""
-    def __init__(self, path, temperature_sensor_names):
-        super().__init__(path + "temperature", initial_log = "Time, Average, " + ", ".join(temperature_sensor_names))
+    """
+    A Logger that knows how to log temperatures.
+    With window_columns, each line also has the minimum and maximum of the
+    average over the logging window, after the sensors (see doc/run_files.md).
+    """
+
+    window_columns = ["Minimum", "Maximum"]
+
+    def __init__(self, path, temperature_sensor_names, buffered = False, window_columns = False):
+        names = list(temperature_sensor_names) + (TemperatureLogger.window_columns if window_columns else [])
+        super().__init__(path + "temperature", initial_log = "Time, Average, " + ", ".join(names), buffered = buffered)
+        self.has_window_columns = window_columns
 
-    def log_temperatures(self, temperatures, average):
-        self.log_values([average] + temperatures)
+    def log_temperatures(self, temperatures, average, window = None):
+        """ window: (minimum, maximum) of the average, if we have window columns."""
+        values = [average] + temperatures
+        if self.has_window_columns:
+            values = values + (list(window) if window is not None else [average, average])
+        self.log_values(values)
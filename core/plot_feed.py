@@ -0,0 +1,150 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+PlotFeed class
+"""
+
+import math
+import os
+import time
+
+
+class MinMaxDecimator:
+    """
+    Keep a decimated copy of a series of rows, as they arrive, in at most
+    max_points rows.
+
+    The rows are put into buckets of equal numbers of rows. Each bucket
+    remembers, for each column, its minimum and maximum and which came
+    first, and becomes two rows: one at the start of the bucket and one at
+    the end. So however much the data is squashed, peaks and troughs (and
+    the heater going on and off) are still drawn. When there are too many
+    buckets, neighbouring pairs are merged, and the buckets get twice as
+    big, so adding a row costs the same however long the run has been.
+    """
+
+    class Bucket:
+        __slots__ = ["start", "end", "count", "minimums", "minimum_times", "maximums", "maximum_times"]
+
+        def __init__(self, timestamp, values):
+            self.start = timestamp
+            self.end = timestamp
+            self.count = 1
+            self.minimums = list(values)
+            self.minimum_times = [timestamp] * len(values)
+            self.maximums = list(values)
+            self.maximum_times = [timestamp] * len(values)
+
+        def add(self, timestamp, values):
+            self.end = timestamp
+            self.count = self.count + 1
+            for i, value in enumerate(values):
+                if value < self.minimums[i] or math.isnan(self.minimums[i]):
+                    self.minimums[i] = value
+                    self.minimum_times[i] = timestamp
+                if value > self.maximums[i] or math.isnan(self.maximums[i]):
+                    self.maximums[i] = value
+                    self.maximum_times[i] = timestamp
+
+        def merge(self, other):
+            self.end = other.end
+            self.count = self.count + other.count
+            for i in range(len(self.minimums)):
+                if other.minimums[i] < self.minimums[i] or math.isnan(self.minimums[i]):
+                    self.minimums[i] = other.minimums[i]
+                    self.minimum_times[i] = other.minimum_times[i]
+                if other.maximums[i] > self.maximums[i] or math.isnan(self.maximums[i]):
+                    self.maximums[i] = other.maximums[i]
+                    self.maximum_times[i] = other.maximum_times[i]
+
+        def rows(self):
+            if self.count == 1:
+                return [(self.start, self.minimums)]
+            first = []
+            second = []
+            for i in range(len(self.minimums)):
+                if self.minimum_times[i] <= self.maximum_times[i]:
+                    first.append(self.minimums[i])
+                    second.append(self.maximums[i])
+                else:
+                    first.append(self.maximums[i])
+                    second.append(self.minimums[i])
+            return [(self.start, first), (self.end, second)]
+
+    def __init__(self, max_points = 320):
+        self.max_buckets = max(1, max_points // 2)
+        self.bucket_size = 1
+        self.buckets = []
+
+    def add(self, timestamp, values):
+        if len(self.buckets) > 0 and self.buckets[-1].count < self.bucket_size:
+            self.buckets[-1].add(timestamp, values)
+            return
+        self.buckets.append(MinMaxDecimator.Bucket(timestamp, values))
+        if len(self.buckets) > self.max_buckets:
+            self.__merge_pairs()
+
+    def rows(self):
+        """ The decimated rows, as (timestamp, values), oldest first."""
+        rows = []
+        for bucket in self.buckets:
+            rows.extend(bucket.rows())
+        return rows
+
+    def __merge_pairs(self):
+        merged = []
+        for i in range(0, len(self.buckets), 2):
+            bucket = self.buckets[i]
+            if i + 1 < len(self.buckets):
+                bucket.merge(self.buckets[i + 1])
+            merged.append(bucket)
+        self.buckets = merged
+        self.bucket_size = self.bucket_size * 2
+
+
+class PlotFeed:
+    """
+    The data gnuplot draws for a run, in the same format as the temperature
+    and state logs, but decimated to about the width of the graph in pixels,
+    so redrawing the graph costs the same at the end of a day long hold as
+    it does at the start.
+
+    The files are only rewritten by write(), and atomically, so gnuplot
+    never sees half a file.
+    """
+
+    max_points = 320
+
+    def __init__(self, folder):
+        folder = folder if folder.endswith("/") else folder + "/"
+        self.temperature_path = folder + "plot_temperature.csv"
+        self.state_path = folder + "plot_state.csv"
+        self.temperatures = MinMaxDecimator(PlotFeed.max_points)
+        self.state = MinMaxDecimator(PlotFeed.max_points)
+        self.changed = True
+        self.write()
+
+    def add(self, timestamp, average, target, heater_is_on, pump_is_on):
+        self.temperatures.add(timestamp, [average])
+        self.state.add(timestamp, [target, 1 if heater_is_on else 0, 1 if pump_is_on else 0])
+        self.changed = True
+
+    def write(self):
+        """ Rewrite the files, if anything has been added since they were last written."""
+        if not self.changed:
+            return
+        PlotFeed.__write_file(self.temperature_path, "Time, Average", self.temperatures.rows(), ["{0:.4f}"])
+        PlotFeed.__write_file(self.state_path, "Time, Target, Heater, Pump", self.state.rows(), ["{0}", "{0:.0f}", "{0:.0f}"])
+        self.changed = False
+
+    @staticmethod
+    def __write_file(path, header, rows, formats):
+        lines = [header]
+        for timestamp, values in rows:
+            text = time.strftime("%H:%M:%S", time.localtime(timestamp))
+            lines.append(text + ", " + ", ".join(f.format(v) for f, v in zip(formats, values)))
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temporary_path, path)
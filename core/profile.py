@@ -7,11 +7,21 @@ Profile class
 
 import json
 import math
+import os
 import sys
+from array import array
+from bisect import bisect_left
 from pathlib import Path
-from datetime import datetime, timedelta
+from datetime import timedelta
 from os import scandir
 
+import clock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def json_from_file(filepath, logger):
     try:
@@ -61,63 +71,81 @@ class Profile():
     hold_rest_minutes
                 How long the rolling rest step should extend into the
                 future when we're holding a set temperature.
+
+    The steps are compiled into a table of segments (start and end
+    seconds, start and end temperatures) sorted by time, so finding the
+    temperature at a given time is a binary search rather than a walk
+    through the JSON. The table is rebuilt whenever the steps change.
+
+    A hold profile changes every minute, but only at the end, so rather
+    than rewriting everything we only rewrite the last line of the graph
+    data (the end of the rolling rest), or append to it when the set point
+    changes. The JSON is replaced atomically, and not more often than
+    json_write_interval_seconds, so call flush() when the profile is
+    finished with.
     """
-    def __init__(self, file_path, graph_data_path, logger):
+
+    # The shortest time between writes of the JSON for a hold profile.
+    json_write_interval_seconds = 300
+
+    def __init__(self, file_path, graph_data_path, logger, profile = None):
+        """
+        file_path: the JSON file for the profile, which is read if it exists
+        graph_data_path: where to write the data for gnuplot
+        logger: a Logger
+        profile: the already parsed JSON, so we don't read file_path. It must not be changed.
+        """
         self.file_path = file_path
         self._graph_data_path = graph_data_path
-        self.start_time = datetime.now()
+        self.start_time = clock.now()
         self.last_change = self.start_time
         self.logger = logger
         self.hold_rest_minutes = 0
-        if Path(file_path).exists():
+        self.profile = None
+        self.json_written = None
+        self.json_changed = False
+        self.plot_tail = None
+        if profile is not None:
+            self.profile = profile
+        elif Path(file_path).exists():
             self.profile = json_from_file(self.file_path, self.logger)
+        self.__compile()
 
     def create_hold_profile(self, temperature, hold_rest_minutes):
         self.hold_rest_minutes = hold_rest_minutes
         self.profile = {"name": "Hold", "description": "Automatically generated."}
         self.profile["steps"] = [{"start": temperature}, {"rest": hold_rest_minutes}]
-        self.__update_generated_files()
+        self.__compile()
+        self.write()
+        self.write_plot()
 
     def graph_data_path(self):
         return self._graph_data_path
 
     def seconds(self):
-        return (datetime.now() - self.start_time).total_seconds()
+        return (clock.now() - self.start_time).total_seconds()
 
     def __rest_minutes(self):
-        seconds = (datetime.now() - self.last_change).total_seconds()
+        seconds = (clock.now() - self.last_change).total_seconds()
         return seconds / 60.0
 
-    def __update_generated_files(self):
-        self.write()
-        self.write_plot()
-
-    def __update_rest_step(self, additional_minutes = 0):
-        last_step = self.profile["steps"][-1]
-        last_step["rest"] = self.__rest_minutes() + additional_minutes
-
-    def update_rest(self):
-        self.__update_rest_step(self.hold_rest_minutes)
-        self.__update_generated_files()
-
-    def change_set_point(self, temperature):
-        self.__update_rest_step()
-        self.last_change = datetime.now()
-        self.profile["steps"].append({"jump": temperature})
-        self.profile["steps"].append({"rest": self.hold_rest_minutes})
-        self.__update_generated_files()
-
-    def write(self):
-        with open(self.file_path, "w+") as f:
-            json.dump(self.profile, f, indent=4)
-
-    def temperature_at(self, seconds):
+    def __compile(self):
+        """
+        Build the segment table from the steps.
+        Zero length steps ('start' and 'jump') are kept, so that
+        temperature_at() gives exactly the same answers as walking the
+        steps in order and taking the first one that contains the time.
+        """
+        self.__segment_starts = array("d")
+        self.__segment_ends = array("d")
+        self.__segment_durations = array("d")
+        self.__segment_start_temperatures = array("d")
+        self.__segment_end_temperatures = array("d")
         step_start_temperature = 0
-        step_start_seconds = 0
         step_end_temperature = math.nan
-        step_end_seconds = 0
         elapsed_seconds = 0
-        for step in self.profile["steps"]:
+        steps = [] if self.profile is None else self.profile.get("steps", [])
+        for step in steps:
             keys = list(step)
             if len(keys) > 0:
                 step_duration = 0
@@ -140,61 +168,278 @@ class Profile():
                     step_end_temperature = step_start_temperature
                     step_duration = 0
 
-                step_start_seconds = elapsed_seconds
+                self.__segment_starts.append(elapsed_seconds)
                 elapsed_seconds = elapsed_seconds + step_duration
-                step_end_seconds = elapsed_seconds
-                if (step_start_seconds <= seconds) and (seconds <= step_end_seconds):
-                    interpolated_temperature = step_start_temperature
-                    if step_duration != 0:
-                        proportion = (seconds - step_start_seconds) / step_duration
-                        interpolated_temperature = step_start_temperature + (step_end_temperature - step_start_temperature) * proportion
-                    return interpolated_temperature
-
-        return step_end_temperature
-
-    def write_plot(self):
-        """ Write a file containing gnuplot data for the profile."""
+                self.__segment_ends.append(elapsed_seconds)
+                self.__segment_durations.append(step_duration)
+                self.__segment_start_temperatures.append(step_start_temperature)
+                self.__segment_end_temperatures.append(step_end_temperature)
+        self.__final_temperature = step_end_temperature
+
+    def __update_rest_step(self, additional_minutes = 0):
+        last_step = self.profile["steps"][-1]
+        last_step["rest"] = self.__rest_minutes() + additional_minutes
+
+    def update_rest(self):
+        self.__update_rest_step(self.hold_rest_minutes)
+        self.__compile()
+        self.__json_changed()
+        self.__rewrite_plot_tail([])
+
+    def change_set_point(self, temperature):
+        self.__update_rest_step()
+        self.last_change = clock.now()
+        self.profile["steps"].append({"jump": temperature})
+        self.profile["steps"].append({"rest": self.hold_rest_minutes})
+        self.__compile()
+        self.__json_changed()
+        self.__rewrite_plot_tail([temperature])
+
+    def write(self):
+        """ Write the JSON, atomically, so there is always a complete file."""
+        temporary_path = self.file_path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(self.profile, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.file_path)
+        self.json_written = clock.monotonic()
+        self.json_changed = False
+
+    def flush(self):
+        """ Write anything that has been held back."""
+        if self.json_changed:
+            self.write()
+
+    def __json_changed(self):
+        self.json_changed = True
+        if self.json_written is None or clock.monotonic() - self.json_written >= Profile.json_write_interval_seconds:
+            self.write()
+
+    def temperature_at(self, seconds):
+        # The first segment that ends at or after 'seconds' is the only one that can contain it.
+        return self.__temperature_in_segment(bisect_left(self.__segment_ends, seconds), seconds)
+
+    def temperatures_at(self, times):
+        """
+        Get the temperature at each of 'times' (seconds into the profile).
+        With numpy, every time is looked up in the segment table at once.
+        Without it, if the times are in order, as they are for plotting or
+        simulation, this is one pass through the segment table.
+        """
+        if numpy is not None:
+            return self.__temperatures_at_with_numpy(times)
+        temperatures = array("d")
+        ends = self.__segment_ends
+        in_order = all(a <= b for a, b in zip(times, times[1:]))
+        segment = 0
+        for seconds in times:
+            if in_order:
+                while segment < len(ends) and ends[segment] < seconds:
+                    segment = segment + 1
+            else:
+                segment = bisect_left(ends, seconds)
+            temperatures.append(self.__temperature_in_segment(segment, seconds))
+        return temperatures
+
+    def __temperatures_at_with_numpy(self, times):
+        """ temperatures_at(), giving exactly the same answers as __temperature_in_segment()."""
+        times = numpy.asarray(times, dtype = "d")
+        temperatures = numpy.full(len(times), self.__final_temperature, dtype = "d")
+        segments = numpy.searchsorted(numpy.asarray(self.__segment_ends), times, side = "left")
+        inside = numpy.flatnonzero(segments < len(self.__segment_ends))
+        segments = segments[inside]
+        starts = numpy.asarray(self.__segment_starts)[segments]
+        contained = starts <= times[inside]
+        inside = inside[contained]
+        segments = segments[contained]
+        starts = starts[contained]
+        durations = numpy.asarray(self.__segment_durations)[segments]
+        start_temperatures = numpy.asarray(self.__segment_start_temperatures)[segments]
+        end_temperatures = numpy.asarray(self.__segment_end_temperatures)[segments]
+        ramping = durations != 0
+        proportions = (times[inside] - starts) / numpy.where(ramping, durations, 1)
+        temperatures[inside] = numpy.where(ramping, start_temperatures + (end_temperatures - start_temperatures) * proportions, start_temperatures)
+        return array("d", temperatures.tobytes())
+
+    def __temperature_in_segment(self, segment, seconds):
+        if segment < len(self.__segment_ends) and self.__segment_starts[segment] <= seconds:
+            start_temperature = self.__segment_start_temperatures[segment]
+            duration = self.__segment_durations[segment]
+            if duration != 0:
+                proportion = (seconds - self.__segment_starts[segment]) / duration
+                end_temperature = self.__segment_end_temperatures[segment]
+                return start_temperature + (end_temperature - start_temperature) * proportion
+            return start_temperature
+        return self.__final_temperature
+
+    def write_plot(self, points = None):
+        """
+        Write a file containing gnuplot data for the profile.
+        points: the result of plot_points() for this profile, if we already have it.
+        """
+        if points is None:
+            points = Profile.plot_points(self.profile["steps"], self.logger)
+        offset = len("Time, Temperature\n")
+        line = ""
         with open(self._graph_data_path, "w+") as f:
-            run_time = self.start_time
             f.write("Time, Temperature\n")
-            temperature = 0
-            for step in self.profile["steps"]:
-                keys = list(step)
-                if len(keys) > 0:
-                    if keys[0] == "start":
-                        temperature = step["start"]
-                    if keys[0] == "rest":
-                        run_time += timedelta(minutes = step["rest"])
-                    if keys[0] == "ramp":
-                        run_time += timedelta(minutes = step["ramp"])
-                        temperature = step["to"]
-                    if keys[0] == "mashout":
-                        temperature = step["mashout"]
-                        time = run_time.strftime("%H:%M:%S, ")
-                        f.write(time + str(temperature) + "\n")
-                        run_time += timedelta(minutes = 10)
-                    if keys[0] == "jump":
-                        temperature = step["jump"]
-
-                    time = run_time.strftime("%H:%M:%S, ")
-                    f.write(time + str(temperature) + "\n")
-                else:
-                    logger.error("Can't make sense of " + str(step))
+            for time_offset, temperature in points:
+                line = Profile.__plot_line(self.start_time + time_offset, temperature)
+                f.write(line)
+                offset = offset + len(line)
+
+        # If we finished with a rest, remember where its line starts, so we can change it later.
+        self.plot_tail = None
+        steps = self.profile["steps"]
+        if len(steps) > 0 and len(points) > 1 and list(steps[-1])[:1] == ["rest"]:
+            self.plot_tail = {"offset": offset - len(line), "rest_start_time": self.start_time + points[-2][0], "temperature": points[-1][1]}
 
     @staticmethod
-    def get_list(profiles_folder, logger):
+    def plot_points(steps, logger):
+        """
+        Get the (time offset, temperature) of each point of the plot data for 'steps'.
+        The time offset is a timedelta from the start of the profile.
+        """
+        points = []
+        run_time = timedelta()
+        temperature = 0
+        for step in steps:
+            keys = list(step)
+            if len(keys) > 0:
+                if keys[0] == "start":
+                    temperature = step["start"]
+                if keys[0] == "rest":
+                    run_time += timedelta(minutes = step["rest"])
+                if keys[0] == "ramp":
+                    run_time += timedelta(minutes = step["ramp"])
+                    temperature = step["to"]
+                if keys[0] == "mashout":
+                    temperature = step["mashout"]
+                    points.append((run_time, temperature))
+                    run_time += timedelta(minutes = 10)
+                if keys[0] == "jump":
+                    temperature = step["jump"]
+
+                points.append((run_time, temperature))
+            else:
+                logger.error("Can't make sense of " + str(step))
+        return points
+
+    @staticmethod
+    def __plot_line(run_time, temperature):
+        return run_time.strftime("%H:%M:%S, ") + str(temperature) + "\n"
+
+    def __rewrite_plot_tail(self, new_set_points):
+        """
+        Replace the last line of the plot data, which is the end of the
+        final rest, and then add a jump and a new rest for each new set point.
+        This gives the same file as write_plot(), without rewriting it all.
+        """
+        if self.plot_tail is None or not Path(self._graph_data_path).is_file():
+            self.write_plot()
+            return
+        tail = self.plot_tail
+        steps = self.profile["steps"]
+        rests = [step["rest"] for step in steps[len(steps) - 2 * len(new_set_points) - 1::2]]
+        run_time = tail["rest_start_time"] + timedelta(minutes = rests[0])
+        lines = [Profile.__plot_line(run_time, tail["temperature"])]
+        for temperature, rest in zip(new_set_points, rests[1:]):
+            lines.append(Profile.__plot_line(run_time, temperature))
+            tail["rest_start_time"] = run_time
+            tail["temperature"] = temperature
+            run_time += timedelta(minutes = rest)
+            lines.append(Profile.__plot_line(run_time, temperature))
+        with open(self._graph_data_path, "r+") as f:
+            f.seek(tail["offset"])
+            f.write("".join(lines))
+            f.truncate()
+        tail["offset"] = tail["offset"] + len("".join(lines[:-1]))
+
+
+class ProfileCache:
+    """
+    Keep the parsed preset profiles, so we don't have to read and parse
+    every file each time the GUI asks for the list, or again when one of
+    them is chosen.
+
+    Entries are keyed by path and are re-read if the file's modification
+    time changes. Each entry also has the plot data points and some
+    details worked out from the steps, so starting a preset is quick.
+    """
+
+    known_steps = ["start", "rest", "ramp", "mashout", "jump"]
+
+    class Entry:
+        def __init__(self, path, mtime, profile, points):
+            self.path = path
+            self.mtime = mtime
+            self.profile = profile
+            self.name = profile["name"]
+            self.description = profile["description"]
+            self.points = points
+            temperatures = [temperature for time_offset, temperature in points]
+            self.duration_minutes = points[-1][0].total_seconds() / 60 if len(points) > 0 else 0
+            self.minimum_temperature = min(temperatures) if len(temperatures) > 0 else math.nan
+            self.maximum_temperature = max(temperatures) if len(temperatures) > 0 else math.nan
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.entries = {}
+
+    def get(self, filepath):
+        """ Get the Entry for filepath, or None if it isn't a valid profile."""
+        try:
+            mtime = os.stat(filepath).st_mtime_ns
+        except OSError:
+            self.entries.pop(filepath, None)
+            self.logger.error("Problem reading " + filepath)
+            return None
+        entry = self.entries.get(filepath)
+        if entry is None or entry.mtime != mtime:
+            entry = self.__load(filepath, mtime)
+            if entry is None:
+                self.entries.pop(filepath, None)
+            else:
+                self.entries[filepath] = entry
+        return entry
+
+    def get_list(self, profiles_folder):
         """ Get a list of objects describing all the profiles in the profiles_folder."""
         profile_list = []
+        seen = set()
         with scandir(profiles_folder) as it:
             for entry in it:
                 if entry.is_file():
                     filepath = profiles_folder + entry.name
-                    profile = json_from_file(filepath, logger)
-                    if profile is not None:
-                        try:
-                            profile_list.append({"filepath":filepath, "name":profile["name"], "description":profile["description"]})
-                        except AttributeError:
-                            logger.error("Missing attributes in " + filepath)
-                            logger.error(str(profile))
+                    seen.add(filepath)
+                    details = self.get(filepath)
+                    if details is not None:
+                        profile_list.append({"filepath": filepath, "name": details.name, "description": details.description, "duration": details.duration_minutes})
+        for filepath in [f for f in self.entries if f not in seen and f.startswith(profiles_folder)]:
+            del self.entries[filepath]
         return profile_list
 
+    def __load(self, filepath, mtime):
+        profile = json_from_file(filepath, self.logger)
+        if profile is None:
+            return None
+        problem = ProfileCache.__problem(profile)
+        if problem is not None:
+            self.logger.error("Problem with " + filepath + ": " + problem)
+            return None
+        return ProfileCache.Entry(filepath, mtime, profile, Profile.plot_points(profile["steps"], self.logger))
+
+    @staticmethod
+    def __problem(profile):
+        if not isinstance(profile, dict):
+            return "not a JSON object"
+        for attribute in ["name", "description", "steps"]:
+            if attribute not in profile:
+                return "missing '" + attribute + "'"
+        if not isinstance(profile["steps"], list):
+            return "'steps' is not a list"
+        for step in profile["steps"]:
+            if not isinstance(step, dict) or len(step) == 0 or list(step)[0] not in ProfileCache.known_steps:
+                return "can't make sense of " + str(step)
+        return None
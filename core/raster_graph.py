@@ -0,0 +1,371 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+RasterGraphWriter class
+"""
+
+import math
+import os
+import struct
+import zlib
+from pathlib import Path
+
+
+# 5x7 digits for the temperature axis labels.
+digit_font = {
+    "0": ["01110", "10001", "10011", "10101", "11001", "10001", "01110"],
+    "1": ["00100", "01100", "00100", "00100", "00100", "00100", "01110"],
+    "2": ["01110", "10001", "00001", "00010", "00100", "01000", "11111"],
+    "3": ["11111", "00010", "00100", "00010", "00001", "10001", "01110"],
+    "4": ["00010", "00110", "01010", "10010", "11111", "00010", "00010"],
+    "5": ["11111", "10000", "11110", "00001", "00001", "10001", "01110"],
+    "6": ["00110", "01000", "10000", "11110", "10001", "10001", "01110"],
+    "7": ["11111", "00001", "00010", "00100", "01000", "01000", "01000"],
+    "8": ["01110", "10001", "10001", "01110", "10001", "10001", "01110"],
+    "9": ["01110", "10001", "10001", "01111", "00001", "00010", "01100"],
+}
+
+
+def seconds_of_day(text):
+    hours, minutes, seconds = text.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def read_plot_data(path, start_seconds):
+    """
+    Read a CSV file with a header and "HH:MM:SS, value, ..." rows, as gnuplot would.
+    Returns a list of (seconds since start_seconds, [values]).
+    """
+    rows = []
+    with open(path) as f:
+        f.readline()
+        for line in f:
+            parts = line.split(",")
+            if len(parts) < 2:
+                continue
+            try:
+                seconds = (seconds_of_day(parts[0].strip()) - start_seconds) % 86400
+                rows.append((seconds, [float(p) for p in parts[1:]]))
+            except ValueError:
+                continue
+    return rows
+
+
+def first_difference(old, new):
+    """ The index of the first row of new that isn't the same as in old."""
+    for i, (a, b) in enumerate(zip(old, new)):
+        if a != b:
+            return i
+    return min(len(old), len(new))
+
+
+class RasterGraphWriter:
+    """
+    Draw the graph ourselves, rather than with gnuplot, so no other process
+    is needed.
+
+    The picture looks like target/graph.plt's, but is drawn incrementally.
+    The background, grid, axis labels and the profile line are drawn into
+    a base layer, which is only redrawn when the profile or the time axis
+    changes. The pixels are kept between writes, and only the part of the
+    graph to the right of the first row of data (or of the profile) that
+    has changed since last time is copied back from the base layer and
+    drawn again. Usually that is just the last few pixels, even when a
+    hold's profile is made a minute longer. Everything is only drawn
+    again when the time axis changes, or when the PlotFeed squashes its
+    rows up, which happens each time the run doubles in length.
+
+    Two differences from gnuplot: the profile is drawn under the
+    temperature line, because it is in the base layer, and once the data
+    goes past the end of the time axis, the axis is made axis_growth
+    times longer, rather than a tic longer, so that a long hold isn't
+    drawn again from scratch every time_tic_seconds.
+
+    It has the same write(), close() and path() as GraphWriter, so it can
+    be used with a BackgroundGraphWriter.
+    """
+
+    width = 320
+    height = 240
+
+    low = 15
+    high = 85
+    temperature_tic = 10
+    time_tic_seconds = 10 * 60
+    axis_growth = 1.5
+
+    # gnuplot's margins are in characters of its 7x13 font.
+    left = round(2.5 * 7)
+    right = width - 1 - round(0.5 * 7)
+    top = round(1.25 * 13)
+    bottom = height - 1 - round(0.5 * 13)
+
+    tic_length = 4
+
+    # The heater is drawn on a 0 to 5 scale, so it fills the bottom fifth of the plot.
+    heater_scale = 5
+
+    white, black, grey, orange, brown, green = range(6)
+    palette = [(0xff, 0xff, 0xff), (0x00, 0x00, 0x00), (0xa0, 0xa0, 0xa0), (0xff, 0x99, 0x00), (0x80, 0x40, 0x00), (0x00, 0x80, 0x40)]
+
+    temperature_line_width = 2
+    profile_line_width = 2
+    target_line_width = 3
+
+    def __init__(self, logger, graph_output_path, temperature_path, profile_data_path, state_path, start_time):
+        """
+        logger: a Logger in case we need to report errors
+        graph_output_path : the path for the PNG we are creating
+        temperature_path: the temperature data, in the temperature log format, normally a PlotFeed's
+        profile_data_path: the profile data
+        state_path: the state data, in the state log format, normally a PlotFeed's
+        start_time: the start time of the graph, for the x-axis
+        """
+        self.logger = logger
+        self.graph_output_path = graph_output_path
+        self.temperature_path = temperature_path
+        self.profile_data_path = profile_data_path
+        self.state_path = state_path
+        self.start_seconds = seconds_of_day(start_time.strftime("%H:%M:%S"))
+        self.profile = None
+        self.end_seconds = None
+        self.base = None
+        self.pixels = None
+        self.temperatures = []
+        self.state = []
+        self.clip_left = 0
+        # Where the current picture was last written, if anywhere.
+        self.written_path = None
+
+    def path(self):
+        return self.graph_output_path
+
+    def set_path(self, graph_output_path):
+        """ Draw the graph at graph_output_path from now on."""
+        self.graph_output_path = graph_output_path
+
+    def close(self):
+        pass
+
+    def write(self, timeout = None):
+        """
+        Update the graph. timeout is ignored, since we don't wait for anything.
+        Returns True if the graph was written.
+        """
+        if not Path(self.temperature_path).is_file():
+            self.logger.error("RasterGraphWriter.write(): no temperature file yet")
+            return False
+        try:
+            temperatures = read_plot_data(self.temperature_path, self.start_seconds)
+            state = read_plot_data(self.state_path, self.start_seconds)
+            profile = read_plot_data(self.profile_data_path, self.start_seconds)
+        except OSError as e:
+            self.logger.error("RasterGraphWriter: " + str(e))
+            return False
+
+        starts = []
+        end_seconds = self.__end_seconds([temperatures, state, profile])
+        if end_seconds != self.end_seconds:
+            self.profile = profile
+            self.end_seconds = end_seconds
+            self.__draw_base()
+            self.pixels = bytearray(self.base)
+            self.temperatures = []
+            self.state = []
+            self.written_path = None
+        elif profile != self.profile:
+            # Only the base layer to the right of the change is different, so keep our pixels.
+            starts.append(RasterGraphWriter.__changed_from(self.profile, profile))
+            self.profile = profile
+            pixels = self.pixels
+            self.__draw_base()
+            self.pixels = pixels
+
+        # Everything from the start of the segment leading to the first changed row is redrawn.
+        starts.extend(RasterGraphWriter.__changed_from(old, new) for old, new in [(self.temperatures, temperatures), (self.state, state)])
+        starts = [s for s in starts if s is not None]
+        # A GraphHandOff moves the picture away once it has been written, so it may need writing again.
+        if len(starts) == 0 and self.written_path == self.graph_output_path and os.path.exists(self.graph_output_path):
+            return True
+
+        if len(starts) > 0:
+            self.__redraw_from(self.x(min(starts)), temperatures, state)
+        self.temperatures = temperatures
+        self.state = state
+
+        self.written_path = None
+        try:
+            self.__write_png()
+        except OSError as e:
+            self.logger.error("RasterGraphWriter: couldn't write " + self.graph_output_path + ": " + str(e))
+            return False
+        self.written_path = self.graph_output_path
+        return True
+
+    def x(self, seconds):
+        span = RasterGraphWriter.right - RasterGraphWriter.left
+        return RasterGraphWriter.left + round(seconds * span / self.end_seconds)
+
+    def y(self, temperature):
+        span = RasterGraphWriter.bottom - RasterGraphWriter.top
+        return RasterGraphWriter.bottom - round((temperature - RasterGraphWriter.low) * span / (RasterGraphWriter.high - RasterGraphWriter.low))
+
+    def __end_seconds(self, series):
+        """
+        Like gnuplot, the time axis goes to the tic after the last point of any of the data,
+        but it never gets shorter, and when it has to get longer it gets axis_growth times longer.
+        """
+        last = max([rows[-1][0] for rows in series if len(rows) > 0], default = 0)
+        if self.end_seconds is not None:
+            if last <= self.end_seconds:
+                return self.end_seconds
+            last = max(last, self.end_seconds * RasterGraphWriter.axis_growth)
+        tic = RasterGraphWriter.time_tic_seconds
+        return max(1, math.ceil(last / tic)) * tic
+
+    @staticmethod
+    def __changed_from(old, new):
+        """ The start of the segment leading to the first row of new that isn't in old, or None if they're the same."""
+        changed = first_difference(old, new)
+        if changed >= max(len(old), len(new)):
+            return None
+        return new[max(changed - 1, 0)][0] if len(new) > 0 else 0
+
+    def __draw_base(self):
+        g = RasterGraphWriter
+        self.pixels = bytearray([g.white]) * (g.width * g.height)
+        self.clip_left = 0
+
+        for temperature in range(g.low + (-g.low) % g.temperature_tic, g.high + 1, g.temperature_tic):
+            y = self.y(temperature)
+            self.__dotted_line(g.left, y, g.right, y)
+            self.__line(g.left, y, g.left + g.tic_length, y, g.black, 1)
+            self.__text(str(temperature), g.left - 3, y)
+        for seconds in range(0, self.end_seconds + 1, g.time_tic_seconds):
+            x = self.x(seconds)
+            self.__dotted_line(x, g.top, x, g.bottom)
+            self.__line(x, g.bottom, x, g.bottom - g.tic_length, g.black, 1)
+            self.__line(x, g.top, x, g.top + g.tic_length, g.black, 1)
+
+        self.__lines(self.profile, 0, g.brown, g.profile_line_width)
+
+        self.__line(g.left, g.top, g.right, g.top, g.black, 1)
+        self.__line(g.right, g.top, g.right, g.bottom, g.black, 1)
+        self.__line(g.right, g.bottom, g.left, g.bottom, g.black, 1)
+        self.__line(g.left, g.bottom, g.left, g.top, g.black, 1)
+        self.base = bytes(self.pixels)
+
+    def __redraw_from(self, clip_left, temperatures, state):
+        """ Copy the base layer back, from clip_left to the right hand side, and draw the data there again."""
+        g = RasterGraphWriter
+        clip_left = max(clip_left - g.target_line_width, g.left + 1)
+        for row in range(g.height):
+            start = row * g.width + clip_left
+            end = (row + 1) * g.width
+            self.pixels[start:end] = self.base[start:end]
+        self.clip_left = clip_left
+        self.__heater(state)
+        self.__lines(temperatures, 0, g.black, g.temperature_line_width)
+        self.__lines(state, 0, g.green, g.target_line_width)
+        self.clip_left = 0
+
+    def __heater(self, state):
+        g = RasterGraphWriter
+        full_height = (g.bottom - g.top) / g.heater_scale
+        for (t0, values0), (t1, values1) in zip(state, state[1:]):
+            if len(values0) < 2 or len(values1) < 2:
+                continue
+            x0 = self.x(t0)
+            x1 = self.x(t1)
+            if x1 < self.clip_left:
+                continue
+            for x in range(max(x0, self.clip_left), min(x1, g.right - 1) + 1):
+                fraction = 0 if x1 == x0 else (x - x0) / (x1 - x0)
+                heater = values0[1] + (values1[1] - values0[1]) * fraction
+                if heater > 0:
+                    top = max(g.bottom - round(heater * full_height), g.top + 1)
+                    for y in range(top, g.bottom):
+                        self.pixels[y * g.width + x] = g.orange
+
+    def __lines(self, rows, column, colour, width):
+        """ Join the points of one column of rows, leaving gaps where there is no value, as gnuplot does."""
+        for (t0, values0), (t1, values1) in zip(rows, rows[1:]):
+            if len(values0) <= column or len(values1) <= column:
+                continue
+            v0 = values0[column]
+            v1 = values1[column]
+            if math.isnan(v0) or math.isnan(v1):
+                continue
+            x1 = self.x(t1)
+            if x1 + width < self.clip_left:
+                continue
+            self.__line(self.x(t0), self.y(v0), x1, self.y(v1), colour, width)
+
+    def __line(self, x0, y0, x1, y1, colour, width):
+        """ Bresenham's line, with a width by width square pen, clipped to the plot."""
+        g = RasterGraphWriter
+        dx = abs(x1 - x0)
+        dy = -abs(y1 - y0)
+        sx = 1 if x0 < x1 else -1
+        sy = 1 if y0 < y1 else -1
+        error = dx + dy
+        pen = range(-(width // 2), width - width // 2)
+        left = max(g.left, self.clip_left)
+        pixels = self.pixels
+        while True:
+            for py in pen:
+                y = y0 + py
+                if g.top <= y <= g.bottom:
+                    for px in pen:
+                        x = x0 + px
+                        if left <= x <= g.right:
+                            pixels[y * g.width + x] = colour
+            if x0 == x1 and y0 == y1:
+                return
+            e2 = 2 * error
+            if e2 >= dy:
+                error = error + dy
+                x0 = x0 + sx
+            if e2 <= dx:
+                error = error + dx
+                y0 = y0 + sy
+
+    def __dotted_line(self, x0, y0, x1, y1):
+        g = RasterGraphWriter
+        if y0 == y1:
+            for x in range(x0, x1 + 1, 2):
+                self.pixels[y0 * g.width + x] = g.grey
+        else:
+            for y in range(y0, y1 + 1, 2):
+                self.pixels[y * g.width + x0] = g.grey
+
+    def __text(self, text, right, middle):
+        """ Draw text, right justified to x = right and centred on y = middle."""
+        g = RasterGraphWriter
+        x = right - len(text) * 6 + 1
+        top = middle - 3
+        for character in text:
+            for row, bits in enumerate(digit_font[character]):
+                for column, bit in enumerate(bits):
+                    if bit == "1":
+                        self.pixels[(top + row) * g.width + x + column] = g.black
+            x = x + 6
+
+    def __write_png(self):
+        g = RasterGraphWriter
+        rows = b"".join(b"\x00" + self.pixels[y * g.width:(y + 1) * g.width] for y in range(g.height))
+        palette = b"".join(bytes(colour) for colour in g.palette)
+        png = (b"\x89PNG\r\n\x1a\n"
+               + RasterGraphWriter.__chunk(b"IHDR", struct.pack(">IIBBBBB", g.width, g.height, 8, 3, 0, 0, 0))
+               + RasterGraphWriter.__chunk(b"PLTE", palette)
+               + RasterGraphWriter.__chunk(b"IDAT", zlib.compress(rows, 6))
+               + RasterGraphWriter.__chunk(b"IEND", b""))
+        temporary_path = self.graph_output_path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(png)
+        os.replace(temporary_path, self.graph_output_path)
+
+    @staticmethod
+    def __chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
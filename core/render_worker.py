@@ -0,0 +1,231 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+The graph process.
+
+Drawing the graph, with gnuplot or in Python, takes far longer than
+controlling the heater, and in the core's process it would compete with
+the control thread for the GIL. So the graph can be drawn in a process
+of its own, which follows the run through the core's TelemetryRing, keeps
+its own PlotFeed, and draws and hands off the graph when asked.
+
+The core talks to it over its stdin and stdout, like gnuplot: one JSON
+command per line in, and messages for the GUI (e.g. 'image ...') out,
+which the core passes on.
+
+    python3 render_worker.py RING_NAME LOG_FOLDER [--cpus 0,1,2]
+
+RenderProcess and ProcessGraphWriter are the core's side of it.
+"""
+
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+
+import stats
+
+from graph_writer import GraphWriter, GraphHandOff
+from logger import Logger
+from plot_feed import PlotFeed
+from raster_graph import RasterGraphWriter
+from scheduling import pin_to_cpus, parse_cpus
+from telemetry import TelemetryRing
+from worker_process import WorkerProcess, answer_stats
+
+
+start_time_format = "%Y-%m-%d %H:%M:%S"
+
+
+class RenderWorker:
+    """ The graph process's side: draw the graph for the current run, when asked."""
+
+    render_timeout_seconds = 20
+
+    def __init__(self, ring, logger, output = sys.stdout):
+        self.ring = ring
+        self.logger = logger
+        self.output = output
+        self.feed = None
+        self.writer = None
+        self.hand_off = None
+        self.next_record = 0
+        self.run = None
+
+    def handle(self, command):
+        name = command.get("command")
+        if name == "start":
+            self.start(command)
+        elif name == "stats":
+            answer_stats(command, self.send)
+        elif command.get("run") != self.run:
+            # For a run that has already been replaced, e.g. the old run closing after the new one started.
+            pass
+        elif name == "write":
+            self.write()
+        elif name == "close":
+            if command.get("final", False):
+                self.write()
+            self.close()
+        else:
+            self.logger.error("RenderWorker: unknown command " + str(name))
+
+    def start(self, command):
+        """ A new run. The command has the run's folder, and everything needed to draw its graph."""
+        self.close()
+        folder = command["folder"]
+        start_time = datetime.strptime(command["start_time"], start_time_format)
+        self.feed = PlotFeed(command["run_folder"])
+        if command["renderer"] == "raster":
+            self.writer = RasterGraphWriter(self.logger, folder + "graph.png", self.feed.temperature_path, command["profile_data_path"], self.feed.state_path, start_time)
+        else:
+            self.writer = GraphWriter(self.logger, folder + "graph.png", command["gnuplot_command_file"], self.feed.temperature_path, command["profile_data_path"], self.feed.state_path, start_time)
+        self.hand_off = GraphHandOff(folder, command.get("keep_path"))
+        self.next_record = command["from"]
+        self.run = command["run"]
+
+    def write(self):
+        if self.writer is None:
+            return
+        records, self.next_record, lost = self.ring.read(self.next_record)
+        if lost > 0:
+            self.logger.error("RenderWorker: lost " + str(lost) + " samples")
+        for timestamp, average, target, heater_is_on, pump_is_on, temperatures in records:
+            self.feed.add(timestamp, average, target, heater_is_on, pump_is_on)
+        self.feed.write()
+        self.writer.set_path(self.hand_off.next_path())
+        started = stats.start()
+        written = self.writer.write(RenderWorker.render_timeout_seconds)
+        stats.stop("graph.write", started)
+        if written:
+            try:
+                path = self.hand_off.publish(self.writer.path())
+            except OSError as e:
+                self.logger.error("RenderWorker: couldn't hand off the graph: " + str(e))
+                return
+            if path is not None:
+                self.send("image " + path)
+
+    def send(self, line):
+        """ Send line to the core, which passes messages on to the GUI."""
+        self.output.write(line + "\n")
+        self.output.flush()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                self.hand_off.close()
+            except OSError as e:
+                self.logger.error("RenderWorker: couldn't keep the graph: " + str(e))
+        self.feed = None
+        self.writer = None
+        self.hand_off = None
+        self.run = None
+
+
+class ProcessGraphWriter:
+    """
+    The core's graph for one run, drawn by the graph process.
+    It has the same write(), close() and path() as BackgroundGraphWriter,
+    so it can belong to an Activity in the same way.
+    """
+    def __init__(self, render_process, run, graph_path):
+        self.render_process = render_process
+        self.run = run
+        self.graph_path = graph_path
+
+    def path(self):
+        return self.graph_path
+
+    def write(self):
+        """ Ask for the graph to be updated. Never waits."""
+        self.render_process.send({"command": "write", "run": self.run})
+
+    def close(self, final_write = False, timeout = 1):
+        """ timeout is ignored, since we don't wait for the graph process."""
+        self.render_process.send({"command": "close", "run": self.run, "final": final_write})
+        if self.render_process.current_run is not None and self.render_process.current_run["run"] == self.run:
+            self.render_process.current_run = None
+
+
+class RenderProcess(WorkerProcess):
+    """
+    The core's side of the graph process.
+
+    If the process stops, the new one is told about the current run again.
+    What it writes to stdout is passed on to the GUI.
+    """
+
+    worker_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "render_worker.py")
+
+    def __init__(self, logger, event_loop, ring, log_folder, cpus = None):
+        """
+        logger: a Logger in case we need to report errors
+        event_loop: the EventLoop that reads the process's output
+        ring: the TelemetryRing the run is recorded in
+        log_folder: where the process should write its log
+        cpus: the CPUs the process should run on, or None for any
+        """
+        arguments = [ring.name, log_folder]
+        if cpus is not None:
+            arguments = arguments + ["--cpus", ",".join(str(c) for c in sorted(cpus))]
+        super().__init__("graph process", RenderProcess.worker_path, arguments, logger, event_loop)
+        self.ring = ring
+        self.current_run = None
+        self.runs = 0
+
+    def graph_writer(self, run_folder, folder, keep_path, profile_data_path, start_time, renderer, gnuplot_command_file):
+        """
+        Tell the process about a new run, and get the run's graph writer.
+        run_folder: where the process should write its PlotFeed
+        folder: where it should draw and hand off the graph
+        keep_path: where the last graph should be kept
+        """
+        self.runs = self.runs + 1
+        self.current_run = {
+            "command": "start",
+            "run": self.runs,
+            "run_folder": run_folder,
+            "folder": folder,
+            "keep_path": keep_path,
+            "profile_data_path": profile_data_path,
+            "start_time": start_time.strftime(start_time_format),
+            "renderer": renderer,
+            "gnuplot_command_file": gnuplot_command_file,
+            "from": self.ring.written(),
+        }
+        self.send(self.current_run)
+        return ProcessGraphWriter(self, self.runs, folder + "graph.png")
+
+    def missed(self):
+        return [] if self.current_run is None else [self.current_run]
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Draw the Mash-o-matiC graph in its own process")
+    parser.add_argument("ring", help = "the name of the core's TelemetryRing")
+    parser.add_argument("log_folder")
+    parser.add_argument("--cpus", help = "the CPUs to run on, e.g. 0,1,2")
+    arguments = parser.parse_args()
+
+    logger = Logger(arguments.log_folder + "render", initial_log = "Mash-o-matiC graph process")
+    if arguments.cpus is not None:
+        pin_to_cpus(parse_cpus(arguments.cpus), logger)
+    ring = TelemetryRing.attach(arguments.ring)
+    worker = RenderWorker(ring, logger)
+    try:
+        for line in sys.stdin:
+            try:
+                worker.handle(json.loads(line))
+            except (ValueError, KeyError, RuntimeError, OSError) as e:
+                logger.error("RenderWorker: " + repr(e) + " handling " + line.strip())
+    finally:
+        worker.close()
+        ring.close()
+
+
+if __name__ == "__main__":
+    main()
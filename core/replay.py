@@ -0,0 +1,282 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+Replay a recorded run through the core.
+
+The temperatures recorded in a run folder (from run.bin if there is one,
+otherwise from the temperature CSV log) are fed back through the Core, its
+Activity, the heater and pump control and the logging, on a VirtualClock.
+The replayed run is written to a new run folder, with its own state log,
+temperature log, run log and graph, so the behaviour and the speed of the
+core can be compared between versions.
+
+    python3 replay.py RUN_FOLDER [--speed N] [--output FOLDER] [--messages]
+
+By default the run is replayed as fast as possible; --speed 60 replays an
+hour in a minute. A hold is replayed with the same set point changes, at
+the same times, as the recorded run.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from fake_hardware import install_stub_gpio
+install_stub_gpio()
+
+import clock
+import core
+import utils
+from graph_writer import BackgroundGraphWriter
+from logger import TemperatureLogger
+from profile import json_from_file
+from run_catalogue import parse_run_folder_name, read_temperature_csv
+from run_log import RunLogReader
+from sample_history import SampleHistory
+from temperature_reader import TemperatureReader
+
+
+repository_folder = str(Path(__file__).resolve().parent.parent) + "/"
+
+
+class ReplayTemperatureReader:
+    """ Stands in for TemperatureReader, giving the core the recorded temperatures."""
+    def __init__(self, names):
+        self.names = list(names)
+        self.histories = [SampleHistory(TemperatureReader.history_size) for n in self.names]
+        self.values = []
+        self.timestamp = None
+
+    def feed(self, values):
+        self.timestamp = clock.monotonic()
+        self.values = list(values)
+        for history, value in zip(self.histories, self.values):
+            history.add(self.timestamp, value)
+
+    def start(self):
+        pass
+
+    def temperatures(self):
+        return list(self.values)
+
+    def samples(self):
+        return [(self.timestamp, v) for v in self.values]
+
+    def sample_age(self):
+        return None if self.timestamp is None else clock.monotonic() - self.timestamp
+
+    def snapshots(self):
+        return [h.snapshot() for h in self.histories]
+
+    def sensor_names(self):
+        return list(self.names)
+
+
+class StderrLogger:
+    def log(self, text):
+        pass
+
+    def error(self, text):
+        sys.stderr.write(text + "\n")
+
+
+def recorded_samples(folder):
+    """
+    Get the sensor names, the time of each sample and the sensor values for
+    each sample, from the run log if there is one, otherwise from the CSV log.
+    """
+    folder_path = Path(folder)
+    if (folder_path / "run.bin").is_file():
+        reader = RunLogReader(str(folder_path / "run.bin"))
+        names = reader.sensor_names()
+        times = reader.column("Time").tolist()
+        columns = [reader.column(n).tolist() for n in names]
+        reader.close()
+        return names, times, [list(values) for values in zip(*columns)]
+    run_type, stem, start = parse_run_folder_name(folder_path.name)
+    names, times, rows = read_temperature_csv(folder_path, start)
+    # The first column of the CSV is the average, which the core works out for itself,
+    # and there may be window columns after the sensors.
+    sensor_count = len(names) - 1
+    if names[-len(TemperatureLogger.window_columns):] == TemperatureLogger.window_columns:
+        sensor_count = sensor_count - len(TemperatureLogger.window_columns)
+    return names[1:1 + sensor_count], times, [row[1:1 + sensor_count] for row in rows]
+
+
+def hold_set_points(folder):
+    """
+    Get (seconds, temperature) for the start of a recorded hold, and for
+    each time its set point was changed, from its profile.json.
+    """
+    profile = json_from_file(str(Path(folder) / "profile.json"), StderrLogger())
+    set_points = []
+    seconds = 0
+    for step in [] if profile is None else profile.get("steps", []):
+        if "start" in step:
+            set_points.append((seconds, step["start"]))
+        if "jump" in step:
+            set_points.append((seconds, step["jump"]))
+        if "rest" in step:
+            seconds = seconds + step["rest"] * 60
+    return set_points
+
+
+def preset_profile(folder):
+    """ The copy of its profile that a preset run keeps in its folder."""
+    for path in Path(folder).glob("*.json"):
+        return str(path)
+    return None
+
+
+class Replay:
+    """
+    Drive a Core with a VirtualClock, feeding it recorded samples.
+
+    The recorded core logged the mean of the samples over each log period,
+    so each recorded sample is fed in sample_lag_seconds after the one
+    before it was logged, and is what the sensors read for the whole of
+    the next log period. So the replayed core logs the same mean, and a
+    replay of a replay is the same as the replay.
+    """
+
+    # Less than the control period, so no control cycle is missed, but
+    # enough to be after the log timer, even if it was a little late.
+    sample_lag_seconds = 0.5
+
+    def __init__(self, the_core, virtual_clock, reader, speed = None):
+        """ speed: how many times faster than real time to run, or None for as fast as possible."""
+        self.core = the_core
+        self.clock = virtual_clock
+        self.reader = reader
+        self.speed = speed
+        self.real_start = time.monotonic()
+
+    def run(self, times, rows, start_run, changes):
+        """
+        times, rows: the recorded samples
+        start_run: called to start the run, after the first sample has been fed in
+        changes: (seconds, callable) to call at those times into the run
+        """
+        first = times[0]
+        self.reader.feed(rows[0])
+        with utils.message_batch():
+            start_run()
+        self.core.start_timers(control_timer = True)
+        changes = sorted(changes, key = lambda c: c[0])
+        for previous_time, values in zip(times, rows[1:]):
+            at = previous_time - first + Replay.sample_lag_seconds
+            while len(changes) > 0 and changes[0][0] <= at:
+                self.advance_to(changes[0][0])
+                with utils.message_batch():
+                    changes.pop(0)[1]()
+            self.advance_to(at)
+            self.reader.feed(values)
+        self.advance_to(self.clock.monotonic() + self.core.log_period)
+
+    def advance_to(self, target):
+        """ Move the clock on to target, running the core's timers as they fall due."""
+        while True:
+            deadline = self.core.event_loop.next_deadline()
+            if deadline is None or deadline > target:
+                break
+            self.__wait_until(deadline)
+            self.clock.advance_to(deadline)
+            self.core.event_loop.run_due_timers()
+        self.__wait_until(target)
+        self.clock.advance_to(target)
+
+    def __wait_until(self, virtual_time):
+        if self.speed is not None:
+            wait = self.real_start + virtual_time / self.speed - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+
+
+def replay(folder, installation, speed = None, controller_name = None):
+    """
+    Replay the run in folder, writing a new run into installation, with the
+    named controller (see control.py), or the default. Returns the new run folder.
+    """
+    folder = folder if folder.endswith("/") else folder + "/"
+    parsed = parse_run_folder_name(Path(folder).name)
+    if parsed is None:
+        raise RuntimeError(folder + " isn't a run folder")
+    run_type = parsed[0]
+    names, times, rows = recorded_samples(folder)
+    if len(times) == 0:
+        raise RuntimeError(folder + " has no samples")
+
+    virtual_clock = clock.VirtualClock(datetime.fromtimestamp(times[0]))
+    clock.set_clock(virtual_clock)
+    reader = ReplayTemperatureReader(names)
+    the_core = core.Core(installation, temperature_reader = reader)
+    the_replay = Replay(the_core, virtual_clock, reader, speed)
+
+    if run_type == "hold":
+        set_points = hold_set_points(folder)
+        if len(set_points) == 0:
+            raise RuntimeError(folder + " has no hold profile")
+        start_run = lambda: the_core.hold(set_points[0][1], controller_name)
+        changes = [(seconds, lambda t = temperature: the_core.hold(t)) for seconds, temperature in set_points[1:]]
+    else:
+        profile_path = preset_profile(folder)
+        if profile_path is None:
+            raise RuntimeError(folder + " has no preset profile")
+        start_run = lambda: the_core.preset(profile_path, controller_name)
+        changes = []
+
+    the_replay.run(times, rows, start_run, changes)
+
+    run_folder = the_core.run_folder
+    if the_core.activity.graph is not None:
+        the_core.plot_feed.write()
+        the_core.activity.graph.close(final_write = True, timeout = BackgroundGraphWriter.render_timeout_seconds)
+    the_core.go_to_idle()
+    the_core.close_finished_graphs()
+    the_core.catalogue.close()
+    clock.set_clock(clock.SystemClock())
+    return run_folder
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Replay a recorded Mash-o-matiC run")
+    parser.add_argument("folder", help = "the run folder to replay")
+    parser.add_argument("--speed", type = float, help = "times faster than real time, rather than as fast as possible")
+    parser.add_argument("--output", help = "the installation folder to write the replayed run to, rather than a temporary one")
+    parser.add_argument("--controller", help = "the heater controller to use, e.g. predictive")
+    parser.add_argument("--graph", choices = ["gnuplot", "raster"], default = core.Core.graph_renderer, help = "how to draw the graph")
+    parser.add_argument("--messages", action = "store_true", help = "write the messages for the GUI to stdout")
+    arguments = parser.parse_args()
+    core.Core.graph_renderer = arguments.graph
+
+    installation = arguments.output if arguments.output is not None else tempfile.mkdtemp(prefix = "mash-replay-")
+    installation = installation if installation.endswith("/") else installation + "/"
+    Path(installation).mkdir(parents=True, exist_ok=True)
+    if not Path(installation + "graph.plt").is_file():
+        shutil.copy(repository_folder + "target/graph.plt", installation + "graph.plt")
+
+    with open(os.devnull, "w") as null:
+        if not arguments.messages:
+            utils.message_writer.output = null
+        start = time.perf_counter()
+        try:
+            run_folder = replay(arguments.folder, installation, arguments.speed, arguments.controller)
+        except RuntimeError as e:
+            sys.stderr.write(str(e) + "\n")
+            sys.exit(1)
+        finally:
+            utils.flush_messages()
+        elapsed = time.perf_counter() - start
+
+    sys.stderr.write("Replayed {0} in {1:.2f}s\n".format(arguments.folder, elapsed))
+    print(run_folder)
+
+
+if __name__ == "__main__":
+    main()
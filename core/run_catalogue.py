@@ -0,0 +1,224 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+RunCatalogue class
+"""
+
+import json
+import math
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+from os import scandir
+from pathlib import Path
+
+from run_log import RunLogReader
+
+
+def parse_run_folder_name(name):
+    """
+    Split a run folder name, e.g. "preset_Wheat-beer_2021-03-20_101500",
+    into its type ("hold" or "preset"), profile stem and start time.
+    Returns None if the name isn't one of ours.
+    """
+    parts = name.split("_")
+    if len(parts) < 3 or parts[0] not in ["hold", "preset"]:
+        return None
+    try:
+        start = datetime.strptime(parts[-2] + "_" + parts[-1], "%Y-%m-%d_%H%M%S")
+    except ValueError:
+        return None
+    return parts[0], "_".join(parts[1:-2]), start
+
+
+def summarise_run_folder(folder):
+    """
+    Summarise the run in folder, from its binary run log if it has one,
+    otherwise from its temperature CSV log.
+    Returns a dictionary with the columns of the catalogue, or None if
+    the folder isn't a run.
+    """
+    folder_path = Path(folder)
+    parsed = parse_run_folder_name(folder_path.name)
+    if parsed is None:
+        return None
+    run_type, stem, start = parsed
+    summary = {
+        "folder": str(folder_path),
+        "type": run_type,
+        "profile": profile_name(folder_path, run_type, stem),
+        "start": start.timestamp(),
+        "end": start.timestamp(),
+        "samples": 0,
+        "minimum": None,
+        "maximum": None,
+        "mean": None,
+    }
+    if (folder_path / "run.bin").is_file():
+        times, temperatures = samples_from_run_log(folder_path / "run.bin")
+    else:
+        times, temperatures = samples_from_csv(folder_path, start)
+    if len(times) > 0:
+        summary["start"] = times[0]
+        summary["end"] = times[-1]
+    finite = [t for t in temperatures if not math.isnan(t)]
+    summary["samples"] = len(temperatures)
+    if len(finite) > 0:
+        summary["minimum"] = min(finite)
+        summary["maximum"] = max(finite)
+        summary["mean"] = math.fsum(finite) / len(finite)
+    summary["duration"] = summary["end"] - summary["start"]
+    return summary
+
+
+def profile_name(folder_path, run_type, stem):
+    if run_type == "hold":
+        return "Hold"
+    for path in folder_path.glob("*.json"):
+        try:
+            with open(path) as f:
+                return json.load(f)["name"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    return stem
+
+
+def samples_from_run_log(path):
+    reader = RunLogReader(str(path))
+    times = reader.column("Time").tolist()
+    temperatures = reader.column("Average").tolist()
+    reader.close()
+    return times, temperatures
+
+
+def samples_from_csv(folder_path, start):
+    names, times, rows = read_temperature_csv(folder_path, start)
+    return times, [row[0] for row in rows]
+
+
+def read_temperature_csv(folder_path, start):
+    """
+    Read the temperature CSV log in folder_path.
+    The CSV logs only have the time of day, so count days from the start of the run.
+    Returns the names of the columns after Time, the time of each sample,
+    and the values for each sample. A sensor value that can't be read is NaN.
+    """
+    names = []
+    times = []
+    rows = []
+    for path in folder_path.glob("temperature_*.log"):
+        with open(path) as f:
+            names = [n.strip() for n in f.readline().split(",")[1:]]
+            day = start.replace(hour = 0, minute = 0, second = 0)
+            previous = None
+            for line in f:
+                parts = line.split(",")
+                try:
+                    time_of_day = datetime.strptime(parts[0].strip(), "%H:%M:%S")
+                    temperature = float(parts[1])
+                except (ValueError, IndexError):
+                    continue
+                sample_time = day.replace(hour = time_of_day.hour, minute = time_of_day.minute, second = time_of_day.second)
+                if previous is not None and sample_time < previous:
+                    day = day + timedelta(days = 1)
+                    sample_time = sample_time + timedelta(days = 1)
+                previous = sample_time
+                times.append(sample_time.timestamp())
+                rows.append([temperature] + [float_or_nan(p) for p in parts[2:]])
+    return names, times, rows
+
+
+def float_or_nan(text):
+    try:
+        return float(text)
+    except ValueError:
+        return math.nan
+
+
+class RunCatalogue:
+    """
+    An index of the run folders, kept in an SQLite database, so we can find
+    old runs without listing the folders and reading their logs.
+
+    Each run is added when it finishes. If the database is new, or lost,
+    rebuild() recreates it by scanning the runs folder.
+    """
+
+    columns = ["folder", "type", "profile", "start", "end", "duration", "samples", "minimum", "maximum", "mean"]
+
+    def __init__(self, database_path, runs_folder, logger):
+        self.runs_folder = runs_folder
+        self.logger = logger
+        Path(runs_folder).mkdir(parents=True, exist_ok=True)
+        is_new = not Path(database_path).is_file()
+        self.database = sqlite3.connect(database_path)
+        self.database.execute("""
+            CREATE TABLE IF NOT EXISTS runs (
+                folder TEXT PRIMARY KEY,
+                type TEXT,
+                profile TEXT,
+                start REAL,
+                end REAL,
+                duration REAL,
+                samples INTEGER,
+                minimum REAL,
+                maximum REAL,
+                mean REAL)""")
+        self.database.execute("CREATE INDEX IF NOT EXISTS runs_by_start ON runs (start)")
+        self.database.commit()
+        if is_new:
+            self.rebuild()
+
+    def close(self):
+        self.database.close()
+
+    def add(self, folder):
+        """ Add, or update, the run in folder."""
+        try:
+            summary = summarise_run_folder(folder)
+        except (OSError, RuntimeError) as e:
+            self.logger.error("RunCatalogue: couldn't summarise " + str(folder) + ": " + str(e))
+            return
+        if summary is not None:
+            self.__insert([summary])
+            self.database.commit()
+
+    def rebuild(self):
+        """ Recreate the catalogue from what is in the runs folder."""
+        summaries = []
+        with scandir(self.runs_folder) as it:
+            for entry in it:
+                if entry.is_dir():
+                    try:
+                        summary = summarise_run_folder(entry.path)
+                    except (OSError, RuntimeError) as e:
+                        self.logger.error("RunCatalogue: couldn't summarise " + entry.path + ": " + str(e))
+                        continue
+                    if summary is not None:
+                        summaries.append(summary)
+        self.database.execute("DELETE FROM runs")
+        self.__insert(summaries)
+        self.database.commit()
+        return len(summaries)
+
+    def recent(self, count = 10):
+        """ The most recent runs, newest first, as dictionaries."""
+        rows = self.database.execute("SELECT " + ", ".join(RunCatalogue.columns) + " FROM runs ORDER BY start DESC LIMIT ?", (count,))
+        return [dict(zip(RunCatalogue.columns, row)) for row in rows]
+
+    def __insert(self, summaries):
+        placeholders = ", ".join([":" + c for c in RunCatalogue.columns])
+        self.database.executemany("INSERT OR REPLACE INTO runs VALUES (" + placeholders + ")", summaries)
+
+
+if __name__ == "__main__":
+    class StderrLogger:
+        def error(self, text):
+            sys.stderr.write(text + "\n")
+
+    runs_folder = sys.argv[1] if len(sys.argv) > 1 else "/opt/mash-o-matic/runs/"
+    catalogue = RunCatalogue(str(Path(runs_folder) / "catalogue.sqlite"), runs_folder, StderrLogger())
+    print(str(catalogue.rebuild()) + " runs")
+    for run in catalogue.recent(20):
+        print(run)
@@ -0,0 +1,183 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+Binary run log
+
+A compact, append only record of a run, alongside the CSV logs.
+
+The file starts with a header:
+    8 bytes     magic, "MASHRUN1"
+    4 bytes     header length in bytes, including the magic (little endian uint32)
+    4 bytes     number of sensors (little endian uint32)
+    JSON        {"columns": [...]}, space padded so the header is a multiple of 8 bytes
+Then fixed width records, each of which is a little endian float64 for each column:
+    time (seconds since the epoch), average, one per sensor, [minimum, maximum,] target, heater, pump
+The minimum and maximum of the average over each logging window are only
+there if the header lists them.
+
+Because every value is a float64 and the records start on an 8 byte
+boundary, the file can be mapped straight into memory and viewed as a
+table of doubles, without parsing or copying.
+
+To regenerate the CSV logs:
+    python3 run_log.py path/to/run.bin [output_folder] [--window-columns]
+"""
+
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from pathlib import Path
+
+
+magic = b"MASHRUN1"
+fixed_header = struct.Struct("<8sII")
+
+
+window_columns = ["Minimum", "Maximum"]
+
+
+def column_names(sensor_names, with_window_columns = False):
+    window = window_columns if with_window_columns else []
+    return ["Time", "Average"] + list(sensor_names) + window + ["Target", "Heater", "Pump"]
+
+
+class RunLogWriter:
+    """ Append records to a binary run log."""
+    def __init__(self, path, sensor_names, with_window_columns = False):
+        self.path = path
+        self.with_window_columns = with_window_columns
+        self.columns = column_names(sensor_names, with_window_columns)
+        self.record = struct.Struct("<" + str(len(self.columns)) + "d")
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(RunLogWriter.__header(self.columns, len(sensor_names)))
+            self.file.flush()
+
+    @staticmethod
+    def __header(columns, sensor_count):
+        description = json.dumps({"columns": columns}).encode()
+        length = fixed_header.size + len(description)
+        padding = (8 - length % 8) % 8
+        return fixed_header.pack(magic, length + padding, sensor_count) + description + b" " * padding
+
+    def append(self, timestamp, average, temperatures, target, heater_is_on, pump_is_on, window = None):
+        """ window: (minimum, maximum) of the average over the logging window."""
+        values = [timestamp, average] + list(temperatures)
+        if self.with_window_columns:
+            values = values + (list(window) if window is not None else [average, average])
+        values = values + [target, 1 if heater_is_on else 0, 1 if pump_is_on else 0]
+        self.file.write(self.record.pack(*values))
+
+    def flush(self):
+        self.file.flush()
+
+    def checkpoint(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if not self.file.closed:
+            self.checkpoint()
+            self.file.close()
+
+
+class RunLogReader:
+    """
+    Read a binary run log through a memory map.
+
+    column() gives a strided memoryview onto the mapped file, and numpy()
+    gives a 2D array (one row per record) that also shares the mapping,
+    so neither copies the data.
+    Only whole records that were in the file when it was opened (or last
+    refresh()ed) are visible. Views must be released before refresh() or close().
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        header = self.file.read(fixed_header.size)
+        file_magic, self.header_size, self.sensor_count = fixed_header.unpack(header)
+        if file_magic != magic:
+            raise RuntimeError(path + " is not a run log")
+        description = self.file.read(self.header_size - fixed_header.size)
+        self.columns = json.loads(description.decode())["columns"]
+        self.width = len(self.columns)
+        self.record = struct.Struct("<" + str(self.width) + "d")
+        self.map = None
+        self.refresh()
+
+    def refresh(self):
+        """ Map the file again, to see records added since it was opened."""
+        self.close_map()
+        self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        self.count = (len(self.map) - self.header_size) // self.record.size
+
+    def close_map(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def close(self):
+        self.close_map()
+        self.file.close()
+
+    def __len__(self):
+        return self.count
+
+    def sensor_names(self):
+        return self.columns[2:2 + self.sensor_count]
+
+    def records(self):
+        """ Iterate over the records as tuples."""
+        end = self.header_size + self.count * self.record.size
+        return self.record.iter_unpack(memoryview(self.map)[self.header_size:end])
+
+    def values(self):
+        """ All the values, as one flat memoryview of doubles."""
+        end = self.header_size + self.count * self.record.size
+        return memoryview(self.map)[self.header_size:end].cast("d")
+
+    def column(self, name):
+        """ A memoryview of one column, e.g. "Average"."""
+        return self.values()[self.columns.index(name)::self.width]
+
+    def numpy(self):
+        import numpy
+        return numpy.frombuffer(self.map, dtype = "<f8", count = self.count * self.width, offset = self.header_size).reshape(self.count, self.width)
+
+
+def csv_time(timestamp):
+    return time.strftime("%H:%M:%S", time.localtime(timestamp))
+
+
+def write_csv(run_log_path, temperature_log_path, state_log_path, with_window_columns = False):
+    """
+    Write the temperature and state CSV logs, in the same format as the Loggers, from a binary run log.
+    with_window_columns: include the window columns in the temperature log, if the run log has them.
+    """
+    reader = RunLogReader(run_log_path)
+    # The average and the sensors, and then any window columns, which are the rest up to the target.
+    last = len(reader.columns) - 3 if with_window_columns else 2 + reader.sensor_count
+    temperature_columns = range(1, last)
+    with open(temperature_log_path, "w") as temperatures, open(state_log_path, "w") as state:
+        temperatures.write("Time, " + ", ".join(reader.columns[i] for i in temperature_columns) + "\n")
+        state.write("Time, Target, Heater, Pump\n")
+        for record in reader.records():
+            time_text = csv_time(record[0]) + ", "
+            temperatures.write(time_text + ", ".join(str(record[i]) for i in temperature_columns) + "\n")
+            target, heater, pump = record[-3:]
+            state.write(time_text + ", ".join(map(str, [target, int(heater), int(pump)])) + "\n")
+    reader.close()
+
+
+if __name__ == "__main__":
+    arguments = [a for a in sys.argv[1:] if a != "--window-columns"]
+    if len(arguments) < 1:
+        sys.stderr.write("usage: run_log.py run.bin [output_folder] [--window-columns]\n")
+        sys.exit(1)
+    folder = arguments[1] if len(arguments) > 1 else str(Path(arguments[0]).parent)
+    folder = folder if folder.endswith("/") else folder + "/"
+    write_csv(arguments[0], folder + "temperature.log", folder + "state.log", "--window-columns" in sys.argv)
@@ -0,0 +1,136 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+SampleHistory class
+"""
+
+import math
+import statistics
+import threading
+from array import array
+from bisect import bisect_left
+
+
+class Snapshot:
+    """
+    An immutable, oldest first, copy of the samples in a SampleHistory,
+    with statistics over the most recent samples.
+
+    Every statistic takes an optional window: only samples taken in the
+    last 'seconds' (counting back from the newest sample) are used.
+    With no window, all the samples are used.
+    Statistics of no samples are NaN.
+    """
+    def __init__(self, times, values):
+        self.times = times
+        self.values = values
+
+    def __len__(self):
+        return len(self.times)
+
+    def latest(self):
+        """ The newest (timestamp, value), or None if there are no samples."""
+        if len(self.times) == 0:
+            return None
+        return self.times[-1], self.values[-1]
+
+    def age(self, now):
+        """ How old the newest sample is at time 'now', or infinity if there are no samples."""
+        if len(self.times) == 0:
+            return math.inf
+        return now - self.times[-1]
+
+    def window(self, seconds = None):
+        """ Get (times, values) for the samples in the window."""
+        if seconds is None or len(self.times) == 0:
+            return self.times, self.values
+        first = bisect_left(self.times, self.times[-1] - seconds)
+        return self.times[first:], self.values[first:]
+
+    def mean(self, seconds = None):
+        times, values = self.window(seconds)
+        if len(values) == 0:
+            return math.nan
+        return math.fsum(values) / len(values)
+
+    def median(self, seconds = None):
+        times, values = self.window(seconds)
+        if len(values) == 0:
+            return math.nan
+        return statistics.median(values)
+
+    def trimmed_mean(self, seconds = None, proportion = 0.1):
+        """ The mean, ignoring 'proportion' of the samples at each end of the range of values."""
+        times, values = self.window(seconds)
+        if len(values) == 0:
+            return math.nan
+        ordered = sorted(values)
+        trim = int(len(ordered) * proportion)
+        if trim > 0 and len(ordered) > 2 * trim:
+            ordered = ordered[trim:-trim]
+        return math.fsum(ordered) / len(ordered)
+
+    def slope(self, seconds = None):
+        """ The least squares rate of change, in units per minute."""
+        times, values = self.window(seconds)
+        n = len(values)
+        if n < 2:
+            return math.nan
+        mean_time = math.fsum(times) / n
+        mean_value = math.fsum(values) / n
+        covariance = math.fsum((t - mean_time) * (v - mean_value) for t, v in zip(times, values))
+        variance = math.fsum((t - mean_time) ** 2 for t in times)
+        if variance == 0:
+            return math.nan
+        return 60 * covariance / variance
+
+
+class SampleHistory:
+    """
+    A fixed size ring buffer of (timestamp, value) samples.
+
+    The samples are kept in arrays, so there's no per-sample object.
+    One thread adds samples, which only stores them. The newest sample is
+    published by replacing a single reference, so latest() never waits.
+    snapshot() makes the oldest first copy when it's asked for, at most
+    once per new sample however many threads ask, under a lock that add()
+    only holds while it stores a sample.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array("d", bytes(8 * capacity))
+        self.values = array("d", bytes(8 * capacity))
+        self.next = 0
+        self.count = 0
+        self.lock = threading.Lock()
+        self.newest = None
+        self.published = Snapshot(array("d"), array("d"))
+
+    def add(self, timestamp, value):
+        with self.lock:
+            self.times[self.next] = timestamp
+            self.values[self.next] = value
+            self.next = (self.next + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+            self.published = None
+        self.newest = (timestamp, value)
+
+    def latest(self):
+        """ The newest (timestamp, value), or None if there are no samples."""
+        return self.newest
+
+    def snapshot(self):
+        published = self.published
+        if published is None:
+            with self.lock:
+                if self.published is None:
+                    self.published = self.__oldest_first()
+                published = self.published
+        return published
+
+    def __oldest_first(self):
+        if self.count < self.capacity:
+            return Snapshot(self.times[:self.count], self.values[:self.count])
+        return Snapshot(self.times[self.next:] + self.times[:self.next],
+                        self.values[self.next:] + self.values[:self.next])
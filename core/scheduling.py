@@ -0,0 +1,36 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+CPU pinning and real-time priority.
+
+On Linux both apply to the calling thread, and are inherited by any thread
+or process it starts afterwards. They are optional: if they aren't
+allowed (real-time priority needs root or CAP_SYS_NICE) or aren't
+supported, we say so and carry on as we were.
+"""
+
+import os
+
+
+def pin_to_cpus(cpus, logger):
+    """ Run the calling thread on cpus (e.g. {3}) only."""
+    try:
+        os.sched_setaffinity(0, cpus)
+        logger.log("Running on CPUs " + ",".join(str(c) for c in sorted(cpus)))
+    except (AttributeError, OSError, ValueError) as e:
+        logger.error("Couldn't run on CPUs " + str(cpus) + ": " + str(e))
+
+
+def use_real_time_priority(priority, logger):
+    """ Schedule the calling thread SCHED_FIFO, with priority 1 (lowest) to 99."""
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        logger.log("Real-time priority " + str(priority))
+    except (AttributeError, OSError, ValueError) as e:
+        logger.error("Couldn't use real-time priority " + str(priority) + ": " + str(e))
+
+
+def parse_cpus(text):
+    """ "0,1,2" -> {0, 1, 2} """
+    return {int(c) for c in text.split(",") if c.strip() != ""}
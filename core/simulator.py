@@ -0,0 +1,310 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+A simulated mash tun, so that whole profiles can be run closed loop
+without the hardware.
+
+The model has two lumps of water: the water in the heating loop, which the
+heater heats, and the mash. The pump mixes the two, and without it only a
+little heat convects out of the loop. The mash loses heat to the room. The
+sensors sit in the mash, and each has a first order lag, noise, an offset
+and the DS18B20's 1/16 degree resolution.
+The defaults come from doc/numbers.md: about 1 degree a minute from the
+800W element into 10l of water, and sensors reading about 0.6 degrees low.
+
+    python3 simulator.py hold 66 [--minutes 90]
+    python3 simulator.py preset PROFILE.json
+    python3 simulator.py fit RUN_FOLDER
+
+'hold' and 'preset' run the core, on a VirtualClock, against the model, and
+print how well the temperature was controlled and how much CPU time the
+core used, as JSON. 'fit' adjusts the model to match a recorded run (it
+needs the run's run.bin, for the heater and pump states).
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from fake_hardware import install_stub_gpio
+install_stub_gpio()
+
+import clock
+import core
+import gpio
+import utils
+from graph_writer import BackgroundGraphWriter
+from profile import ProfileCache
+from replay import Replay, ReplayTemperatureReader, StderrLogger, repository_folder
+from run_log import RunLogReader
+
+
+class MashTun:
+    """ The thermal model. Temperatures are in degrees C, times in seconds."""
+
+    heater_watts = 800
+    water_kg = 10
+    loop_kg = 1
+    specific_heat = 4186                # J/kg/K
+    ambient_temperature = 18
+    ambient_watts_per_degree = 2.5      # from the mash to the room
+    pump_watts_per_degree = 400         # from the loop to the mash, with the pump running
+    still_watts_per_degree = 10         # ... and without it
+    sensor_lag_seconds = 30
+    sensor_noise = 0.05                 # standard deviation
+    sensor_offset = -0.6
+    sensor_resolution = 0.0625
+
+    # The longest step the model takes, to keep the integration stable.
+    max_step_seconds = 1.0
+
+    # The parameters that fit() may change.
+    fitted_parameters = ["heater_watts", "ambient_watts_per_degree", "pump_watts_per_degree", "sensor_lag_seconds"]
+
+    def __init__(self, start_temperature = 20, sensor_count = 1, seed = None, **parameters):
+        """ parameters: any of the class attributes, to override the default."""
+        for name, value in parameters.items():
+            if not hasattr(MashTun, name):
+                raise ValueError("MashTun has no parameter " + name)
+            setattr(self, name, value)
+        self.loop = start_temperature
+        self.mash = start_temperature
+        self.sensors = [start_temperature] * sensor_count
+        self.random = random.Random(seed)
+        self.heater = False
+        self.pump = False
+
+    def step(self, seconds):
+        """ Move the model on by seconds, with the current heater and pump settings."""
+        while seconds > 0:
+            dt = min(seconds, self.max_step_seconds)
+            seconds = seconds - dt
+            exchange = self.pump_watts_per_degree if self.pump else self.still_watts_per_degree
+            to_mash = exchange * (self.loop - self.mash)
+            to_room = self.ambient_watts_per_degree * (self.mash - self.ambient_temperature)
+            heat = self.heater_watts if self.heater else 0
+            self.loop = self.loop + (heat - to_mash) * dt / (self.loop_kg * self.specific_heat)
+            self.mash = self.mash + (to_mash - to_room) * dt / (self.water_kg * self.specific_heat)
+            follow = 1 - math.exp(-dt / self.sensor_lag_seconds)
+            self.sensors = [s + (self.mash - s) * follow for s in self.sensors]
+
+    def readings(self):
+        """ What the sensors would say now."""
+        values = []
+        for s in self.sensors:
+            value = s + self.sensor_offset + self.random.gauss(0, self.sensor_noise)
+            values.append(round(value / self.sensor_resolution) * self.sensor_resolution)
+        return values
+
+    def parameters(self):
+        return {name: getattr(self, name) for name in MashTun.fitted_parameters}
+
+
+class ControlMetrics:
+    """ Collect the true mash temperature against the target, and summarise how well it was controlled."""
+    def __init__(self):
+        self.samples = []
+
+    def add(self, seconds, target, temperature, heater):
+        self.samples.append((seconds, target, temperature, heater))
+
+    def summary(self, settled_within = 0.5):
+        """
+        overshoot: the furthest the temperature went above the target
+        rms_error, mean_error: once the target had first been reached
+        time_to_target: how long it took to get to within settled_within of the first target
+        heater_duty, heater_switches: how much the heater was on, and how often it switched
+        """
+        targeted = [s for s in self.samples if not math.isnan(s[1])]
+        if len(targeted) == 0:
+            return {}
+        reached = next((i for i, s in enumerate(targeted) if abs(s[2] - s[1]) <= settled_within), None)
+        settled = [] if reached is None else targeted[reached:]
+        errors = [temperature - target for seconds, target, temperature, heater in settled]
+        heater = [s[3] for s in self.samples]
+        return {
+            "time_to_target_seconds": None if reached is None else targeted[reached][0] - targeted[0][0],
+            "overshoot": max(temperature - target for seconds, target, temperature, heater in targeted),
+            "rms_error": math.sqrt(math.fsum(e * e for e in errors) / len(errors)) if len(errors) > 0 else None,
+            "mean_error": math.fsum(errors) / len(errors) if len(errors) > 0 else None,
+            "heater_duty": sum(heater) / len(heater),
+            "heater_switches": sum(1 for a, b in zip(heater, heater[1:]) if a != b),
+        }
+
+
+def profile_target(activity):
+    profile = getattr(activity, "profile", None)
+    if profile is None:
+        return math.nan
+    return profile.temperature_at(profile.seconds())
+
+
+def run_closed_loop(installation, start_run, seconds, tun, sample_period = 1, speed = None):
+    """
+    Run the core against tun for seconds of virtual time.
+    start_run is given the Core, to start the hold or preset.
+    Returns the control metrics, the CPU time used, and the new run folder.
+    """
+    virtual_clock = clock.VirtualClock()
+    clock.set_clock(virtual_clock)
+    reader = ReplayTemperatureReader(["Sim" + str(i + 1) for i in range(len(tun.sensors))])
+    the_core = core.Core(installation, temperature_reader = reader)
+    driver = Replay(the_core, virtual_clock, reader, speed)
+    metrics = ControlMetrics()
+
+    reader.feed(tun.readings())
+    with utils.message_batch():
+        start_run(the_core)
+    the_core.start_timers(control_timer = True)
+
+    model_seconds = 0
+    cpu_start = time.process_time()
+    t = 0
+    while t < seconds:
+        tun.heater = gpio.heater().is_lit
+        tun.pump = gpio.pump().is_lit
+        model_start = time.process_time()
+        tun.step(sample_period)
+        model_seconds = model_seconds + time.process_time() - model_start
+        t = t + sample_period
+        driver.advance_to(t)
+        reader.feed(tun.readings())
+        metrics.add(t, profile_target(the_core.activity), tun.mash, 1 if gpio.heater().is_lit else 0)
+    cpu_seconds = time.process_time() - cpu_start
+
+    run_folder = the_core.run_folder
+    if the_core.activity.graph is not None:
+        the_core.plot_feed.write()
+        the_core.activity.graph.close(final_write = True, timeout = BackgroundGraphWriter.render_timeout_seconds)
+    the_core.go_to_idle()
+    the_core.close_finished_graphs()
+    the_core.catalogue.close()
+    clock.set_clock(clock.SystemClock())
+
+    results = metrics.summary()
+    results["simulated_seconds"] = seconds
+    results["core_cpu_seconds"] = cpu_seconds - model_seconds
+    results["core_cpu_seconds_per_hour"] = (cpu_seconds - model_seconds) * 3600 / seconds
+    results["model_cpu_seconds"] = model_seconds
+    return results, run_folder
+
+
+def recorded_run(folder):
+    """ The times, average temperatures, heater and pump states from a run's run.bin."""
+    path = Path(folder) / "run.bin"
+    if not path.is_file():
+        raise RuntimeError(str(folder) + " has no run.bin")
+    reader = RunLogReader(str(path))
+    run = [reader.column(name).tolist() for name in ["Time", "Average", "Heater", "Pump"]]
+    reader.close()
+    if len(run[0]) < 2:
+        raise RuntimeError(str(folder) + " is too short")
+    return run
+
+
+def open_loop_error(run, parameters):
+    """ The RMS difference between the recorded temperatures and the model's, driven by the recorded heater and pump."""
+    times, averages, heaters, pumps = run
+    tun = MashTun(start_temperature = averages[0] - MashTun.sensor_offset, sensor_noise = 0, sensor_resolution = 1e-9, **parameters)
+    squares = 0.0
+    for i in range(1, len(times)):
+        tun.heater = heaters[i - 1] > 0.5
+        tun.pump = pumps[i - 1] > 0.5
+        tun.step(times[i] - times[i - 1])
+        if not math.isnan(averages[i]):
+            squares = squares + (tun.readings()[0] - averages[i]) ** 2
+    return math.sqrt(squares / (len(times) - 1))
+
+
+def fit(folder, rounds = 12):
+    """
+    Adjust the model's parameters to match a recorded run, one parameter at
+    a time, trying bigger and smaller values and halving the step each round.
+    """
+    run = recorded_run(folder)
+    parameters = MashTun().parameters()
+    best = open_loop_error(run, parameters)
+    start = best
+    factor = 1.5
+    for r in range(rounds):
+        for name in MashTun.fitted_parameters:
+            for scale in [factor, 1 / factor]:
+                trial = dict(parameters)
+                trial[name] = parameters[name] * scale
+                error = open_loop_error(run, trial)
+                if error < best:
+                    best = error
+                    parameters = trial
+        factor = 1 + (factor - 1) / 2
+    return {"parameters": parameters, "rms_error": best, "default_rms_error": start}
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Run the Mash-o-matiC core against a simulated mash tun")
+    parser.add_argument("command", choices = ["hold", "preset", "fit"])
+    parser.add_argument("argument", help = "the hold temperature, the preset profile, or the run folder to fit")
+    parser.add_argument("--minutes", type = float, help = "how long to run for (default: 90 for a hold, the length of a preset)")
+    parser.add_argument("--start-temperature", type = float, default = 20)
+    parser.add_argument("--sensors", type = int, default = 1, help = "how many sensors")
+    parser.add_argument("--parameters", help = "a JSON file of MashTun parameters, e.g. from fit")
+    parser.add_argument("--controller", help = "the heater controller to use, e.g. predictive")
+    parser.add_argument("--graph", choices = ["gnuplot", "raster"], default = core.Core.graph_renderer, help = "how to draw the graph")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--speed", type = float, help = "times faster than real time, rather than as fast as possible")
+    parser.add_argument("--output", help = "the installation folder to write the run to, rather than a temporary one")
+    arguments = parser.parse_args()
+    core.Core.graph_renderer = arguments.graph
+
+    if arguments.command == "fit":
+        print(json.dumps(fit(arguments.argument), indent = 4))
+        return
+
+    parameters = {}
+    if arguments.parameters is not None:
+        with open(arguments.parameters) as f:
+            parameters = json.load(f)
+        parameters = parameters.get("parameters", parameters)
+    tun = MashTun(arguments.start_temperature, arguments.sensors, arguments.seed, **parameters)
+
+    if arguments.command == "hold":
+        temperature = float(arguments.argument)
+        start_run = lambda the_core: the_core.hold(temperature, arguments.controller)
+        minutes = 90 if arguments.minutes is None else arguments.minutes
+    else:
+        profile_path = str(Path(arguments.argument).resolve())
+        start_run = lambda the_core: the_core.preset(profile_path, arguments.controller)
+        minutes = arguments.minutes
+        if minutes is None:
+            details = ProfileCache(StderrLogger()).get(profile_path)
+            if details is None:
+                sys.stderr.write("Can't use preset " + profile_path + "\n")
+                sys.exit(1)
+            minutes = details.duration_minutes
+
+    installation = arguments.output if arguments.output is not None else tempfile.mkdtemp(prefix = "mash-simulator-")
+    installation = installation if installation.endswith("/") else installation + "/"
+    Path(installation).mkdir(parents=True, exist_ok=True)
+    if not Path(installation + "graph.plt").is_file():
+        shutil.copy(repository_folder + "target/graph.plt", installation + "graph.plt")
+
+    with open(os.devnull, "w") as null:
+        utils.message_writer.output = null
+        try:
+            results, run_folder = run_closed_loop(installation, start_run, minutes * 60, tun, speed = arguments.speed)
+        finally:
+            utils.flush_messages()
+    results["run_folder"] = run_folder
+    results["parameters"] = tun.parameters()
+    print(json.dumps(results, indent = 4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+Timing statistics
+
+Hot paths time themselves like this:
+
+    started = stats.start()
+    ...
+    stats.stop("core.control", started)
+
+While the statistics are off (the default) start() returns None and
+stop() returns straight away, so the cost is two function calls.
+While they are on, each duration goes into a Timing of that name, which
+keeps a rolling histogram, so percentiles can be reported (the 'stats'
+message) or dumped to a file.
+
+The core's worker processes keep their own, and export() them when the
+core asks, which the core load()s and merges into what it reports.
+"""
+
+import json
+import math
+import threading
+import time
+
+
+enabled = False
+
+timings = {}
+lock = threading.Lock()
+
+
+class Histogram:
+    """
+    Durations, in seconds, counted in logarithmic buckets: buckets_per_decade
+    for each power of ten from smallest_seconds up, plus one for anything
+    smaller and one for anything bigger. Percentiles are only as good as the
+    bucket width, about 25% with 10 buckets per decade.
+    """
+
+    buckets_per_decade = 10
+    smallest_seconds = 1e-6
+    decades = 9
+
+    def __init__(self):
+        self.counts = [0] * (Histogram.buckets_per_decade * Histogram.decades + 2)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, seconds):
+        if seconds <= Histogram.smallest_seconds:
+            bucket = 0
+        else:
+            bucket = min(int(math.log10(seconds / Histogram.smallest_seconds) * Histogram.buckets_per_decade) + 1, len(self.counts) - 1)
+        self.counts[bucket] = self.counts[bucket] + 1
+        self.count = self.count + 1
+        self.total = self.total + seconds
+        self.maximum = max(self.maximum, seconds)
+
+    def merge(self, other):
+        merged = Histogram()
+        merged.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        merged.count = self.count + other.count
+        merged.total = self.total + other.total
+        merged.maximum = max(self.maximum, other.maximum)
+        return merged
+
+    def percentile(self, percent):
+        """ The upper bound of the bucket with the percent'th duration, or nan if there are none."""
+        if self.count == 0:
+            return math.nan
+        wanted = math.ceil(self.count * percent / 100)
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen = seen + count
+            if seen >= max(wanted, 1):
+                return min(Histogram.upper_bound(bucket), self.maximum)
+        return self.maximum
+
+    def to_dictionary(self):
+        return {"counts": self.counts, "count": self.count, "total": self.total, "maximum": self.maximum}
+
+    @staticmethod
+    def from_dictionary(dictionary):
+        histogram = Histogram()
+        if len(dictionary["counts"]) != len(histogram.counts):
+            raise ValueError("Histogram has " + str(len(dictionary["counts"])) + " buckets, rather than " + str(len(histogram.counts)))
+        histogram.counts = list(dictionary["counts"])
+        histogram.count = dictionary["count"]
+        histogram.total = dictionary["total"]
+        histogram.maximum = dictionary["maximum"]
+        return histogram
+
+    @staticmethod
+    def upper_bound(bucket):
+        return Histogram.smallest_seconds * 10 ** (bucket / Histogram.buckets_per_decade)
+
+
+class Timing:
+    """
+    A rolling histogram: durations go into the current histogram, which
+    becomes the previous one every rotate_seconds, so what is reported
+    covers the last rotate_seconds to 2 * rotate_seconds.
+    """
+
+    rotate_seconds = 600
+
+    def __init__(self):
+        self.current = Histogram()
+        self.previous = Histogram()
+        self.started = time.monotonic()
+
+    def add(self, seconds):
+        now = time.monotonic()
+        if now - self.started > Timing.rotate_seconds:
+            self.previous = self.current
+            self.current = Histogram()
+            self.started = now
+        self.current.add(seconds)
+
+    def histogram(self):
+        return self.previous.merge(self.current)
+
+
+def start():
+    """ The time now, to give to stop(), or None if the statistics are off."""
+    return time.perf_counter() if enabled else None
+
+
+def stop(name, started):
+    """ Record the time since started, which came from start()."""
+    if started is not None:
+        record(name, time.perf_counter() - started)
+
+
+def record(name, seconds):
+    with lock:
+        timing = timings.get(name)
+        if timing is None:
+            timing = Timing()
+            timings[name] = timing
+        timing.add(seconds)
+
+
+def enable(on = True):
+    global enabled
+    enabled = on
+
+
+def reset():
+    with lock:
+        timings.clear()
+
+
+percentiles = [50, 90, 99]
+
+
+def histograms(others = ()):
+    """
+    Each timing's Histogram, keyed by name, merged with others: dictionaries
+    of Histograms from load(), e.g. from worker processes.
+    """
+    with lock:
+        results = {name: timing.histogram() for name, timing in timings.items()}
+    for other in others:
+        for name, histogram in other.items():
+            results[name] = results[name].merge(histogram) if name in results else histogram
+    return results
+
+
+def export():
+    """ The histograms, as something json can write, for another process to load()."""
+    return {name: h.to_dictionary() for name, h in histograms().items()}
+
+
+def load(exported):
+    """ Histograms, keyed by name, from export()."""
+    return {name: Histogram.from_dictionary(h) for name, h in exported.items()}
+
+
+def summary(others = ()):
+    """
+    A dictionary of each timing's count, mean, percentiles and maximum,
+    in milliseconds, keyed by name, in name order.
+    others: see histograms()
+    """
+    histograms_by_name = histograms(others)
+    results = {}
+    for name in sorted(histograms_by_name):
+        h = histograms_by_name[name]
+        result = {"count": h.count, "mean_ms": 1000 * h.total / h.count if h.count > 0 else math.nan}
+        for p in percentiles:
+            result["p" + str(p) + "_ms"] = 1000 * h.percentile(p)
+        result["max_ms"] = 1000 * h.maximum
+        results[name] = result
+    return results
+
+
+def dump(path, others = ()):
+    """
+    Write the summary, and each histogram's bucket counts, as JSON.
+    others: see histograms()
+    """
+    histograms_by_name = histograms(others)
+    buckets = [Histogram.upper_bound(b) for b in range(len(Histogram().counts))]
+    details = {
+        "summary": summary(others),
+        "bucket_upper_bounds_seconds": buckets,
+        "counts": {name: h.counts for name, h in sorted(histograms_by_name.items())},
+    }
+    with open(path, "w") as f:
+        json.dump(details, f, indent = 4)
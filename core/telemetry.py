@@ -0,0 +1,103 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+TelemetryRing class
+"""
+
+import struct
+from multiprocessing import shared_memory
+
+
+def attach_shared_memory(name):
+    """
+    Open shared memory that another process created, without this process's
+    resource tracker deleting it when we exit (which it does before Python 3.13).
+    """
+    try:
+        return shared_memory.SharedMemory(name, track = False)
+    except TypeError:
+        memory = shared_memory.SharedMemory(name)
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(memory._name, "shared_memory")
+        return memory
+
+
+class TelemetryRing:
+    """
+    The most recent samples and state, in shared memory, so that other
+    processes (e.g. the graph process) can follow the run without asking
+    the core for anything, and without the core waiting for them.
+
+    There is one writer, the core or its control process, and any number of readers. The header
+    has the number of records ever written. Each record has its own index,
+    so a reader can tell if the writer has gone all the way round the
+    ring and overwritten it, in which case the reader has lost it.
+    """
+
+    capacity = 4096
+    max_sensors = 8
+
+    header = struct.Struct("<Q")
+    # index, time, average, target, heater, pump, number of sensors, sensors
+    record = struct.Struct("<QdddBBB5x" + "d" * max_sensors)
+
+    def __init__(self, memory, owner):
+        """ Use create() or attach() rather than this."""
+        self.memory = memory
+        self.owner = owner
+        self.count = self.written()
+
+    @staticmethod
+    def create():
+        size = TelemetryRing.header.size + TelemetryRing.capacity * TelemetryRing.record.size
+        return TelemetryRing(shared_memory.SharedMemory(create = True, size = size), True)
+
+    @staticmethod
+    def attach(name):
+        return TelemetryRing(attach_shared_memory(name), False)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def written(self):
+        """ How many records have ever been written."""
+        return TelemetryRing.header.unpack_from(self.memory.buf, 0)[0]
+
+    def append(self, timestamp, average, target, heater_is_on, pump_is_on, temperatures):
+        temperatures = list(temperatures[:TelemetryRing.max_sensors])
+        padding = [0.0] * (TelemetryRing.max_sensors - len(temperatures))
+        TelemetryRing.record.pack_into(self.memory.buf, self.__offset(self.count), self.count, timestamp, average, target,
+                                       1 if heater_is_on else 0, 1 if pump_is_on else 0, len(temperatures), *(temperatures + padding))
+        self.count = self.count + 1
+        TelemetryRing.header.pack_into(self.memory.buf, 0, self.count)
+
+    def read(self, since):
+        """
+        Get the records written since the since'th.
+        Returns (records, next, lost) where each record is
+        (timestamp, average, target, heater_is_on, pump_is_on, temperatures),
+        next is the since for the next read, and lost is how many records
+        were overwritten before we could read them.
+        """
+        written = self.written()
+        first = max(since, written - TelemetryRing.capacity)
+        records = []
+        for i in range(first, written):
+            fields = TelemetryRing.record.unpack_from(self.memory.buf, self.__offset(i))
+            if fields[0] == i:
+                index, timestamp, average, target, heater, pump, sensor_count = fields[:7]
+                records.append((i, (timestamp, average, target, heater == 1, pump == 1, list(fields[7:7 + sensor_count]))))
+        # The writer may have started on the next record, and so on whatever was in its place, while we were reading.
+        oldest_safe = self.written() - TelemetryRing.capacity + 1
+        records = [record for i, record in records if i >= oldest_safe]
+        return records, written, (written - since) - len(records)
+
+    def close(self):
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+    def __offset(self, index):
+        return TelemetryRing.header.size + (index % TelemetryRing.capacity) * TelemetryRing.record.size
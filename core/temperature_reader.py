@@ -7,9 +7,13 @@ DS18B20 temperature sensor management
 
 import threading
 import sys
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
 
+import clock
+import stats
+from sample_history import SampleHistory
+
 
 def read_file(filename):
     with open(filename) as f:
@@ -27,20 +31,70 @@ class TemperatureReader:
     one second per file to complete the read().
     This led to the requirement for it to be done in a background worker
     thread.
+
+    In concurrent mode each sensor is read in its own pool thread, so the
+    whole set is refreshed in about one conversion time, rather than one
+    conversion time per sensor. Every value carries the monotonic time it
+    was read, so consumers can tell how old it is.
+
+    Each sensor keeps a SampleHistory of recent values. Anything that wants
+    the latest temperatures (control, logging) reads them from these without
+    any locking or copying, and anything that wants the recent history (the
+    test display) takes a snapshot.
+    wait_for_samples() lets a consumer (the control thread) run as soon as
+    each set of samples has been read.
+
+    In bulk read mode, if the w1_therm driver supports it, we tell every
+    sensor on the bus to start a conversion at once (therm_bulk_read), wait
+    for them all to finish, and then reading each temperature file just
+    returns the converted value rather than starting a conversion of its own.
+    The resolution of each sensor can also be set, since conversion time
+    doubles for each extra bit (see conversion_seconds).
+    If the kernel doesn't have these controls we carry on as before.
     """
 
+    # How many samples each sensor remembers.
+    history_size = 600
+
+    # The shortest time between reads of the same sensor in concurrent or bulk mode.
+    minimum_cycle_seconds = 1.0
+
+    # DS18B20 conversion times for each resolution, in bits.
+    conversion_seconds = {9: 0.094, 10: 0.188, 11: 0.375, 12: 0.75}
+    default_resolution = 12
+
+    # How often to check whether a bulk conversion has finished.
+    bulk_read_poll_seconds = 0.01
+
     one_wire_device_path = "/sys/bus/w1/devices/"
 
+    # A sensor has failed if it hasn't had a good value for this long.
+    stale_sample_seconds = 15
+
     class Sensor:
         """ Encapsulate one temperature sensor."""
 
         def __init__(self, name, path):
             self.name = name
             self.path = path
-            self.value = 0.0
-            self.errors = 0
+            self.history = SampleHistory(TemperatureReader.history_size)
+            self.created = clock.monotonic()
 
-        def read(self, lock):
+        @property
+        def value(self):
+            return self.latest()[1]
+
+        @property
+        def timestamp(self):
+            return self.latest()[0]
+
+        def latest(self):
+            """ (timestamp, value) of the latest good value, both from the same sample, or (None, 0.0) if there isn't one."""
+            latest = self.history.latest()
+            return (None, 0.0) if latest is None else latest
+
+        def read(self):
+            started = stats.start()
             try:
                 with open(self.path + "/temperature") as f:
                     raw_value = f.read()
@@ -48,43 +102,126 @@ class TemperatureReader:
                         value = float(raw_value)
                     except ValueError:
                         sys.stderr.write("Couldn't parse '" + raw_value + "' for temperature sensor '" + self.name + "'\n")
-                        self.errors = self.errors + 1
                     else:
-                        lock.acquire()
-                        self.value = value / 1000
-                        lock.release()
-                        self.errors = 0
+                        self.history.add(clock.monotonic(), value / 1000)
             except FileNotFoundError:
                 sys.stderr.write("Couldn't read sensor '" + self.name + "'\n")
-                self.errors = self.errors + 1
+            stats.stop("sensor.read", started)
+
+        def age(self):
+            """ How long, in seconds, since the latest good value (or since we started, if there hasn't been one)."""
+            timestamp = self.latest()[0]
+            return clock.monotonic() - (self.created if timestamp is None else timestamp)
 
         def failed(self):
-            return self.errors > 10
+            """ Reads that fail, and reads that hang, both leave us without a recent value."""
+            return self.age() > TemperatureReader.stale_sample_seconds
+
+        def set_resolution(self, bits):
+            try:
+                with open(self.path + "/resolution", "w") as f:
+                    f.write(str(bits))
+                return True
+            except OSError as e:
+                sys.stderr.write("Couldn't set resolution of sensor '" + self.name + "': " + str(e) + "\n")
+            return False
 
 
-    def __init__(self, sensor_names_file):
+    def __init__(self, sensor_names_file, concurrent = False, bulk_read = False, resolution = None):
+        """
+        sensor_names_file: file mapping sensor IDs to nicknames
+        concurrent: read all the sensors at the same time, rather than one after the other
+        bulk_read: start the conversions of all the sensors with one bulk read, if the driver can
+        resolution: the sensor resolution in bits (9-12), or None to leave it as it is
+        """
         self.sensors = []
         self.lock = threading.Lock()
         self.sensor_names_file = sensor_names_file
+        self.concurrent = concurrent
+        self.bulk_read = bulk_read
+        self.resolution = resolution
+        self.pool = None
+        self.thread = None
+        self.running = False
+        self.cycles = 0
+        self.new_samples = threading.Condition()
 
     def start(self):
-        self.__discover_sensors()
+        self.discover_sensors()
+        if self.bulk_read and not self.bulk_read_supported():
+            sys.stderr.write("No therm_bulk_read, reading temperature sensors individually\n")
+            self.bulk_read = False
+        if self.resolution is not None:
+            self.set_resolution(self.resolution)
+        if self.concurrent:
+            self.pool = ThreadPoolExecutor(max_workers = max(1, len(self.sensors)), thread_name_prefix = "sensor")
+        self.running = True
         self.thread = threading.Thread(target=TemperatureReader.__thread_function, daemon=True, args=(self,))
         self.thread.start()
 
+    def stop(self):
+        """ Stop reading the sensors, once the current set has been read."""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout = 5)
+            self.thread = None
+        if self.pool is not None:
+            self.pool.shutdown(wait = False)
+            self.pool = None
+
     def temperatures(self):
         values = []
         failures = []
-        self.lock.acquire()
         for i in self.sensors:
             values.append(i.value)
             if i.failed():
                 failures.append(i.name)
-        self.lock.release()
         if len(failures):
             raise RuntimeError("Temperature sensor problem: " + ",".join(failures))
         return values
 
+    def wait_for_samples(self, last_cycle, timeout = None):
+        """
+        Wait until the sensors have been read again since last_cycle, or for timeout seconds.
+        Returns the latest cycle, to pass in next time. Pass None to not wait at all.
+        """
+        with self.new_samples:
+            if last_cycle is not None:
+                self.new_samples.wait_for(lambda: self.cycles != last_cycle, timeout)
+            return self.cycles
+
+    def bulk_read_supported(self):
+        return Path(self.__bulk_read_path()).is_file()
+
+    def set_resolution(self, bits):
+        """
+        Set the resolution of all the sensors, e.g. 10 bits for quicker
+        readings when holding, or 12 for the best precision.
+        Returns False if any sensor couldn't be changed.
+        """
+        self.resolution = bits
+        self.lock.acquire()
+        sensors = list(self.sensors)
+        self.lock.release()
+        results = [i.set_resolution(bits) for i in sensors]
+        return all(results)
+
+    def samples(self):
+        """
+        Get (timestamp, value) for each sensor, where timestamp is the
+        clock.monotonic() time the value was read, or None if it hasn't been yet.
+        """
+        return [i.latest() for i in self.sensors]
+
+    def sample_age(self):
+        """ The age, in seconds, of the stalest sensor's latest value, or None if there are no sensors."""
+        ages = [i.age() for i in self.sensors]
+        return max(ages) if len(ages) > 0 else None
+
+    def snapshots(self):
+        """ Get a Snapshot of the recent history of each sensor."""
+        return [i.history.snapshot() for i in self.sensors]
+
     def sensor_names(self):
         values = []
         self.lock.acquire()
@@ -103,7 +240,8 @@ class TemperatureReader:
                     nicknames[parts[0]] = parts[1]
         return nicknames
 
-    def __discover_sensors(self):
+    def discover_sensors(self):
+        """ Find the sensors, and their names, without reading them. start() does this."""
         nicknames = self.__sensor_nicknames()
 
         count = read_file(TemperatureReader.one_wire_device_path + "w1_bus_master1/w1_master_slave_count")
@@ -112,8 +250,7 @@ class TemperatureReader:
 
         sensors = read_file(TemperatureReader.one_wire_device_path + "w1_bus_master1/w1_master_slaves")
 
-        self.lock.acquire()
-        self.sensors.clear()
+        discovered = []
         for i in sensors:
             name = i.rstrip()
             path = TemperatureReader.one_wire_device_path + name
@@ -121,14 +258,66 @@ class TemperatureReader:
                 nickname = nicknames[name]
                 if nickname is not "":
                     name = nickname
-            self.sensors.append(TemperatureReader.Sensor(name, path))
+            discovered.append(TemperatureReader.Sensor(name, path))
+        # Replace the whole list, so readers never see it half built.
+        self.lock.acquire()
+        self.sensors = discovered
         self.lock.release()
 
+    def __bulk_read_path(self):
+        return TemperatureReader.one_wire_device_path + "w1_bus_master1/therm_bulk_read"
+
+    def __bulk_conversion(self):
+        """
+        Start all the sensors converting, and wait until they've finished.
+        Reading therm_bulk_read gives -1 while any conversion is still in progress.
+        """
+        try:
+            with open(self.__bulk_read_path(), "w") as f:
+                f.write("trigger")
+        except OSError as e:
+            sys.stderr.write("Bulk read failed, reading temperature sensors individually: " + str(e) + "\n")
+            self.bulk_read = False
+            return
+        resolution = self.resolution if self.resolution is not None else TemperatureReader.default_resolution
+        conversion = TemperatureReader.conversion_seconds.get(resolution, TemperatureReader.conversion_seconds[12])
+        clock.sleep(conversion)
+        give_up = clock.monotonic() + conversion
+        while clock.monotonic() < give_up:
+            try:
+                if read_file(self.__bulk_read_path())[0].strip() != "-1":
+                    return
+            except (OSError, IndexError):
+                return
+            clock.sleep(TemperatureReader.bulk_read_poll_seconds)
+
     def __read_sensors(self):
         for i in self.sensors:
-            i.read(self.lock)
+            i.read()
+
+    def __read_sensors_concurrently(self):
+        wait([self.pool.submit(i.read) for i in self.sensors])
 
     def __thread_function(self):
-        while True:
-            self.__read_sensors()
-            sleep(1)
+        while self.running:
+            if self.concurrent or self.bulk_read:
+                cycle_start = clock.monotonic()
+                started = stats.start()
+                if self.bulk_read:
+                    self.__bulk_conversion()
+                if self.concurrent:
+                    self.__read_sensors_concurrently()
+                else:
+                    self.__read_sensors()
+                stats.stop("sensor.cycle", started)
+                self.__samples_read()
+                clock.sleep(max(0, TemperatureReader.minimum_cycle_seconds - (clock.monotonic() - cycle_start)))
+            else:
+                self.__read_sensors()
+                self.__samples_read()
+                clock.sleep(1)
+
+    def __samples_read(self):
+        with self.new_samples:
+            self.cycles = self.cycles + 1
+            self.new_samples.notify_all()
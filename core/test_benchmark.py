@@ -0,0 +1,37 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+Benchmark smoke test: the benchmarks still run against the current code
+
+    python3 -m unittest test_benchmark
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_quick_run(self):
+        with tempfile.TemporaryDirectory() as folder:
+            output = os.path.join(folder, "results.json")
+            benchmark = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark.py")
+            completed = subprocess.run([sys.executable, benchmark, "--quick", "--output", output],
+                                       stdout = subprocess.PIPE, stderr = subprocess.STDOUT, timeout = 120)
+            self.assertEqual(completed.returncode, 0, completed.stdout.decode(errors = "replace"))
+            with open(output) as f:
+                results = json.load(f)
+        # Every benchmark either ran or says why it was skipped.
+        for name in ["sensor.read[4 sensors]", "temperature_reader.temperatures", "core.update_temperatures[hold]"]:
+            self.assertIn(name, results["results"])
+        for name, result in results["results"].items():
+            self.assertGreater(result["median_us"], 0, name)
+
+
+if __name__ == "__main__":
+    unittest.main()
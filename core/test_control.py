@@ -0,0 +1,112 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+Heater controller tests
+
+    python3 -m unittest test_control
+"""
+
+import unittest
+
+import clock
+from control import BangBangController, PredictiveController, TimeProportionalController, MinimumOffTime
+
+
+class FlatProfile:
+    """ Enough of a Profile: the same target all the time."""
+    def __init__(self, target):
+        self.target = target
+
+    def temperature_at(self, seconds):
+        return self.target
+
+
+class ControllerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = clock.VirtualClock()
+        clock.set_clock(self.clock)
+        self.profile = FlatProfile(66)
+        self.heater_is_on = False
+        self.seconds = 0
+
+    def tearDown(self):
+        clock.set_clock(clock.SystemClock())
+
+    def control(self, controller, temperature):
+        """ One second of control, switching the heater as the core would."""
+        self.heater_is_on = controller.should_heat(self.profile, self.seconds, temperature, self.heater_is_on)
+        self.clock.advance(1)
+        self.seconds = self.seconds + 1
+        return self.heater_is_on
+
+
+class TestMinimumOffTime(ControllerTestCase):
+
+    def test_stays_off(self):
+        minimum_off = MinimumOffTime(10)
+        self.assertTrue(minimum_off.allow(True, False))
+        self.assertFalse(minimum_off.allow(False, True))
+        self.clock.advance(9.9)
+        self.assertFalse(minimum_off.allow(True, False))
+        self.clock.advance(0.1)
+        self.assertTrue(minimum_off.allow(True, False))
+
+    def test_always_goes_off_straight_away(self):
+        minimum_off = MinimumOffTime(10)
+        self.assertFalse(minimum_off.allow(False, True))
+        self.assertFalse(minimum_off.allow(False, True))
+        self.assertTrue(minimum_off.allow(True, True))
+
+
+class TestBangBang(ControllerTestCase):
+
+    def test_noise_doesnt_chatter(self):
+        controller = BangBangController()
+        self.assertTrue(self.control(controller, 60))
+        # Noise either side of the switching point.
+        states = [self.control(controller, 65.5 + (0.1 if i % 2 == 0 else -0.1)) for i in range(30)]
+        self.assertFalse(states[0])
+        self.assertEqual(states[1:BangBangController.minimum_off_seconds], [False] * (BangBangController.minimum_off_seconds - 1))
+        self.assertIn(True, states[BangBangController.minimum_off_seconds:])
+
+    def test_no_target(self):
+        self.profile = FlatProfile(float("nan"))
+        self.assertFalse(self.control(BangBangController(), 20))
+
+
+class TestPredictive(ControllerTestCase):
+
+    def test_stays_off_for_the_minimum(self):
+        controller = PredictiveController()
+        self.assertTrue(self.control(controller, 60))
+        self.assertFalse(self.control(controller, 70))
+        # Wants to heat again straight away, but has to wait.
+        states = [self.control(controller, 50) for i in range(PredictiveController.minimum_off_seconds)]
+        self.assertEqual(states[:PredictiveController.minimum_off_seconds - 1], [False] * (PredictiveController.minimum_off_seconds - 1))
+        self.assertTrue(states[-1])
+
+
+class TestTimeProportional(ControllerTestCase):
+
+    def on_seconds_in_each_period(self, controller, temperature, periods):
+        period = TimeProportionalController.pwm_period_seconds
+        states = [self.control(controller, temperature) for i in range(period * periods)]
+        return [sum(states[p * period:(p + 1) * period]) for p in range(periods)]
+
+    def test_full_power(self):
+        period = TimeProportionalController.pwm_period_seconds
+        self.assertEqual(self.on_seconds_in_each_period(TimeProportionalController(), 50, 3), [period] * 3)
+
+    def test_short_off_slices_are_kept(self):
+        # Aiming for 90%: three seconds off and straight back on, with no minimum off time stretching it.
+        period = TimeProportionalController.pwm_period_seconds
+        temperature = 66 - TimeProportionalController.aim_below - 0.9 * TimeProportionalController.proportional_band
+        controller = TimeProportionalController()
+        self.assertAlmostEqual(controller.duty(self.profile, 0, temperature), 0.9)
+        self.assertEqual(self.on_seconds_in_each_period(controller, temperature, 3), [round(0.9 * period)] * 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
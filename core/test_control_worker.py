@@ -0,0 +1,337 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+Control process tests, on stub GPIO and a FakeOneWireBus
+
+    python3 -m unittest test_control_worker
+"""
+
+import io
+import tempfile
+import time
+import unittest
+from datetime import datetime
+from pathlib import Path
+
+from fake_hardware import install_stub_gpio, FakeOneWireBus, write_fake_worker
+install_stub_gpio()
+
+import core
+import gpio
+import stats
+import utils
+from control_worker import ControlWorker, ControlProcess
+from event_loop import EventLoop
+from logger import Logger
+from profile import Profile
+from telemetry import TelemetryRing
+from temperature_reader import TemperatureReader
+from test_core import CoreTestCase
+from test_watchdog import wait_until
+
+
+sensor_ids = ["28-000001", "28-000002"]
+
+
+def latest_record(ring):
+    """ (timestamp, average, target, heater_is_on, pump_is_on, temperatures) from the last record written, or None."""
+    records, next_record, lost = ring.read(max(0, ring.written() - 1))
+    return records[-1] if len(records) > 0 else None
+
+def heater_in_ring(ring, since = 0):
+    """ Whether the heater was on in the last record, if it was written after the since'th."""
+    record = latest_record(ring)
+    return ring.written() > since and record is not None and record[3]
+
+def run_command(run, temperature, command = "run"):
+    """ What ControlProcess sends for a hold at temperature."""
+    return {"command": command, "run": run, "controller": None, "path": "",
+            "profile": {"steps": [{"start": temperature}, {"rest": 10}]}, "start_time": datetime.now().isoformat()}
+
+
+class LoopRunner:
+    """ Run an EventLoop until something has happened, or too long has passed."""
+    def __init__(self, event_loop):
+        self.event_loop = event_loop
+        self.condition = lambda: True
+        self.give_up = 0
+        event_loop.call_every(0.02, self.check)
+
+    def check(self):
+        if self.condition() or time.monotonic() > self.give_up:
+            self.event_loop.stop()
+
+    def run_until(self, condition, timeout = 10):
+        """ Returns whether condition came true."""
+        self.condition = condition
+        self.give_up = time.monotonic() + timeout
+        self.event_loop.run()
+        return condition()
+
+
+class TestControlWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_device_path = TemperatureReader.one_wire_device_path
+        self.saved_cycle_seconds = TemperatureReader.minimum_cycle_seconds
+        TemperatureReader.minimum_cycle_seconds = 0.05
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = self.folder.name + "/"
+        self.bus = FakeOneWireBus(self.path + "w1/", sensor_ids)
+        self.bus.install()
+        self.output = io.StringIO()
+        # A new one, which hasn't sent anything yet, so state messages aren't dropped as unchanged.
+        self.saved_message_writer = utils.message_writer
+        utils.message_writer = utils.MessageWriter(self.output)
+        self.ring = TelemetryRing.create()
+        self.logger = Logger(self.path + "control")
+        self.reader = TemperatureReader(self.path + "sensor_names.txt", concurrent = True)
+        self.worker = ControlWorker(self.ring, self.logger, self.reader, timeout_seconds = 1)
+
+    def tearDown(self):
+        self.worker.stop()
+        gpio.leave_test_mode()
+        utils.flush_messages()
+        utils.message_writer = self.saved_message_writer
+        self.logger.close()
+        self.ring.close()
+        TemperatureReader.one_wire_device_path = self.saved_device_path
+        TemperatureReader.minimum_cycle_seconds = self.saved_cycle_seconds
+        self.folder.cleanup()
+
+    def messages(self):
+        utils.flush_messages()
+        return self.output.getvalue().splitlines()
+
+    def controlled_since(self, since):
+        """ Wait until control has recorded another set of samples, and return the latest."""
+        self.assertTrue(wait_until(lambda: self.ring.written() > since))
+        return latest_record(self.ring)
+
+    def test_starts_with_everything_off(self):
+        gpio.heater().on()
+        gpio.pump().on()
+        self.worker.start()
+        self.assertFalse(gpio.heater().is_lit)
+        self.assertFalse(gpio.pump().is_lit)
+        self.assertEqual(self.messages()[:2], ["heat off", "pump off"])
+
+    def test_idle_records_the_temperatures_without_heating(self):
+        self.worker.start()
+        timestamp, average, target, heater_is_on, pump_is_on, temperatures = self.controlled_since(0)
+        self.assertEqual(temperatures, [20.0, 20.0])
+        self.assertEqual(average, 20.0)
+        self.assertFalse(heater_is_on)
+        self.assertIn("temp 20.0", self.messages())
+
+    def test_heats_to_the_run_profile(self):
+        self.worker.start()
+        self.controlled_since(0)
+        self.worker.handle(run_command(1, 66))
+        # Straight away, once the sensors have been read, rather than at the next samples.
+        self.assertTrue(gpio.heater().is_lit)
+        self.assertTrue(gpio.pump().is_lit)
+        timestamp, average, target, heater_is_on, pump_is_on, temperatures = self.controlled_since(self.ring.written())
+        self.assertEqual(target, 66)
+        self.assertTrue(heater_is_on and pump_is_on)
+        self.assertIn("heat on", self.messages())
+        self.assertIn("cold", self.messages())
+
+    def test_profile_change(self):
+        self.worker.start()
+        self.worker.handle(run_command(1, 66))
+        self.worker.handle(run_command(1, 10, "profile"))
+        record = self.controlled_since(self.ring.written())
+        self.assertEqual(record[2], 10)
+        self.assertFalse(gpio.heater().is_lit)
+        self.assertIn("hot", self.messages())
+        # Still running, so the pump stays on.
+        self.assertTrue(gpio.pump().is_lit)
+
+    def test_profile_for_another_run_is_ignored(self):
+        self.worker.start()
+        self.worker.handle(run_command(2, 66))
+        self.worker.handle(run_command(1, 10, "profile"))
+        self.assertEqual(self.controlled_since(self.ring.written())[2], 66)
+
+    def test_idle_turns_everything_off(self):
+        self.worker.start()
+        self.worker.handle(run_command(1, 66))
+        self.worker.handle({"command": "idle"})
+        self.assertFalse(gpio.heater().is_lit)
+        self.assertFalse(gpio.pump().is_lit)
+        record = self.controlled_since(self.ring.written())
+        self.assertFalse(record[3])
+        self.assertEqual(record[2], record[1])
+
+    def test_test_mode_leaves_the_heater_to_the_buttons(self):
+        self.worker.start()
+        self.worker.handle({"command": "testmode"})
+        gpio.claim_pins().button(3).press()
+        self.assertTrue(gpio.heater().is_lit)
+        self.controlled_since(self.ring.written() + 1)
+        self.assertTrue(gpio.heater().is_lit)
+        self.assertTrue(any(m.startswith("testshow ") for m in self.messages()))
+        self.worker.handle({"command": "idle"})
+        self.assertFalse(gpio.heater().is_lit)
+        self.assertFalse(gpio.test_mode)
+
+    def test_stop_leaves_everything_off(self):
+        self.worker.start()
+        self.worker.handle(run_command(1, 66))
+        self.worker.stop()
+        self.assertFalse(gpio.heater().is_lit)
+        self.assertFalse(gpio.pump().is_lit)
+        written = self.ring.written()
+        time.sleep(0.2)
+        self.assertEqual(self.ring.written(), written)
+
+    def test_watchdog(self):
+        saved = TemperatureReader.stale_sample_seconds
+        TemperatureReader.stale_sample_seconds = 0.5
+        try:
+            self.worker.watchdog_seconds = 10
+            self.worker.start()
+            self.worker.handle(run_command(1, 66))
+            Path(self.bus.folder + sensor_ids[1] + "/temperature").unlink()
+            self.assertTrue(wait_until(lambda: not gpio.heater().is_lit and not gpio.pump().is_lit))
+            self.assertTrue(wait_until(lambda: any(m.startswith("error \"Watchdog: Temperatures are") for m in self.messages())))
+        finally:
+            TemperatureReader.stale_sample_seconds = saved
+
+
+class TestControlProcess(unittest.TestCase):
+    """ The real control process, with the stub GPIO, which we can only see through the ring and its messages."""
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = self.folder.name + "/"
+        self.bus = FakeOneWireBus(self.path + "w1/", sensor_ids)
+        self.output = io.StringIO()
+        utils.message_writer.output = self.output
+        self.ring = TelemetryRing.create()
+        self.logger = Logger(self.path + "core")
+        self.event_loop = EventLoop()
+        self.runner = LoopRunner(self.event_loop)
+        self.process = ControlProcess(self.logger, self.event_loop, self.ring, self.path, self.path + "sensor_names.txt")
+        self.process.worker_path = write_fake_worker(self.path + "control_worker.py", ControlProcess.worker_path, self.bus)
+        self.profile = Profile(self.path + "profile.json", self.path + "profile.dat", self.logger)
+        self.profile.create_hold_profile(66, 10)
+
+    def tearDown(self):
+        self.process.close()
+        utils.flush_messages()
+        utils.message_writer.output = None
+        self.logger.close()
+        self.ring.close()
+        self.folder.cleanup()
+
+    def messages(self):
+        utils.flush_messages()
+        return self.output.getvalue().splitlines()
+
+    def test_controls_the_run(self):
+        self.process.keep_running()
+        self.process.start_run(self.profile, None)
+        self.assertTrue(self.runner.run_until(lambda: heater_in_ring(self.ring)))
+        self.assertEqual(latest_record(self.ring)[2], 66)
+        self.assertTrue(self.runner.run_until(lambda: "heat on" in self.messages()))
+        self.profile.change_set_point(10)
+        self.process.change_profile(self.profile)
+        self.assertTrue(self.runner.run_until(lambda: latest_record(self.ring)[2] == 10))
+        self.assertFalse(latest_record(self.ring)[3])
+        self.process.idle()
+        written = self.ring.written()
+        self.assertTrue(self.runner.run_until(lambda: self.ring.written() > written and not latest_record(self.ring)[4]))
+
+    def test_everything_off_when_closed(self):
+        self.process.start_run(self.profile, None)
+        self.assertTrue(self.runner.run_until(lambda: heater_in_ring(self.ring)))
+        self.process.close()
+        self.assertEqual(self.messages()[-2:], ["heat off", "pump off"])
+        self.assertIsNone(self.process.process)
+
+    def test_replaced_with_the_run_when_it_stops(self):
+        self.process.start_run(self.profile, None)
+        self.assertTrue(self.runner.run_until(lambda: heater_in_ring(self.ring)))
+        self.process.process.kill()
+        self.assertTrue(self.runner.run_until(lambda: self.process.process is None))
+        self.assertIn("error \"The control process stopped\"", self.messages())
+        self.process.keep_running()
+        written = self.ring.written()
+        self.assertTrue(self.runner.run_until(lambda: heater_in_ring(self.ring, written)))
+
+
+class TestSplitProcesses(CoreTestCase):
+    """ The core, with the control and log processes on the stub GPIO."""
+
+    settings = {"graph_renderer": "raster", "split_processes": True, "log_period": 0.2}
+
+    def create_core(self):
+        self.saved_worker_path = ControlProcess.worker_path
+        ControlProcess.worker_path = write_fake_worker(self.installation + "control_worker.py", self.saved_worker_path, self.bus)
+        # The stub GPIO is shared by every test in this process, so start again to see whether the core claims the pins.
+        self.saved_pins = gpio.pins
+        gpio.pins = None
+        the_core = core.Core(self.installation)
+        self.runner = LoopRunner(the_core.event_loop)
+        return the_core
+
+    def tearDown(self):
+        super().tearDown()
+        ControlProcess.worker_path = self.saved_worker_path
+        gpio.pins = self.saved_pins
+
+    def test_no_pins_in_the_core(self):
+        self.core.decode_message("hold 66")
+        self.assertTrue(self.runner.run_until(lambda: heater_in_ring(self.core.telemetry)))
+        self.core.decode_message("testmode")
+        self.core.decode_message("idle")
+        self.assertFalse(gpio.claimed())
+
+    def test_hold(self):
+        self.core.decode_message("hold 66")
+        self.assertTrue(self.runner.run_until(lambda: heater_in_ring(self.core.telemetry)))
+        self.assertTrue(self.runner.run_until(lambda: "heat on" in self.messages()))
+        run_folder = self.core.run_folder
+        self.core.decode_message("hold 10")
+        self.assertTrue(self.runner.run_until(lambda: latest_record(self.core.telemetry)[2] == 10))
+        time.sleep(0.5)
+        self.core.decode_message("idle")
+        # The log process adds the run to the catalogue once it has closed the logs.
+        self.assertTrue(self.runner.run_until(lambda: len(self.core.catalogue.recent()) == 1))
+        self.assertEqual(self.core.catalogue.recent()[0]["folder"].rstrip("/"), run_folder.rstrip("/"))
+        temperature_log = list(Path(run_folder).glob("temperature_*.log"))[0].read_text().splitlines()
+        self.assertEqual(temperature_log[0], "Time, Average, " + ", ".join(sensor_ids))
+        self.assertGreater(len(temperature_log), 2)
+        self.assertTrue(Path(run_folder + "run.bin").is_file())
+        written = self.core.telemetry.written()
+        self.assertTrue(self.runner.run_until(lambda: self.core.telemetry.written() > written and not latest_record(self.core.telemetry)[4]))
+
+    def test_status_from_the_ring(self):
+        self.assertTrue(self.runner.run_until(lambda: self.core.telemetry.written() > 0))
+        self.core.send_status()
+        self.assertEqual(self.core.temperatures, [20.0, 20.0])
+        self.assertEqual(self.core.average_temperature, 20.0)
+
+    def test_stats_from_every_process(self):
+        self.core.decode_message("stats on")
+        try:
+            self.core.decode_message("hold 66")
+            self.assertTrue(self.runner.run_until(lambda: any(m.startswith("image " + self.core.run_folder) for m in self.messages())))
+            self.assertTrue(self.runner.run_until(lambda: len(list(Path(self.core.run_folder).glob("state_*.log"))) == 1))
+            # Long enough for a whole sensor cycle since the statistics went on.
+            self.runner.run_until(lambda: False, timeout = 1.5)
+            self.core.decode_message("stats")
+            self.assertTrue(self.runner.run_until(lambda: self.core.stats_request is None, timeout = 5))
+            names = [m.split()[1] for m in self.messages() if m.startswith("stats ")]
+            for name in ["core.decode_message", "control_process.control", "sensor.cycle", "log_process.log", "graph.write"]:
+                self.assertIn(name, names)
+        finally:
+            stats.enable(False)
+            stats.reset()
+
+
+if __name__ == "__main__":
+    unittest.main()
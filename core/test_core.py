@@ -0,0 +1,155 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+Core tests, on stub GPIO and a FakeOneWireBus
+
+    python3 -m unittest test_core
+"""
+
+import io
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from fake_hardware import install_stub_gpio, FakeOneWireBus
+install_stub_gpio()
+
+import core
+import gpio
+import utils
+from activity import Activity
+from temperature_reader import TemperatureReader
+from test_watchdog import wait_until
+
+
+class CoreTestCase(unittest.TestCase):
+    """
+    A Core in a temporary installation folder, with messages to the GUI
+    captured. Nothing runs unless the test starts it.
+    """
+
+    sensor_ids = ["28-000001", "28-000002"]
+
+    # Core class attributes for the test, which are put back afterwards.
+    settings = {"graph_renderer": "raster"}
+
+    def setUp(self):
+        self.saved_settings = {name: getattr(core.Core, name) for name in self.settings}
+        self.saved_device_path = TemperatureReader.one_wire_device_path
+        for name, value in self.settings.items():
+            setattr(core.Core, name, value)
+        self.folder = tempfile.TemporaryDirectory()
+        self.installation = self.folder.name + "/"
+        self.bus = FakeOneWireBus(self.installation + "w1/", CoreTestCase.sensor_ids)
+        self.bus.install()
+        self.output = io.StringIO()
+        utils.message_writer.output = self.output
+        self.core = self.create_core()
+
+    def create_core(self):
+        return core.Core(self.installation)
+
+    def tearDown(self):
+        self.core.controlling = False
+        with self.core.lock:
+            self.core.go_to_idle()
+        self.core.close_finished_graphs()
+        self.core.temperature_reader.stop()
+        self.core.close_workers()
+        utils.flush_messages()
+        utils.message_writer.output = None
+        for name, value in self.saved_settings.items():
+            setattr(core.Core, name, value)
+        TemperatureReader.one_wire_device_path = self.saved_device_path
+        self.folder.cleanup()
+
+    def messages(self):
+        """ Everything sent to the GUI so far."""
+        utils.flush_messages()
+        return self.output.getvalue().splitlines()
+
+
+class TestRunsMessage(CoreTestCase):
+
+    def test_runs(self):
+        self.core.decode_message("hold 66")
+        self.core.decode_message("idle")
+        self.core.decode_message("runs")
+        runs = [m for m in self.messages() if m.startswith("run ")]
+        self.assertEqual(len(runs), 1)
+        self.assertIn("\"hold\"", runs[0])
+
+    def test_bad_count(self):
+        for count in ["abc", "0", "-3", "1.5"]:
+            self.core.decode_message("runs " + count)
+            self.assertIn("error \"Can't list " + count + " runs\"", self.messages())
+        self.assertFalse(any(m.startswith("run ") for m in self.messages()))
+
+
+class ScriptedActivity(Activity):
+    """ An Activity whose controller wants whatever it is told to want, in turn."""
+    def __init__(self, logger, decisions):
+        super().__init__(logger)
+        self.decisions = iter(decisions)
+
+    def state(self, average_temperature, is_heater_on):
+        return 66, Activity.State.COLD, next(self.decisions)
+
+
+class TestControl(CoreTestCase):
+
+    def test_heater_follows_the_controller(self):
+        # Any minimum off time is the controller's business, so the core switches straight back on.
+        decisions = [True, False, True, True, False, False, True]
+        self.core.activity = ScriptedActivity(self.core.logger, decisions)
+        heater = []
+        for d in decisions:
+            self.core.control()
+            heater.append(gpio.heater().is_lit)
+        self.assertEqual(heater, decisions)
+        self.assertTrue(gpio.pump().is_lit)
+        self.assertEqual([m for m in self.messages() if m.startswith("heat")], ["heat on", "heat off", "heat on", "heat off", "heat on"])
+
+
+class TestIdle(CoreTestCase):
+
+    def test_clears_the_time(self):
+        self.core.decode_message("hold 66")
+        self.core.decode_message("idle")
+        self.assertIn("time 0", self.messages())
+
+
+class TestShutDown(CoreTestCase):
+
+    def test_hold_profile_is_up_to_date(self):
+        self.core.decode_message("hold 66")
+        profile = self.core.activity.profile
+        # Held back, as it's so soon after the profile was first written.
+        self.core.decode_message("hold 70")
+        self.assertNotEqual(json.loads(Path(profile.file_path).read_text()), profile.profile)
+        self.core.shut_down()
+        self.assertEqual(json.loads(Path(profile.file_path).read_text()), profile.profile)
+
+
+class TestFinalGraph(CoreTestCase):
+
+    settings = {"graph_renderer": "raster", "graph_hand_off_folder": None}
+
+    def create_core(self):
+        core.Core.graph_hand_off_folder = self.installation + "shm"
+        return super().create_core()
+
+    def test_kept_with_the_run_on_shut_down(self):
+        self.core.decode_message("hold 66")
+        run_folder = self.core.run_folder
+        self.assertTrue(wait_until(lambda: any(m.startswith("image " + self.installation + "shm/") for m in self.messages())))
+        self.core.shut_down()
+        self.assertTrue(Path(run_folder + "graph.png").is_file())
+        # So the next run can't draw over it.
+        self.assertEqual(list(Path(self.installation + "shm").iterdir()), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
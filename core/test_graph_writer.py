@@ -0,0 +1,193 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+GraphWriter tests
+
+    python3 -m unittest test_graph_writer
+"""
+
+import io
+import os
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+from pathlib import Path
+
+import utils
+from graph_writer import GraphWriter, GraphHandOff, BackgroundGraphWriter
+from test_watchdog import wait_until
+
+
+class RecordingLogger:
+    def __init__(self):
+        self.errors = []
+
+    def log(self, text):
+        pass
+
+    def error(self, text):
+        self.errors.append(text)
+
+
+class TestGraphWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = self.folder.name + "/"
+        Path(self.path + "temperature.csv").write_text("Time, Average\n")
+        self.logger = RecordingLogger()
+        self.writer = GraphWriter(self.logger, self.path + "graph.png", self.path + "graph.plt", self.path + "temperature.csv",
+                                  self.path + "profile.dat", self.path + "state.csv", datetime.now())
+        self.saved_path = os.environ.get("PATH")
+
+    def tearDown(self):
+        self.writer.close()
+        if self.saved_path is None:
+            os.environ.pop("PATH", None)
+        else:
+            os.environ["PATH"] = self.saved_path
+        self.folder.cleanup()
+
+    def test_no_gnuplot_is_only_reported_once(self):
+        # Nowhere to find gnuplot.
+        os.environ["PATH"] = self.path
+        for i in range(3):
+            self.assertFalse(self.writer.write(1))
+        self.assertEqual(len(self.logger.errors), 1)
+        self.assertTrue(self.logger.errors[0].startswith("GraphWriter: couldn't start gnuplot"))
+
+
+class TestGraphHandOff(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = self.folder.name + "/"
+        self.hand_off = GraphHandOff(self.path, self.path + "graph.png")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def draw(self, picture):
+        """ Draw where the hand off says, as the graph writers do, and publish it."""
+        path = self.hand_off.next_path()
+        Path(path).write_bytes(picture)
+        return self.hand_off.publish(path)
+
+    def test_alternates_between_buffers(self):
+        self.assertEqual(self.draw(b"one"), self.path + "graph_0.png")
+        self.assertEqual(self.draw(b"two"), self.path + "graph_1.png")
+        self.assertEqual(self.draw(b"three"), self.path + "graph_0.png")
+        # The one the GUI was told about last is left alone.
+        self.assertEqual(Path(self.path + "graph_1.png").read_bytes(), b"two")
+
+    def test_unchanged_picture_isnt_handed_off(self):
+        self.assertEqual(self.draw(b"one"), self.path + "graph_0.png")
+        self.assertIsNone(self.draw(b"one"))
+        self.assertIsNone(self.draw(b"one"))
+        self.assertEqual(self.draw(b"two"), self.path + "graph_1.png")
+
+    def test_buffers_are_replaced_rather_than_drawn_over(self):
+        self.draw(b"one")
+        with open(self.path + "graph_0.png", "rb") as gui:
+            self.draw(b"two")
+            self.draw(b"three")
+            # The GUI, still loading the picture before last, gets all of it.
+            self.assertEqual(gui.read(), b"one")
+        self.assertEqual(sorted(p.name for p in Path(self.path).iterdir()), ["graph_0.png", "graph_1.png"])
+
+    def test_close_keeps_the_last_one(self):
+        self.draw(b"one")
+        self.draw(b"two")
+        self.hand_off.close()
+        self.assertEqual(Path(self.path + "graph.png").read_bytes(), b"two")
+        # Not written again, and the GUI can still load the one it was told about.
+        self.assertEqual(os.stat(self.path + "graph.png").st_ino, os.stat(self.path + "graph_1.png").st_ino)
+        self.assertFalse(Path(self.path + "graph_0.png").exists())
+
+    def test_close_keeps_the_last_one_from_another_folder(self):
+        with tempfile.TemporaryDirectory() as run_folder:
+            keep_path = run_folder + "/graph.png"
+            self.hand_off = GraphHandOff(self.path, keep_path)
+            self.draw(b"one")
+            self.hand_off.close()
+            self.assertEqual(Path(keep_path).read_bytes(), b"one")
+            # So the next run can't draw over it.
+            self.assertEqual(list(Path(self.path).iterdir()), [])
+
+    def test_close_tidies_an_unchanged_drawing(self):
+        self.draw(b"one")
+        self.draw(b"one")
+        self.hand_off.close()
+        self.assertEqual(sorted(p.name for p in Path(self.path).iterdir()), ["graph.png", "graph_0.png"])
+
+    def test_close_without_a_graph(self):
+        self.hand_off.close()
+        self.assertFalse(Path(self.path + "graph.png").exists())
+
+
+class SlowGraphWriter:
+    """ Draws a picture once it's told it can finish."""
+    def __init__(self, logger):
+        self.logger = logger
+        self.graph_path = None
+        self.drawing = threading.Event()
+        self.can_finish = threading.Event()
+
+    def path(self):
+        return self.graph_path
+
+    def set_path(self, graph_output_path):
+        self.graph_path = graph_output_path
+
+    def write(self, timeout = None):
+        self.drawing.set()
+        self.can_finish.wait()
+        Path(self.graph_path).write_bytes(b"picture")
+        return True
+
+    def close(self):
+        pass
+
+
+class TestBackgroundGraphWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = self.folder.name + "/"
+        self.output = io.StringIO()
+        self.saved_message_writer = utils.message_writer
+        utils.message_writer = utils.MessageWriter(self.output)
+        self.hand_off = GraphHandOff(self.path, self.path + "graph.png")
+        self.graph_writer = SlowGraphWriter(RecordingLogger())
+        self.writer = BackgroundGraphWriter(self.graph_writer, self.hand_off)
+
+    def tearDown(self):
+        self.graph_writer.can_finish.set()
+        self.writer.close()
+        utils.flush_messages()
+        utils.message_writer = self.saved_message_writer
+        self.folder.cleanup()
+
+    def test_sends_the_image(self):
+        self.graph_writer.can_finish.set()
+        self.writer.write()
+        self.assertTrue(wait_until(lambda: utils.flush_messages() or self.output.getvalue() != ""))
+        self.assertEqual(self.output.getvalue(), "image " + self.path + "graph_0.png\n")
+
+    def test_nothing_is_sent_once_closed(self):
+        self.writer.write()
+        self.assertTrue(self.graph_writer.drawing.wait(1))
+        # Gives up waiting for the picture being drawn.
+        self.writer.close(timeout = 0)
+        self.graph_writer.can_finish.set()
+        self.writer.thread.join(1)
+        utils.flush_messages()
+        self.assertEqual(self.output.getvalue(), "")
+        # Still kept with the run.
+        self.assertEqual(Path(self.path + "graph.png").read_bytes(), b"picture")
+
+
+if __name__ == "__main__":
+    unittest.main()
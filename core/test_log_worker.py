@@ -0,0 +1,85 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+Log process tests
+
+    python3 -m unittest test_log_worker
+"""
+
+import io
+import tempfile
+import unittest
+from pathlib import Path
+
+from log_worker import LogWorker
+from logger import Logger
+from run_log import RunLogReader
+from telemetry import TelemetryRing
+
+
+class TestLogWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = self.folder.name + "/"
+        self.ring = TelemetryRing.create()
+        self.logger = Logger(self.path + "log")
+        self.output = io.StringIO()
+        self.worker = LogWorker(self.ring, self.logger, self.output)
+
+    def tearDown(self):
+        self.worker.close()
+        self.logger.close()
+        self.ring.close()
+        self.folder.cleanup()
+
+    def record(self, average, heater_is_on = False):
+        self.ring.append(0.0, average, 66.0, heater_is_on, True, [average - 0.5, average + 0.5])
+
+    def start(self, **options):
+        command = {"command": "start", "run": 1, "run_folder": self.path, "sensor_names": ["Top", "Bottom"], "from": self.ring.written()}
+        command.update(options)
+        self.worker.handle(command)
+
+    def lines(self, pattern):
+        return list(Path(self.path).glob(pattern))[0].read_text().splitlines()
+
+    def test_logs_each_window(self):
+        self.record(60.0)
+        self.start(window_columns = True, raw = True)
+        self.record(61.0, True)
+        self.record(63.0, True)
+        self.worker.log()
+        self.worker.handle({"command": "close", "run": 1})
+        self.assertEqual(self.output.getvalue(), "closed " + self.path + "\n")
+
+        temperature_log = self.lines("temperature_*.log")
+        self.assertEqual(temperature_log[0], "Time, Average, Top, Bottom, Minimum, Maximum")
+        # The latest samples when the run started, then the window since.
+        self.assertEqual([line.split(", ")[1:] for line in temperature_log[1:]],
+                         [["60.0", "59.5", "60.5", "60.0", "60.0"], ["62.0", "61.5", "62.5", "61.0", "63.0"]])
+        self.assertEqual([line.split(", ")[1:] for line in self.lines("state_*.log")[1:]], [["66.0", "0", "1"], ["66.0", "1", "1"]])
+        # Every sample recorded since the run started.
+        self.assertEqual(len(self.lines("raw_temperature_*.log")), 3)
+        log = RunLogReader(self.path + "run.bin")
+        self.assertEqual(len(log), 2)
+        self.assertEqual(list(log.column("Maximum")), [60.0, 63.0])
+        log.close()
+
+    def test_nothing_new_logs_the_latest(self):
+        self.record(60.0)
+        self.start()
+        self.worker.log()
+        self.worker.handle({"command": "close", "run": 1})
+        self.assertEqual([line.split(", ")[1:] for line in self.lines("temperature_*.log")[1:]], [["60.0", "59.5", "60.5"]] * 2)
+
+    def test_commands_for_an_old_run_are_ignored(self):
+        self.start()
+        self.worker.handle({"command": "close", "run": 0})
+        self.assertEqual(self.output.getvalue(), "")
+        self.assertEqual(self.worker.run, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
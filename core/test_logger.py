@@ -0,0 +1,73 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+Logger tests
+
+    python3 -m unittest test_logger
+"""
+
+import tempfile
+import unittest
+from pathlib import Path
+
+from logger import Logger, TemperatureLogger
+
+
+class TestTemperatureLogger(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = self.folder.name + "/"
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def lines(self, logger):
+        logger.close()
+        return Path(logger.path).read_text().splitlines()
+
+    def test_format(self):
+        logger = TemperatureLogger(self.path, ["Top", "Bottom"], buffered = True)
+        logger.log_temperatures([66.0625, 65.875], 65.96875, (65.9, 66.1))
+        header, line = self.lines(logger)
+        self.assertEqual(header, "Time, Average, Top, Bottom")
+        self.assertEqual(line.split(", ")[1:], ["65.96875", "66.0625", "65.875"])
+
+    def test_window_columns(self):
+        logger = TemperatureLogger(self.path, ["Top", "Bottom"], window_columns = True)
+        logger.log_temperatures([66.0625, 65.875], 65.96875, (65.9, 66.1))
+        logger.log_temperatures([66.0, 66.0], 66.0)
+        header, first, second = self.lines(logger)
+        self.assertEqual(header, "Time, Average, Top, Bottom, Minimum, Maximum")
+        self.assertEqual(first.split(", ")[1:], ["65.96875", "66.0625", "65.875", "65.9", "66.1"])
+        self.assertEqual(second.split(", ")[1:], ["66.0", "66.0", "66.0", "66.0", "66.0"])
+
+
+class TestBufferedLogger(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.logger = Logger(self.folder.name + "/test", initial_log = "Test", buffered = True)
+
+    def tearDown(self):
+        self.logger.close()
+        self.folder.cleanup()
+
+    def written(self):
+        return Path(self.logger.path).read_text().splitlines()
+
+    def test_held_back_until_flushed(self):
+        self.logger.log("one")
+        self.assertEqual(self.written(), ["Test"])
+        self.logger.checkpoint()
+        self.assertEqual(len(self.written()), 2)
+
+    def test_errors_go_straight_out(self):
+        self.logger.log("one")
+        self.logger.error("two")
+        self.assertEqual([line.split(", ", 1)[1] for line in self.written()[1:]], ["one", "two"])
+
+
+if __name__ == "__main__":
+    unittest.main()
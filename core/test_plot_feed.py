@@ -0,0 +1,80 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+PlotFeed and MinMaxDecimator tests
+
+    python3 -m unittest test_plot_feed
+"""
+
+import tempfile
+import unittest
+from pathlib import Path
+
+from plot_feed import MinMaxDecimator, PlotFeed
+
+
+class TestMinMaxDecimator(unittest.TestCase):
+
+    def test_rows_kept_until_there_are_too_many(self):
+        decimator = MinMaxDecimator(max_points = 8)
+        for t in range(4):
+            decimator.add(t, [float(t)])
+        self.assertEqual(decimator.rows(), [(0, [0.0]), (1, [1.0]), (2, [2.0]), (3, [3.0])])
+
+    def test_bucket_keeps_minimum_and_maximum_in_order(self):
+        decimator = MinMaxDecimator(max_points = 2)
+        # One bucket, so everything is squashed into two rows. The maximum
+        # comes before the minimum, so it is drawn first.
+        for t, value in enumerate([50.0, 70.0, 55.0, 40.0, 60.0]):
+            decimator.add(t, [value])
+        self.assertEqual(decimator.rows(), [(0, [70.0]), (4, [40.0])])
+
+    def test_columns_are_independent(self):
+        decimator = MinMaxDecimator(max_points = 2)
+        for t, values in enumerate([[60.0, 0], [61.0, 1], [59.0, 0]]):
+            decimator.add(t, values)
+        self.assertEqual(decimator.rows(), [(0, [61.0, 0]), (2, [59.0, 1])])
+
+    def test_peaks_and_the_last_point_survive_decimation(self):
+        decimator = MinMaxDecimator(max_points = 20)
+        values = [60.0] * 1000
+        values[123] = 80.0
+        values[456] = 30.0
+        for t, value in enumerate(values):
+            decimator.add(t, [value])
+        rows = decimator.rows()
+        self.assertLessEqual(len(rows), 20)
+        self.assertEqual(max(r[1][0] for r in rows), 80.0)
+        self.assertEqual(min(r[1][0] for r in rows), 30.0)
+        self.assertEqual(rows[0][0], 0)
+        self.assertEqual(rows[-1][0], 999)
+        self.assertEqual([r[0] for r in rows], sorted(r[0] for r in rows))
+
+
+class TestPlotFeed(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.feed = PlotFeed(self.folder.name)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def lines(self, name):
+        return Path(self.folder.name + "/" + name).read_text().splitlines()
+
+    def test_empty_files_to_start_with(self):
+        self.assertEqual(self.lines("plot_temperature.csv"), ["Time, Average"])
+        self.assertEqual(self.lines("plot_state.csv"), ["Time, Target, Heater, Pump"])
+
+    def test_only_written_when_asked(self):
+        self.feed.add(0, 60.0, 66.0, True, False)
+        self.assertEqual(len(self.lines("plot_temperature.csv")), 1)
+        self.feed.write()
+        self.assertEqual(self.lines("plot_temperature.csv")[1].split(", ")[1:], ["60.0000"])
+        self.assertEqual(self.lines("plot_state.csv")[1].split(", ")[1:], ["66.0", "1", "0"])
+
+
+if __name__ == "__main__":
+    unittest.main()
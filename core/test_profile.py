@@ -0,0 +1,144 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+Profile tests
+
+    python3 -m unittest test_profile
+"""
+
+import json
+import math
+import os
+import random
+import tempfile
+import unittest
+
+import profile
+from profile import Profile, ProfileCache
+
+
+class NullLogger:
+    def log(self, message):
+        pass
+
+    def error(self, message):
+        pass
+
+
+steps = [
+    {"start": 40},
+    {"rest": 10},
+    {"ramp": 15, "to": 66},
+    {"rest": 60},
+    {"jump": 72},
+    {"rest": 10},
+    {"ramp": 0, "to": 75},
+    {"mashout": 78},
+]
+
+
+class TestTemperaturesAt(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        path = self.folder.name + "/"
+        details = {"name": "Test", "description": "Every kind of step", "steps": steps}
+        self.profile = Profile(path + "profile.json", path + "profile.dat", NullLogger(), details)
+        random.seed(1)
+        edges = [0, 600, 1500, 5100, 5700]
+        self.times = [random.uniform(-60, 7200) for i in range(2000)] + edges + [e + d for e in edges for d in (-1e-9, 1e-9)]
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def check(self, times):
+        expected = [self.profile.temperature_at(t) for t in times]
+        self.assertEqual(list(self.profile.temperatures_at(times)), expected)
+
+    def check_with_and_without_numpy(self, times):
+        self.check(times)
+        saved = profile.numpy
+        profile.numpy = None
+        try:
+            self.check(times)
+        finally:
+            profile.numpy = saved
+
+    def test_in_order(self):
+        self.check_with_and_without_numpy(sorted(self.times))
+
+    def test_out_of_order(self):
+        self.check_with_and_without_numpy(self.times)
+
+    def test_no_times(self):
+        self.check_with_and_without_numpy([])
+
+    def test_no_steps(self):
+        self.profile = Profile(self.folder.name + "/none.json", self.folder.name + "/none.dat", NullLogger(), {"steps": []})
+        self.assertTrue(all(math.isnan(t) for t in self.profile.temperatures_at([0, 10])))
+        saved = profile.numpy
+        profile.numpy = None
+        try:
+            self.assertTrue(all(math.isnan(t) for t in self.profile.temperatures_at([0, 10])))
+        finally:
+            profile.numpy = saved
+
+    def test_shape(self):
+        self.assertEqual(list(self.profile.temperatures_at([0, 300, 600, 1050, 1500, 5400, 9000])), [40, 40, 40, 53, 66, 72, 78])
+
+
+class TestProfileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = self.folder.name + "/"
+        self.cache = ProfileCache(NullLogger())
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def write(self, name, description, mtime_ns):
+        path = self.path + name + ".json"
+        with open(path, "w") as f:
+            json.dump({"name": name, "description": description, "steps": steps}, f)
+        # Set explicitly, so a rewrite in the same clock tick still looks changed.
+        os.utime(path, ns = (mtime_ns, mtime_ns))
+        return path
+
+    def test_hit_until_the_file_changes(self):
+        path = self.write("Wheat", "first", 1000000000)
+        first = self.cache.get(path)
+        self.assertIs(self.cache.get(path), first)
+        self.write("Wheat", "second", 2000000000)
+        second = self.cache.get(path)
+        self.assertIsNot(second, first)
+        self.assertEqual(second.description, "second")
+        self.assertEqual(second.duration_minutes, Profile.plot_points(steps, NullLogger())[-1][0].total_seconds() / 60)
+        self.assertEqual((second.minimum_temperature, second.maximum_temperature), (40, 78))
+
+    def test_deleted_file(self):
+        path = self.write("Wheat", "first", 1000000000)
+        self.cache.get(path)
+        os.remove(path)
+        self.assertIsNone(self.cache.get(path))
+        self.assertEqual(self.cache.entries, {})
+
+    def test_bad_profile_isnt_kept(self):
+        path = self.path + "bad.json"
+        with open(path, "w") as f:
+            json.dump({"name": "Bad", "description": "", "steps": [{"boil": 100}]}, f)
+        self.assertIsNone(self.cache.get(path))
+        self.assertEqual(self.cache.entries, {})
+
+    def test_list_forgets_removed_files(self):
+        keep = self.write("Wheat", "kept", 1000000000)
+        remove = self.write("Stout", "removed", 1000000000)
+        self.assertEqual(sorted(p["name"] for p in self.cache.get_list(self.path)), ["Stout", "Wheat"])
+        os.remove(remove)
+        self.assertEqual([p["name"] for p in self.cache.get_list(self.path)], ["Wheat"])
+        self.assertEqual(list(self.cache.entries), [keep])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+RasterGraphWriter tests
+
+    python3 -m unittest test_raster_graph
+"""
+
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from graph_writer import GraphHandOff
+from raster_graph import RasterGraphWriter
+
+
+class RecordingLogger:
+    def __init__(self):
+        self.errors = []
+
+    def log(self, text):
+        pass
+
+    def error(self, text):
+        self.errors.append(text)
+
+
+class TestRasterGraphWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = self.folder.name + "/"
+        self.start = datetime(2021, 3, 20, 10, 15)
+        self.logger = RecordingLogger()
+        self.write_data([], [])
+        Path(self.path + "profile.dat").write_text(self.time(0) + ", 66\n" + self.time(3600) + ", 66\n")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def time(self, seconds):
+        return (self.start + timedelta(seconds = seconds)).strftime("%H:%M:%S")
+
+    def write_data(self, temperatures, state):
+        """ temperatures: (seconds, average), state: (seconds, target, heater, pump)"""
+        Path(self.path + "temperature.csv").write_text("Time, Average\n" + "".join(
+            "{0}, {1}\n".format(self.time(t), a) for t, a in temperatures))
+        Path(self.path + "state.csv").write_text("Time, Target, Heater, Pump\n" + "".join(
+            "{0}, {1}, {2}, {3}\n".format(self.time(t), target, heater, pump) for t, target, heater, pump in state))
+
+    def create_writer(self, graph_path):
+        return RasterGraphWriter(self.logger, graph_path, self.path + "temperature.csv", self.path + "profile.dat",
+                                 self.path + "state.csv", self.start)
+
+    def write_profile(self, points):
+        Path(self.path + "profile.dat").write_text("".join("{0}, {1}\n".format(self.time(t), v) for t, v in points))
+
+    def assert_same_as_a_full_redraw(self, writer):
+        fresh = self.create_writer(self.path + "fresh.png")
+        self.assertTrue(fresh.write())
+        self.assertEqual(fresh.end_seconds, writer.end_seconds)
+        self.assertEqual(Path(writer.path()).read_bytes(), Path(fresh.path()).read_bytes())
+
+    def test_incremental_updates_are_the_same_as_a_full_redraw(self):
+        writer = self.create_writer(self.path + "graph.png")
+        temperatures = [(t, 40.0 + t / 100) for t in range(0, 600, 10)]
+        state = [(t, 66, 1, 1) for t in range(0, 600, 10)]
+        self.write_data(temperatures, state)
+        self.assertTrue(writer.write())
+        # More data, with the heater going off.
+        temperatures.extend((t, 46.0 + (t % 70) / 20) for t in range(600, 1200, 10))
+        state.extend((t, 66, t // 100 % 2, 1) for t in range(600, 1200, 10))
+        self.write_data(temperatures, state)
+        self.assertTrue(writer.write())
+        self.assert_same_as_a_full_redraw(writer)
+        # The rows squashed up, as a PlotFeed does, so an early one changes.
+        temperatures = temperatures[:3] + [(30, 80.0)] + temperatures[5:]
+        self.write_data(temperatures, state)
+        self.assertTrue(writer.write())
+        self.assert_same_as_a_full_redraw(writer)
+        # A hold's set point changed, twice.
+        self.write_profile([(0, 66), (1200, 66), (1200, 70), (3600, 70)])
+        self.assertTrue(writer.write())
+        self.assert_same_as_a_full_redraw(writer)
+        self.write_profile([(0, 66), (1200, 66), (1200, 70), (2400, 70), (2400, 75), (3600, 75)])
+        self.assertTrue(writer.write())
+        self.assert_same_as_a_full_redraw(writer)
+
+    def test_time_axis_grows_in_steps(self):
+        writer = self.create_writer(self.path + "graph.png")
+        self.write_data([(0, 50.0), (3600, 66.0)], [(0, 66, 1, 1), (3600, 66, 0, 1)])
+        self.assertTrue(writer.write())
+        self.assertEqual(writer.end_seconds, 3600)
+        self.write_data([(0, 50.0), (3600, 66.0), (3610, 66.0)], [(0, 66, 1, 1), (3600, 66, 0, 1), (3610, 66, 0, 1)])
+        self.assertTrue(writer.write())
+        self.assertEqual(writer.end_seconds, 3600 * RasterGraphWriter.axis_growth)
+        # No longer until the data gets there.
+        self.write_data([(0, 50.0), (3600, 66.0), (5400, 66.0)], [(0, 66, 1, 1), (3600, 66, 0, 1), (5400, 66, 0, 1)])
+        self.assertTrue(writer.write())
+        self.assertEqual(writer.end_seconds, 5400)
+        self.assert_same_as_a_full_redraw(writer)
+
+    def test_unchanged_picture_is_drawn_again_for_a_hand_off(self):
+        hand_off = GraphHandOff(self.path, self.path + "graph.png")
+        writer = self.create_writer(hand_off.next_path())
+        self.write_data([(0, 50.0), (10, 51.0)], [(0, 66, 1, 1), (10, 66, 1, 1)])
+        self.assertTrue(writer.write())
+        self.assertEqual(hand_off.publish(writer.path()), self.path + "graph_0.png")
+        # Nothing has changed, but the picture we drew has been handed off.
+        self.assertTrue(writer.write())
+        self.assertIsNone(hand_off.publish(writer.path()))
+        self.assertEqual(self.logger.errors, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+Replay tests: a recorded run replayed through the core does what the core did
+
+    python3 -m unittest test_replay
+"""
+
+import io
+import json
+import tempfile
+import unittest
+from datetime import datetime
+from pathlib import Path
+
+from fake_hardware import install_stub_gpio
+install_stub_gpio()
+
+import clock
+import core
+import replay
+import utils
+from run_log import RunLogWriter
+
+
+def state_log(run_folder):
+    """ The state log's rows, without their times."""
+    path = next(Path(run_folder).glob("state_*.log"))
+    return [line.split(", ")[1:] for line in path.read_text().splitlines()[1:]]
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_renderer = core.Core.graph_renderer
+        core.Core.graph_renderer = "raster"
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = self.folder.name + "/"
+        utils.message_writer.output = io.StringIO()
+
+    def tearDown(self):
+        clock.set_clock(clock.SystemClock())
+        utils.flush_messages()
+        utils.message_writer.output = None
+        core.Core.graph_renderer = self.saved_renderer
+        self.folder.cleanup()
+
+    def recorded_hold(self):
+        """ A hold at 66, heating up from 50 and then overshooting a little."""
+        folder = self.path + "recorded/hold_2021-03-20_101500/"
+        Path(folder).mkdir(parents=True)
+        Path(folder + "profile.json").write_text(json.dumps({"name": "Hold", "steps": [{"start": 66}, {"rest": 60}]}))
+        start = datetime(2021, 3, 20, 10, 15).timestamp()
+        writer = RunLogWriter(folder + "run.bin", ["Top", "Bottom"])
+        for i in range(120):
+            average = min(50.0 + i * 0.25, 67.0)
+            writer.append(start + 10 * i, average, [average - 0.5, average + 0.5], 66.0, False, True)
+        writer.close()
+        return folder
+
+    def installation(self, name):
+        folder = self.path + name + "/"
+        Path(folder).mkdir()
+        return folder
+
+    def test_replay_of_a_replay_is_the_same(self):
+        first = replay.replay(self.recorded_hold(), self.installation("first"))
+        second = replay.replay(first, self.installation("second"))
+        original = state_log(first)
+        self.assertGreater(len(original), 100)
+        # The heater came on to heat up, and went off when it got there.
+        heater = [row[1] for row in original]
+        self.assertIn("1", heater)
+        self.assertEqual(heater[-1], "0")
+        self.assertEqual(state_log(second), original)
+        self.assertEqual(Path(second).name, Path(first).name)
+
+    def test_logs_the_recorded_temperatures(self):
+        recorded = self.recorded_hold()
+        replayed = replay.replay(recorded, self.installation("replayed"))
+        self.assertEqual(replay.recorded_samples(replayed), replay.recorded_samples(recorded))
+
+    def test_no_samples(self):
+        folder = self.path + "hold_2021-03-20_101500/"
+        Path(folder).mkdir()
+        RunLogWriter(folder + "run.bin", ["Top"]).close()
+        with self.assertRaises(RuntimeError):
+            replay.replay(folder, self.installation("replayed"))
+
+    def test_not_a_run_folder(self):
+        folder = self.installation("something_else")
+        with self.assertRaises(RuntimeError):
+            replay.replay(folder, self.installation("replayed"))
+
+
+if __name__ == "__main__":
+    unittest.main()
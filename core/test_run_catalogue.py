@@ -0,0 +1,110 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+RunCatalogue tests
+
+    python3 -m unittest test_run_catalogue
+"""
+
+import json
+import tempfile
+import unittest
+from datetime import datetime
+from pathlib import Path
+
+from run_catalogue import RunCatalogue, summarise_run_folder, parse_run_folder_name
+from run_log import RunLogWriter
+
+
+class RecordingLogger:
+    def __init__(self):
+        self.errors = []
+
+    def error(self, text):
+        self.errors.append(text)
+
+
+class TestRunCatalogue(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.runs = self.folder.name + "/runs/"
+        Path(self.runs).mkdir()
+        self.logger = RecordingLogger()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def binary_run(self, name, averages):
+        folder = self.runs + name + "/"
+        Path(folder).mkdir()
+        start = parse_run_folder_name(name)[2].timestamp()
+        writer = RunLogWriter(folder + "run.bin", ["Top"])
+        for i, average in enumerate(averages):
+            writer.append(start + 10 * i, average, [average], 66.0, False, True)
+        writer.close()
+        return folder
+
+    def csv_run(self, name, lines):
+        folder = self.runs + name + "/"
+        Path(folder).mkdir()
+        Path(folder + "temperature_x.log").write_text("Time, Average, Top\n" + "".join(line + "\n" for line in lines))
+        return folder
+
+    def test_summary_from_the_run_log(self):
+        folder = self.binary_run("hold_2021-03-20_101500", [60.0, 62.0, 64.0])
+        summary = summarise_run_folder(folder)
+        self.assertEqual(summary["type"], "hold")
+        self.assertEqual(summary["profile"], "Hold")
+        self.assertEqual(summary["start"], datetime(2021, 3, 20, 10, 15).timestamp())
+        self.assertEqual(summary["duration"], 20)
+        self.assertEqual((summary["samples"], summary["minimum"], summary["maximum"], summary["mean"]), (3, 60.0, 64.0, 62.0))
+
+    def test_summary_from_the_csv_across_midnight(self):
+        folder = self.csv_run("preset_Wheat-beer_2021-03-20_235950", ["23:59:50, 60.0, 60.0", "00:00:10, 62.0, 62.0", "bad line"])
+        Path(folder + "Wheat-beer.json").write_text(json.dumps({"name": "Wheat beer"}))
+        summary = summarise_run_folder(folder)
+        self.assertEqual(summary["profile"], "Wheat beer")
+        self.assertEqual(summary["duration"], 20)
+        self.assertEqual(summary["samples"], 2)
+
+    def test_not_a_run(self):
+        Path(self.runs + "something_else").mkdir()
+        self.assertIsNone(summarise_run_folder(self.runs + "something_else"))
+
+    def test_new_catalogue_is_built_from_the_runs_folder(self):
+        self.binary_run("hold_2021-03-20_101500", [60.0])
+        self.binary_run("hold_2021-03-21_101500", [61.0])
+        Path(self.runs + "something_else").mkdir()
+        catalogue = RunCatalogue(self.runs + "catalogue.sqlite", self.runs, self.logger)
+        # Newest first.
+        self.assertEqual([Path(run["folder"]).name for run in catalogue.recent()], ["hold_2021-03-21_101500", "hold_2021-03-20_101500"])
+        self.assertEqual(len(catalogue.recent(1)), 1)
+        catalogue.close()
+
+    def test_add_replaces(self):
+        catalogue = RunCatalogue(self.runs + "catalogue.sqlite", self.runs, self.logger)
+        self.assertEqual(catalogue.recent(), [])
+        folder = self.binary_run("hold_2021-03-20_101500", [60.0])
+        catalogue.add(folder)
+        writer = RunLogWriter(folder + "run.bin", ["Top"])
+        writer.append(datetime(2021, 3, 20, 10, 25).timestamp(), 70.0, [70.0], 66.0, False, True)
+        writer.close()
+        catalogue.add(folder)
+        runs = catalogue.recent()
+        self.assertEqual(len(runs), 1)
+        self.assertEqual((runs[0]["samples"], runs[0]["duration"], runs[0]["maximum"]), (2, 600, 70.0))
+        catalogue.close()
+
+    def test_kept_between_uses(self):
+        catalogue = RunCatalogue(self.runs + "catalogue.sqlite", self.runs, self.logger)
+        catalogue.add(self.binary_run("hold_2021-03-20_101500", [60.0]))
+        catalogue.close()
+        catalogue = RunCatalogue(self.runs + "catalogue.sqlite", self.runs, self.logger)
+        self.assertEqual(len(catalogue.recent()), 1)
+        catalogue.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
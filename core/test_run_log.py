@@ -0,0 +1,92 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+Binary run log tests
+
+    python3 -m unittest test_run_log
+"""
+
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from run_log import RunLogWriter, RunLogReader, write_csv
+
+
+class TestRunLog(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = self.folder.name + "/"
+        self.start = time.time()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def write(self, with_window_columns = False):
+        writer = RunLogWriter(self.path + "run.bin", ["Top", "Bottom"], with_window_columns)
+        writer.append(self.start, 60.0, [59.5, 60.5], 66.0, True, True, (59.0, 61.0))
+        writer.append(self.start + 10, 61.0, [60.5, 61.5], 66.0, False, True)
+        return writer
+
+    def test_records_read_back(self):
+        self.write().close()
+        reader = RunLogReader(self.path + "run.bin")
+        self.assertEqual(reader.columns, ["Time", "Average", "Top", "Bottom", "Target", "Heater", "Pump"])
+        self.assertEqual(reader.sensor_names(), ["Top", "Bottom"])
+        self.assertEqual(list(reader.records()), [(self.start, 60.0, 59.5, 60.5, 66.0, 1.0, 1.0), (self.start + 10, 61.0, 60.5, 61.5, 66.0, 0.0, 1.0)])
+        self.assertEqual(reader.column("Average").tolist(), [60.0, 61.0])
+        reader.close()
+
+    def test_window_columns(self):
+        self.write(with_window_columns = True).close()
+        reader = RunLogReader(self.path + "run.bin")
+        self.assertEqual(reader.columns[4:6], ["Minimum", "Maximum"])
+        # Without a window, the average is the whole window.
+        self.assertEqual(reader.column("Minimum").tolist(), [59.0, 61.0])
+        self.assertEqual(reader.column("Maximum").tolist(), [61.0, 61.0])
+        reader.close()
+
+    def test_only_whole_records_until_refreshed(self):
+        writer = self.write()
+        writer.flush()
+        reader = RunLogReader(self.path + "run.bin")
+        writer.append(self.start + 20, 62.0, [61.5, 62.5], 66.0, False, True)
+        writer.flush()
+        with open(self.path + "run.bin", "ab") as f:
+            # Half a record, as if we'd been stopped mid-write.
+            f.write(b"\0" * 12)
+        self.assertEqual(len(reader), 2)
+        reader.refresh()
+        self.assertEqual(len(reader), 3)
+        self.assertEqual(reader.column("Average").tolist(), [60.0, 61.0, 62.0])
+        reader.close()
+        writer.close()
+
+    def test_appends_to_an_existing_log(self):
+        self.write().close()
+        self.write().close()
+        reader = RunLogReader(self.path + "run.bin")
+        self.assertEqual(len(reader), 4)
+        reader.close()
+
+    def test_not_a_run_log(self):
+        Path(self.path + "run.bin").write_bytes(b"NOTARUN!" + b"\0" * 8)
+        with self.assertRaises(RuntimeError):
+            RunLogReader(self.path + "run.bin")
+
+    def test_csv_like_the_loggers(self):
+        self.write(with_window_columns = True).close()
+        write_csv(self.path + "run.bin", self.path + "temperature.log", self.path + "state.log", with_window_columns = True)
+        temperatures = Path(self.path + "temperature.log").read_text().splitlines()
+        self.assertEqual(temperatures[0], "Time, Average, Top, Bottom, Minimum, Maximum")
+        self.assertEqual(temperatures[1].split(", ")[1:], ["60.0", "59.5", "60.5", "59.0", "61.0"])
+        state = Path(self.path + "state.log").read_text().splitlines()
+        self.assertEqual(state[0], "Time, Target, Heater, Pump")
+        self.assertEqual([line.split(", ")[1:] for line in state[1:]], [["66.0", "1", "1"], ["66.0", "0", "1"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
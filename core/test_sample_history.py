@@ -0,0 +1,57 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+SampleHistory tests
+
+    python3 -m unittest test_sample_history
+"""
+
+import math
+import unittest
+
+from sample_history import SampleHistory
+
+
+class TestSampleHistory(unittest.TestCase):
+
+    def test_empty(self):
+        history = SampleHistory(4)
+        self.assertIsNone(history.latest())
+        self.assertEqual(len(history.snapshot()), 0)
+        self.assertIsNone(history.snapshot().latest())
+        self.assertTrue(math.isnan(history.snapshot().mean()))
+
+    def test_oldest_first_after_wrapping(self):
+        history = SampleHistory(4)
+        for t in range(6):
+            history.add(t, 10.0 * t)
+        snapshot = history.snapshot()
+        self.assertEqual(list(snapshot.times), [2, 3, 4, 5])
+        self.assertEqual(list(snapshot.values), [20, 30, 40, 50])
+        self.assertEqual(history.latest(), (5, 50.0))
+        self.assertEqual(snapshot.latest(), (5, 50.0))
+
+    def test_snapshot_is_shared_until_the_next_sample(self):
+        history = SampleHistory(4)
+        history.add(1, 1.0)
+        snapshot = history.snapshot()
+        self.assertIs(history.snapshot(), snapshot)
+        history.add(2, 2.0)
+        self.assertIsNot(history.snapshot(), snapshot)
+        # Earlier snapshots don't change.
+        self.assertEqual(list(snapshot.values), [1.0])
+        self.assertEqual(list(history.snapshot().values), [1.0, 2.0])
+
+    def test_window_statistics(self):
+        history = SampleHistory(10)
+        for t in range(10):
+            history.add(t, 60 + t / 60)
+        snapshot = history.snapshot()
+        self.assertAlmostEqual(snapshot.slope(), 1.0)
+        self.assertAlmostEqual(snapshot.mean(2), 60 + 8 / 60)
+        self.assertEqual(len(snapshot.window(2)[0]), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
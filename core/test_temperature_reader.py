@@ -0,0 +1,138 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+TemperatureReader tests, against a FakeOneWireBus
+
+    python3 -m unittest test_temperature_reader
+"""
+
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from fake_hardware import FakeOneWireBus
+from temperature_reader import TemperatureReader
+
+
+class TestTemperatureReader(unittest.TestCase):
+
+    sensor_ids = ["28-000001", "28-000002", "28-000003"]
+
+    def setUp(self):
+        self.saved = (TemperatureReader.one_wire_device_path, TemperatureReader.minimum_cycle_seconds)
+        TemperatureReader.minimum_cycle_seconds = 0.05
+        self.folder = tempfile.TemporaryDirectory()
+        self.reader = None
+
+    def tearDown(self):
+        if self.reader is not None:
+            self.reader.stop()
+        TemperatureReader.one_wire_device_path, TemperatureReader.minimum_cycle_seconds = self.saved
+        self.folder.cleanup()
+
+    def bus(self, bulk_read):
+        bus = FakeOneWireBus(self.folder.name + "/w1/", TestTemperatureReader.sensor_ids, bulk_read)
+        bus.install()
+        for n, i in enumerate(TestTemperatureReader.sensor_ids):
+            bus.set_temperature(i, 60 + n)
+        return bus
+
+    def start(self, **options):
+        self.reader = TemperatureReader(self.folder.name + "/sensor_names.txt", **options)
+        self.reader.start()
+        return self.reader
+
+    def read_twice(self):
+        """ Wait for two complete sets of samples, so the second was read with whatever the first changed."""
+        cycle = self.reader.wait_for_samples(None)
+        for i in range(2):
+            latest = self.reader.wait_for_samples(cycle, timeout = 5)
+            self.assertNotEqual(latest, cycle, "no new samples")
+            cycle = latest
+        return self.reader.temperatures()
+
+    def resolutions(self, bus, sensor_ids = sensor_ids):
+        return [Path(bus.folder + i + "/resolution").read_text().strip() for i in sensor_ids]
+
+    def test_bulk_read(self):
+        bus = self.bus(bulk_read = True)
+        self.start(concurrent = True, bulk_read = True, resolution = 9)
+        self.assertEqual(self.read_twice(), [60, 61, 62])
+        self.assertTrue(self.reader.bulk_read)
+        self.reader.stop()
+        # The conversion was started with a bulk read, at the resolution we asked for.
+        self.assertEqual(Path(bus.folder + "w1_bus_master1/therm_bulk_read").read_text(), "trigger")
+        self.assertEqual(self.resolutions(bus), ["9", "9", "9"])
+
+    def test_bulk_read_sees_new_temperatures(self):
+        bus = self.bus(bulk_read = True)
+        self.start(concurrent = True, bulk_read = True, resolution = 9)
+        self.read_twice()
+        bus.set_all_temperatures(66.5)
+        self.assertEqual(self.read_twice(), [66.5, 66.5, 66.5])
+
+    def test_no_bulk_read_falls_back_to_individual_reads(self):
+        bus = self.bus(bulk_read = False)
+        self.start(concurrent = True, bulk_read = True)
+        self.assertFalse(self.reader.bulk_read)
+        self.assertEqual(self.read_twice(), [60, 61, 62])
+        self.assertFalse(Path(bus.folder + "w1_bus_master1/therm_bulk_read").exists())
+        # Left as they were.
+        self.assertEqual(self.resolutions(bus), ["12", "12", "12"])
+
+    def test_failed_bulk_read_falls_back_to_individual_reads(self):
+        bus = self.bus(bulk_read = True)
+        self.start(concurrent = True, bulk_read = True, resolution = 9)
+        self.read_twice()
+        # Now the trigger can't be written: swap it, in one go, for a link to nowhere.
+        trigger = bus.folder + "w1_bus_master1/therm_bulk_read"
+        os.symlink(bus.folder + "missing/therm_bulk_read", trigger + ".link")
+        os.replace(trigger + ".link", trigger)
+        bus.set_all_temperatures(70)
+        self.assertEqual(self.read_twice(), [70, 70, 70])
+        self.assertFalse(self.reader.bulk_read)
+
+    def test_one_after_the_other(self):
+        self.bus(bulk_read = False)
+        self.start()
+        self.assertEqual(self.read_twice(), [60, 61, 62])
+
+    def test_set_resolution(self):
+        bus = self.bus(bulk_read = True)
+        self.start(concurrent = True, bulk_read = True)
+        self.assertEqual(self.resolutions(bus), ["12", "12", "12"])
+        self.assertTrue(self.reader.set_resolution(10))
+        self.assertEqual(self.resolutions(bus), ["10", "10", "10"])
+        self.assertEqual(self.reader.resolution, 10)
+
+    def test_set_resolution_fails(self):
+        bus = self.bus(bulk_read = False)
+        self.start()
+        # Now the first sensor's resolution can't be written.
+        resolution = bus.folder + TestTemperatureReader.sensor_ids[0] + "/resolution"
+        os.remove(resolution)
+        os.mkdir(resolution)
+        self.assertFalse(self.reader.set_resolution(10))
+        self.assertEqual(self.resolutions(bus, TestTemperatureReader.sensor_ids[1:]), ["10", "10"])
+
+    def test_sensor_without_new_values_fails(self):
+        bus = self.bus(bulk_read = False)
+        saved = TemperatureReader.stale_sample_seconds
+        TemperatureReader.stale_sample_seconds = 0.2
+        try:
+            self.start(concurrent = True)
+            self.read_twice()
+            os.remove(bus.folder + TestTemperatureReader.sensor_ids[2] + "/temperature")
+            cycle = self.reader.wait_for_samples(None)
+            while self.reader.sample_age() <= 0.2:
+                cycle = self.reader.wait_for_samples(cycle, timeout = 5)
+            with self.assertRaisesRegex(RuntimeError, TestTemperatureReader.sensor_ids[2]):
+                self.reader.temperatures()
+        finally:
+            TemperatureReader.stale_sample_seconds = saved
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+MessageWriter and ErrorReporter tests
+
+    python3 -m unittest test_utils
+"""
+
+import io
+import threading
+import unittest
+
+import clock
+import utils
+from utils import MessageWriter, ErrorReporter
+
+
+class BlockedOutput(io.StringIO):
+    """ An output whose first write waits until it is released, like a GUI that isn't reading its pipe."""
+    def __init__(self):
+        super().__init__()
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def write(self, text):
+        self.writing.set()
+        self.release.wait(5)
+        return super().write(text)
+
+
+class TestMessageWriter(unittest.TestCase):
+
+    def tearDown(self):
+        clock.set_clock(clock.SystemClock())
+
+    def test_unchanged_state_is_dropped(self):
+        output = io.StringIO()
+        writer = MessageWriter(output)
+        for message in ["temp 60", "temp 60", "heat on", "temp 61", "heat on", "time 5", "time 5"]:
+            writer.send(message)
+        writer.flush()
+        self.assertEqual(output.getvalue().splitlines(), ["temp 60", "heat on", "temp 61", "time 5", "time 5"])
+
+    def test_full_resend_on_the_clock_in_use(self):
+        output = io.StringIO()
+        writer = MessageWriter(output)
+        # As replay does, after the writer has been created.
+        virtual = clock.VirtualClock()
+        clock.set_clock(virtual)
+        writer.send("temp 60")
+        virtual.advance(MessageWriter.full_resend_seconds - 1)
+        writer.send("temp 60")
+        virtual.advance(2)
+        writer.send("temp 60")
+        writer.flush()
+        self.assertEqual(output.getvalue().splitlines(), ["temp 60", "temp 60"])
+
+    def test_batch_goes_together(self):
+        output = io.StringIO()
+        writer = MessageWriter(output)
+        with writer.batch():
+            writer.send("temp 60")
+            writer.send("hot")
+            self.assertEqual(output.getvalue(), "")
+        writer.flush()
+        self.assertEqual(output.getvalue(), "temp 60\nhot\n")
+
+    def test_only_buttons_and_errors_jump_the_queue(self):
+        output = BlockedOutput()
+        writer = MessageWriter(output)
+        writer.send("heat on")
+        self.assertTrue(output.writing.wait(5))
+        # While the GUI isn't reading, the rest queue up.
+        writer.send("temp 60")
+        with writer.batch():
+            writer.send("temp 61")
+            writer.send("heat off")
+            writer.send("error \"Oops\"")
+        writer.send("button 1 down")
+        output.release.set()
+        writer.flush()
+        self.assertEqual(output.getvalue().splitlines(), ["heat on", "error \"Oops\"", "button 1 down", "temp 60", "temp 61", "heat off"])
+
+
+class RecordingLogger:
+    def __init__(self):
+        self.errors = []
+
+    def error(self, text):
+        self.errors.append(text)
+
+
+class TestErrorReporter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = clock.VirtualClock()
+        clock.set_clock(self.clock)
+        self.logger = RecordingLogger()
+        self.reporter = ErrorReporter(self.logger)
+        self.output = io.StringIO()
+        self.saved_message_writer = utils.message_writer
+        utils.message_writer = MessageWriter(self.output)
+
+    def tearDown(self):
+        utils.message_writer = self.saved_message_writer
+        clock.set_clock(clock.SystemClock())
+
+    def test_the_same_error_is_only_repeated_every_so_often(self):
+        for second in range(25):
+            self.reporter.report("Sensor failed")
+            self.clock.advance(1)
+        self.assertEqual(self.logger.errors, ["Sensor failed"] * 3)
+        utils.flush_messages()
+        self.assertEqual(self.output.getvalue(), "error \"Sensor failed\"\n" * 3)
+
+    def test_a_different_error_is_reported_straight_away(self):
+        for message in ["Sensor failed", "Other", "Sensor failed"]:
+            self.reporter.report(message)
+        self.assertEqual(self.logger.errors, ["Sensor failed", "Other", "Sensor failed"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,205 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+Watchdog tests
+
+    python3 -m unittest test_watchdog
+"""
+
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from fake_hardware import install_stub_gpio, FakeOneWireBus
+install_stub_gpio()
+
+import core
+import gpio
+import utils
+from temperature_reader import TemperatureReader
+from watchdog import Watchdog
+
+
+def wait_until(condition, timeout = 3):
+    """ Poll condition until it is true, or timeout seconds have passed. Returns the last result."""
+    give_up = time.monotonic() + timeout
+    while not condition() and time.monotonic() < give_up:
+        time.sleep(0.005)
+    return condition()
+
+
+class TripRecorder:
+    def __init__(self):
+        self.reasons = []
+
+    def __call__(self, reason):
+        self.reasons.append(reason)
+
+
+class TestWatchdog(unittest.TestCase):
+
+    def setUp(self):
+        self.trips = TripRecorder()
+        self.age = 0.0
+        self.watchdog = None
+
+    def tearDown(self):
+        if self.watchdog is not None:
+            self.watchdog.stop()
+
+    def start(self, deadline_seconds, sample_age = None, maximum_sample_age_seconds = None):
+        self.watchdog = Watchdog(deadline_seconds, self.trips, sample_age, maximum_sample_age_seconds)
+        self.watchdog.start()
+        return self.watchdog
+
+    def test_missed_kick_trips(self):
+        started = time.monotonic()
+        self.start(0.1)
+        self.assertTrue(wait_until(lambda: len(self.trips.reasons) == 1))
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+        self.assertTrue(self.trips.reasons[0].startswith("Control hasn't run"))
+
+    def test_kicks_in_time_dont_trip(self):
+        watchdog = self.start(0.2)
+        for i in range(40):
+            time.sleep(0.01)
+            watchdog.kick()
+        self.assertEqual(self.trips.reasons, [])
+
+    def test_trips_once_until_kicked_then_rearms(self):
+        watchdog = self.start(0.1)
+        self.assertTrue(wait_until(lambda: len(self.trips.reasons) == 1))
+        # Still not kicked, so no more trips.
+        time.sleep(0.3)
+        self.assertEqual(len(self.trips.reasons), 1)
+        watchdog.kick()
+        self.assertFalse(watchdog.late)
+        self.assertTrue(wait_until(lambda: len(self.trips.reasons) == 2))
+        self.assertEqual(watchdog.trips, 2)
+
+    def test_stale_samples_trip(self):
+        watchdog = self.start(10, lambda: self.age, 15)
+        self.age = 16.0
+        self.assertTrue(wait_until(lambda: len(self.trips.reasons) == 1))
+        self.assertEqual(self.trips.reasons[0], "Temperatures are 16.0s old")
+        self.assertTrue(watchdog.stale)
+
+    def test_stale_samples_trip_once_until_fresh(self):
+        Watchdog.check_seconds = 0.02
+        try:
+            watchdog = self.start(10, lambda: self.age, 15)
+            self.age = 16.0
+            self.assertTrue(wait_until(lambda: len(self.trips.reasons) == 1))
+            time.sleep(0.1)
+            self.assertEqual(len(self.trips.reasons), 1)
+            self.age = 1.0
+            self.assertTrue(wait_until(lambda: not watchdog.stale))
+            self.age = 17.0
+            self.assertTrue(wait_until(lambda: len(self.trips.reasons) == 2))
+        finally:
+            Watchdog.check_seconds = 0.5
+
+    def test_no_sample_age_is_not_stale(self):
+        watchdog = self.start(10, lambda: None, 15)
+        time.sleep(0.1)
+        self.assertEqual(self.trips.reasons, [])
+        self.assertFalse(watchdog.stale)
+
+
+class TestCoreWatchdog(unittest.TestCase):
+    """ The core turns everything off when its watchdog trips, even though the control thread is stuck."""
+
+    sensor_ids = ["28-000001", "28-000002"]
+
+    def setUp(self):
+        self.saved = {
+            "watchdog_seconds": core.Core.watchdog_seconds,
+            "graph_renderer": core.Core.graph_renderer,
+            "one_wire_device_path": TemperatureReader.one_wire_device_path,
+            "stale_sample_seconds": TemperatureReader.stale_sample_seconds,
+            "check_seconds": Watchdog.check_seconds,
+        }
+        self.folder = tempfile.TemporaryDirectory()
+        installation = self.folder.name + "/"
+        self.bus = FakeOneWireBus(installation + "w1/", TestCoreWatchdog.sensor_ids)
+        self.bus.install()
+        self.output = io.StringIO()
+        utils.message_writer.output = self.output
+        core.Core.graph_renderer = "raster"
+        core.Core.watchdog_seconds = 0.5
+        Watchdog.check_seconds = 0.05
+        self.core = core.Core(installation)
+        self.core.start_control_thread()
+        self.core.start_watchdog()
+
+    def tearDown(self):
+        self.core.controlling = False
+        if self.core.watchdog is not None:
+            self.core.watchdog.stop()
+        with self.core.lock:
+            self.core.go_to_idle()
+        utils.flush_messages()
+        utils.message_writer.output = None
+        core.Core.watchdog_seconds = self.saved["watchdog_seconds"]
+        core.Core.graph_renderer = self.saved["graph_renderer"]
+        TemperatureReader.one_wire_device_path = self.saved["one_wire_device_path"]
+        TemperatureReader.stale_sample_seconds = self.saved["stale_sample_seconds"]
+        Watchdog.check_seconds = self.saved["check_seconds"]
+        self.folder.cleanup()
+
+    def heating(self):
+        """ Hold well above the sensors' temperature, so the heater and pump come on."""
+        self.bus.set_all_temperatures(20)
+        self.core.decode_message("hold 66")
+        self.assertTrue(wait_until(lambda: gpio.heater().is_lit and gpio.pump().is_lit))
+
+    def errors(self):
+        utils.flush_messages()
+        return [line for line in self.output.getvalue().splitlines() if line.startswith("error")]
+
+    def test_everything_off_while_control_is_stuck_holding_the_lock(self):
+        self.heating()
+        release = threading.Event()
+        holding = threading.Event()
+        def stuck_control():
+            with self.core.lock:
+                holding.set()
+                release.wait(5)
+        stuck = threading.Thread(target=stuck_control)
+        stuck.start()
+        try:
+            self.assertTrue(holding.wait(1))
+            self.assertTrue(wait_until(lambda: not gpio.heater().is_lit and not gpio.pump().is_lit))
+            # Still stuck, so the watchdog didn't need the lock.
+            self.assertTrue(stuck.is_alive())
+            self.assertTrue(wait_until(lambda: any("Watchdog: Control hasn't run" in e for e in self.errors())))
+        finally:
+            release.set()
+            stuck.join()
+        self.assertEqual(self.core.watchdog.trips, 1)
+
+    def test_everything_off_when_the_temperatures_are_stale(self):
+        core.Core.watchdog_seconds = 10
+        self.core.watchdog.stop()
+        TemperatureReader.stale_sample_seconds = 1
+        self.core.start_watchdog()
+        self.heating()
+        os.remove(self.bus.folder + TestCoreWatchdog.sensor_ids[1] + "/temperature")
+        self.assertTrue(wait_until(lambda: not gpio.heater().is_lit and not gpio.pump().is_lit))
+        self.assertTrue(wait_until(lambda: any("Watchdog: Temperatures are" in e for e in self.errors())))
+
+    def test_watchdog_tripped_turns_everything_off(self):
+        self.heating()
+        with self.core.lock:
+            self.core.watchdog_tripped("testing")
+            self.assertFalse(gpio.heater().is_lit)
+            self.assertFalse(gpio.pump().is_lit)
+        self.assertIn("error \"Watchdog: testing, so everything is off\"", self.errors())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,18 +5,183 @@ https://github.com/pqpq/beer-o-tron
 Utility functions
 """
 
+import itertools
+import queue
 import sys
-from datetime import datetime
+import threading
+from contextlib import contextmanager
+
+import clock
+import stats
+
+
+class MessageWriter:
+    """
+    Write messages to the GUI from a single thread.
+
+    Messages come from the main loop and from the gpiozero button threads,
+    so having one writer means lines can't interleave, and a slow GUI pipe
+    only holds up the writer thread, never the caller.
+
+    Whatever is waiting when the writer thread wakes up is written with one
+    write() and one flush(). Inside a batch() the calling thread's messages
+    are held back and queued together, so a tick's messages go out at once.
+    Button presses and errors jump the queue, but only they do, so messages
+    of the same kind are always written in the order they were sent.
+
+    State messages that haven't changed since they were last sent are
+    dropped, except that everything is sent again every full_resend_seconds
+    in case the GUI missed something.
+    """
+
+    # Messages that go to the front of the queue
+    priority_messages = ["button", "error"]
+
+    # Messages that describe a state, and the state they describe
+    state_messages = {"hot": "state", "cold": "state", "ok": "state", "temp": "temp", "heat": "heat", "pump": "pump"}
+
+    full_resend_seconds = 60
+
+    def __init__(self, output = None):
+        self.output = output
+        self.queue = queue.PriorityQueue()
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        self.last_sent = {}
+        # Not until the first message, since the clock may be replaced after we are created (e.g. for replay).
+        self.last_full_resend = None
+        self.batches = threading.local()
+        self.thread = None
+
+    def send(self, message):
+        started = stats.start()
+        if self.__is_unchanged_state(message):
+            stats.stop("messages.send", started)
+            return
+        batch = getattr(self.batches, "messages", None)
+        if batch is not None:
+            batch.append(message)
+        else:
+            self.__queue([message])
+        stats.stop("messages.send", started)
+
+    @contextmanager
+    def batch(self):
+        """ Hold back this thread's messages until the end of the 'with' block, then send them together."""
+        outer = getattr(self.batches, "messages", None)
+        if outer is not None:
+            yield
+            return
+        self.batches.messages = []
+        try:
+            yield
+        finally:
+            messages = self.batches.messages
+            self.batches.messages = None
+            if len(messages) > 0:
+                self.__queue(messages)
+
+    def flush(self, timeout = 1):
+        """ Wait until everything queued so far has been written."""
+        if self.thread is not None:
+            done = threading.Event()
+            self.queue.put((2, next(self.order), done))
+            done.wait(timeout)
+
+    def __is_unchanged_state(self, message):
+        command = message.split(" ", 1)[0]
+        state = MessageWriter.state_messages.get(command)
+        if state is None:
+            return False
+        with self.lock:
+            now = clock.monotonic()
+            if self.last_full_resend is None:
+                self.last_full_resend = now
+            if now - self.last_full_resend > MessageWriter.full_resend_seconds:
+                self.last_full_resend = now
+                self.last_sent.clear()
+            if self.last_sent.get(state) == message:
+                return True
+            self.last_sent[state] = message
+        return False
+
+    def __queue(self, messages):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=MessageWriter.__thread_function, daemon=True, args=(self,))
+                self.thread.start()
+        urgent = [m for m in messages if m.split(" ", 1)[0] in MessageWriter.priority_messages]
+        if len(urgent) > 0:
+            self.queue.put((0, next(self.order), "".join(m + "\n" for m in urgent)))
+        if len(urgent) < len(messages):
+            self.queue.put((1, next(self.order), "".join(m + "\n" for m in messages if m not in urgent)))
+
+    def __thread_function(self):
+        while True:
+            items = [self.queue.get()]
+            try:
+                while True:
+                    items.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            text = "".join(item for priority, order, item in items if isinstance(item, str))
+            if text != "":
+                # How long the GUI takes to take them, i.e. backpressure from the pipe.
+                started = stats.start()
+                try:
+                    output = self.output if self.output is not None else sys.stdout
+                    output.write(text)
+                    output.flush()
+                except BrokenPipeError:
+                    pass
+                stats.stop("messages.write", started)
+            for priority, order, item in items:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+
+message_writer = MessageWriter()
 
 
 def send_message(message):
-    try:
-        sys.stdout.write(message + '\n')
-        sys.stdout.flush()
-    except BrokenPipeError:
-        pass
+    message_writer.send(message)
+
+
+def message_batch():
+    """ Use in a 'with' statement to send all the messages from a block together."""
+    return message_writer.batch()
+
+
+def flush_messages():
+    message_writer.flush()
+
+
+class ErrorReporter:
+    """
+    Report errors to the log and the GUI, but an error that keeps on
+    happening (e.g. a failed sensor, which control finds for every set of
+    samples) only every repeat_seconds.
+    """
+
+    repeat_seconds = 10
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.last_error = None
+        self.last_reported = 0
+
+    def report(self, message):
+        with self.lock:
+            now = clock.monotonic()
+            if message == self.last_error and now - self.last_reported < ErrorReporter.repeat_seconds:
+                return
+            self.last_error = message
+            self.last_reported = now
+        self.logger.error(message)
+        send_message("error \"" + message + "\"")
 
 
 def datetime_now_string():
     """ Get the current time in IS0-8601 format, suitable for including in a file or directory name."""
-    return datetime.now().strftime("%Y-%m-%d_%H%M%S")
+    return clock.now().strftime("%Y-%m-%d_%H%M%S")
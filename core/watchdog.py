@@ -0,0 +1,101 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+Watchdog class
+"""
+
+import threading
+
+import clock
+
+
+class Watchdog:
+    """
+    Turn everything off if the heater is no longer being controlled.
+
+    The control path kick()s the watchdog every time it has decided what
+    the heater should do. If it hasn't been kicked for deadline_seconds
+    (e.g. the control thread is stuck waiting for the lock, or control
+    keeps failing), or the temperatures we have are older than
+    maximum_sample_age_seconds (e.g. a sensor read has hung), the
+    watchdog trips: it calls trip() with the reason, from its own thread.
+    trip() mustn't need anything the stuck code might be holding, such as
+    the core's lock.
+
+    It trips once for each problem: again for a missed kick once it has
+    been kicked since, and again for stale samples once they have been
+    fresh since.
+
+    The thread sleeps until the kick deadline, or for check_seconds if that
+    is sooner, so the worst case time to trip after the last kick is
+    deadline_seconds plus however long the thread takes to be scheduled.
+    For stale samples it is maximum_sample_age_seconds plus check_seconds.
+    """
+
+    check_seconds = 0.5
+
+    def __init__(self, deadline_seconds, trip, sample_age = None, maximum_sample_age_seconds = None):
+        """
+        deadline_seconds: the longest time allowed between kicks
+        trip: called with the reason, as a string, when the watchdog trips
+        sample_age: returns the age, in seconds, of the oldest of the latest samples, or None if we don't check
+        maximum_sample_age_seconds: the oldest the samples may be
+        """
+        self.deadline_seconds = deadline_seconds
+        self.trip = trip
+        self.sample_age = sample_age
+        self.maximum_sample_age_seconds = maximum_sample_age_seconds
+        self.last_kick = clock.monotonic()
+        # Whether we have tripped because of a missed kick, or stale samples, and not recovered yet.
+        self.late = False
+        self.stale = False
+        self.trips = 0
+        self.running = False
+        self.wake = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.kick()
+        self.running = True
+        self.thread = threading.Thread(target=Watchdog.__thread_function, daemon=True, args=(self,))
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join(timeout = 1)
+            self.thread = None
+
+    def kick(self):
+        self.last_kick = clock.monotonic()
+        if self.late:
+            # Ready to trip again, so start timing the deadline now.
+            self.late = False
+            self.wake.set()
+
+    def __thread_function(self):
+        while self.running:
+            since_kick = clock.monotonic() - self.last_kick
+            if since_kick > self.deadline_seconds and not self.late:
+                self.late = True
+                self.__trip("Control hasn't run for {0:.1f}s".format(since_kick))
+            age = None if self.sample_age is None else self.sample_age()
+            if age is not None and self.maximum_sample_age_seconds is not None and age > self.maximum_sample_age_seconds:
+                if not self.stale:
+                    self.stale = True
+                    self.__trip("Temperatures are {0:.1f}s old".format(age))
+            else:
+                self.stale = False
+            wait = Watchdog.check_seconds
+            if not self.late:
+                # Wake just after the deadline, so we don't find it hasn't quite passed.
+                until_deadline = self.last_kick + self.deadline_seconds - clock.monotonic()
+                wait = max(0.001, min(until_deadline + 0.001, wait))
+            self.wake.wait(wait)
+            self.wake.clear()
+
+    def __trip(self, reason):
+        self.trips = self.trips + 1
+        self.trip(reason)
@@ -0,0 +1,60 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+WindowStatistics class
+"""
+
+import math
+
+
+class WindowStatistics:
+    """
+    Summarise the temperatures over a logging window, as they arrive.
+
+    The control thread sees a set of samples every second or so, but we
+    only log once a window. Rather than keep the samples, keep running
+    totals, so the log has the mean of each sensor and the minimum, mean
+    and maximum of the average over the window, whatever the sensor rate.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.sums = []
+        self.average_sum = 0.0
+        self.average_count = 0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+
+    def add(self, temperatures, average):
+        if len(temperatures) != len(self.sums):
+            # The sensors have changed, so start again.
+            self.reset()
+            self.sums = [0.0] * len(temperatures)
+        self.count = self.count + 1
+        self.sums = [s + t for s, t in zip(self.sums, temperatures)]
+        if not math.isnan(average):
+            self.average_sum = self.average_sum + average
+            self.average_count = self.average_count + 1
+            self.minimum = min(self.minimum, average)
+            self.maximum = max(self.maximum, average)
+
+    def take(self):
+        """
+        Get (temperatures, average, minimum, maximum) for the window so far,
+        where temperatures are the mean of each sensor, and start a new window.
+        Returns None if nothing has been added.
+        """
+        if self.count == 0:
+            return None
+        temperatures = [s / self.count for s in self.sums]
+        if self.average_count > 0:
+            result = (temperatures, self.average_sum / self.average_count, self.minimum, self.maximum)
+        else:
+            result = (temperatures, math.nan, math.nan, math.nan)
+        sensor_count = len(self.sums)
+        self.reset()
+        self.sums = [0.0] * sensor_count
+        return result
@@ -0,0 +1,165 @@
+"""
+Mash-o-matiC Core.
+https://github.com/pqpq/beer-o-tron
+
+WorkerProcess class
+"""
+
+import json
+import sys
+from subprocess import Popen, PIPE, TimeoutExpired
+
+import stats
+from event_loop import LineReader
+from utils import send_message
+
+
+# The start of a worker's reply to a 'stats' command, before its exported histograms.
+stats_report_prefix = "stats_report "
+
+
+def answer_stats(command, send):
+    """
+    The worker's side of a 'stats' command: turn the timing statistics on
+    or off, or reset them, as the command's option says, and send(line)
+    the histograms back.
+    """
+    option = command.get("option")
+    if option == "on":
+        stats.enable(True)
+    elif option == "off":
+        stats.enable(False)
+    elif option == "reset":
+        stats.reset()
+    send(stats_report_prefix + json.dumps(stats.export()))
+
+
+class WorkerProcess:
+    """
+    The core's side of one of its worker processes (see render_worker.py,
+    control_worker.py and log_worker.py).
+
+    A worker is a Python script that takes one JSON command per line on
+    its stdin, and writes lines for the core on its stdout, which are
+    read by the core's EventLoop. Unless received() is overridden they
+    are messages for the GUI, and are passed on.
+
+    The process is started when it is first needed, and again if it stops,
+    in which case it is sent missed(): whatever it needs to catch up.
+    Closing its stdin tells it to finish, and close() waits for it, so
+    anything it writes on the way out is still received.
+
+    Every worker also answers 'stats' commands (see answer_stats()), and
+    the latest histograms it sent back are in stats_report.
+    """
+
+    close_timeout_seconds = 1
+
+    def __init__(self, description, worker_path, arguments, logger, event_loop):
+        """
+        description: what the process is, for the log, e.g. "graph process"
+        worker_path: the script to run
+        arguments: its command line arguments
+        logger: a Logger in case we need to report errors
+        event_loop: the EventLoop that reads the process's output
+        """
+        self.description = description
+        self.worker_path = worker_path
+        self.arguments = arguments
+        self.logger = logger
+        self.event_loop = event_loop
+        self.process = None
+        self.stats_report = None
+        # Called when stats_report arrives, if it isn't None.
+        self.stats_reported = None
+
+    def send(self, command):
+        """ Send command, a dictionary, starting the process if it isn't running."""
+        if not self.is_running():
+            if not self.start():
+                return
+            for c in self.__catch_up():
+                if c is not command:
+                    self.write(c)
+        self.write(command)
+
+    def keep_running(self):
+        """ Start the process if it isn't running, e.g. because it stopped."""
+        if not self.is_running() and self.start():
+            for c in self.__catch_up():
+                self.write(c)
+
+    def request_stats(self, option = None):
+        """ Ask a running process for its timing statistics, passing on option (on, off or reset), if there is one."""
+        self.stats_report = None
+        if self.is_running():
+            self.write({"command": "stats", "option": option})
+
+    def missed(self):
+        """ The commands a new process needs to catch up."""
+        return []
+
+    def received(self, line):
+        """ A line from the process."""
+        send_message(line)
+
+    def stopped(self):
+        """ The process stopped without being asked to."""
+        self.logger.error("The " + self.description + " stopped")
+
+    def close(self):
+        """ Stop the process, if there is one."""
+        if self.process is not None:
+            self.event_loop.remove_reader(self.process.stdout)
+            try:
+                output, errors = self.process.communicate(timeout = self.close_timeout_seconds)
+                for line in output.decode(errors="replace").splitlines():
+                    self.__line(line)
+            except (TimeoutExpired, OSError, ValueError):
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        self.close()
+        try:
+            self.process = Popen([sys.executable, self.worker_path] + self.arguments, stdin=PIPE, stdout=PIPE, bufsize=0)
+        except OSError as e:
+            self.logger.error("Couldn't start the " + self.description + ": " + str(e))
+            return False
+        reader = LineReader(self.process.stdout.fileno(), self.__line, self.__end_of_output)
+        self.event_loop.add_reader(self.process.stdout, reader.read)
+        self.logger.log("Started the " + self.description + ", pid " + str(self.process.pid))
+        return True
+
+    def write(self, command):
+        try:
+            self.process.stdin.write((json.dumps(command) + "\n").encode())
+        except (BrokenPipeError, ValueError, AttributeError):
+            self.logger.error("The " + self.description + " has stopped")
+
+    def __catch_up(self):
+        # A new process doesn't know the statistics are on.
+        catch_up = [{"command": "stats", "option": "on"}] if stats.enabled else []
+        return catch_up + self.missed()
+
+    def __line(self, line):
+        if line.startswith(stats_report_prefix):
+            try:
+                self.stats_report = stats.load(json.loads(line[len(stats_report_prefix):]))
+            except (ValueError, KeyError) as e:
+                self.logger.error("The " + self.description + " sent bad statistics: " + str(e))
+                return
+            if self.stats_reported is not None:
+                self.stats_reported()
+        else:
+            self.received(line)
+
+    def __end_of_output(self):
+        self.event_loop.remove_reader(self.process.stdout)
+        self.process.wait()
+        self.process = None
+        self.stopped()
@@ -60,6 +60,7 @@ Window {
     // Background image. Normally the live temperature graph.
     // Can be a splash screen at startup, etc. etc.
     // Set or refreshed by the "image" message.
+    // The core alternates the graph between two files, and only sends it when it has changed.
     Image {
         id: background
         anchors.fill: parent